@@ -10,10 +10,15 @@ from os import listdir
 import os
 
 import datetime
+import sys
+from django.conf import settings
 from django.shortcuts import render, redirect, HttpResponseRedirect
 from django.http import HttpResponse, JsonResponse
 from global_methods import *
 
+sys.path.append(os.path.join(settings.ROOT_DIR, "reverie/backend_server"))
+from env_channel import send_environment, request_movement
+
 # from django.contrib.staticfiles.templatetags.staticfiles import static #django <3.0版本
 # 正确写法（Django 3.0+）
 from django.templatetags.static  import static 
@@ -206,6 +211,26 @@ def replay_persona_state(request, sim_code, step, persona_name):
   with open(memory + "/associative_memory/nodes.json") as json_file:  
     associative = json.load(json_file)
 
+  # Nodes saved after nodes.json was last rewritten are appended to the
+  # journal next to it, up to the size recorded in save_state.json (see 
+  # associative_memory.py).
+  journal = memory + "/associative_memory/nodes_journal.jsonl"
+  save_state = memory + "/associative_memory/save_state.json"
+  journal_size = None
+  if os.path.exists(save_state):
+    with open(save_state) as json_file:
+      journal_size = json.load(json_file)["journal_size"]
+  if os.path.exists(journal):
+    with open(journal, "rb") as json_file:
+      data = json_file.read(-1 if journal_size is None else journal_size)
+    for line in data.splitlines():
+      try:
+        node_details = json.loads(line)
+      except ValueError:
+        break
+      if node_details["node_count"] == len(associative) + 1:
+        associative[node_details["node_id"]] = node_details
+
   a_mem_event = []
   a_mem_chat = []
   a_mem_thought = []
@@ -246,8 +271,10 @@ def process_environment(request):
   """
   <FRONTEND to BACKEND> 
   This sends the frontend visual world information to the backend server. 
-  It does this by writing the current environment representation to 
-  "storage/environment.json" file. 
+  It does this by pushing the current environment representation to the 
+  running simulation (see env_channel.py), and by writing it to the 
+  "storage/<sim_code>/environment/<step>.json" file, which is also how 
+  simulations are resumed. 
 
   ARGS:
     request: Django request
@@ -266,6 +293,7 @@ def process_environment(request):
   with open(f"storage/{sim_code}/environment/{step}.json", "w") as outfile:
     outfile.write(json.dumps(environment, indent=2))
     outfile.flush()
+  send_environment(sim_code, step, environment)
 
   return HttpResponse("received")
 
@@ -275,8 +303,11 @@ def update_environment(request):
   <BACKEND to FRONTEND> 
   This sends the backend computation of the persona behavior to the frontend
   visual server. 
-  It does this by reading the new movement information from 
-  "storage/movement.json" file.
+  It does this by waiting (briefly, so as not to hold the worker) for the 
+  running simulation to publish the movements of the step (see 
+  env_channel.py), or by reading them from the 
+  "storage/<sim_code>/movement/<step>.json" file. If the simulation is still
+  computing them, the reply is marked "pending" and the frontend asks again.
 
   ARGS:
     request: Django request
@@ -291,11 +322,18 @@ def update_environment(request):
   step = data["step"]
   sim_code = data["sim_code"]
 
+  movements = request_movement(sim_code, step, timeout=0.5)
+  if movements: 
+    movements["<step>"] = step
+    return JsonResponse(movements)
+
   response_data = {"<step>": -1}
   if (check_if_file_exists(f"storage/{sim_code}/movement/{step}.json")):
     with open(f"storage/{sim_code}/movement/{step}.json") as json_file: 
       response_data = json.load(json_file)
       response_data["<step>"] = step
+  elif movements is not None: 
+    response_data["pending"] = True
 
   return JsonResponse(response_data)
 
@@ -14,6 +14,9 @@ from pathlib import Path
 from datetime import datetime
 from multiprocessing import Process
 from openai_cost_logger import OpenAICostLoggerViz
+from persona.prompt_template.gpt_structure import cost_logger
+from persona.prompt_template.openai_logger_singleton import (
+    print_experiment_cache_stats, print_total_cache_stats)
 
 
 def parse_args() -> Tuple[str, str, int, bool]:
@@ -25,6 +28,10 @@ def parse_args() -> Tuple[str, str, int, bool]:
             - the name of the new simulation
             - total steps to run (step = 10sec in the simulation)
             - open the simulator UI
+            - browser path, port and owner
+            - number of threads running persona cognition each step
+            - record the LLM calls, and the simulation whose calls to replay
+            - step without the frontend (no browser is opened)
     """
     parser = argparse.ArgumentParser(description='Reverie Server')
     parser.add_argument(
@@ -70,6 +77,28 @@ def parse_args() -> Tuple[str, str, int, bool]:
         default="public",
         help='Indicate ownership'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of threads running persona cognition in parallel each step'
+    )
+    parser.add_argument(
+        '--record',
+        action='store_true',
+        help='Record all LLM and embedding calls to reverie/llm_log.jsonl'
+    )
+    parser.add_argument(
+        '--replay',
+        type=str,
+        default=None,
+        help='Replay the LLM and embedding calls recorded by this simulation'
+    )
+    parser.add_argument(
+        '--headless',
+        action='store_true',
+        help='Step the simulation in-process, without the frontend and browser'
+    )
     origin = parser.parse_args().origin
     target = parser.parse_args().target
     steps = parser.parse_args().steps
@@ -78,8 +107,12 @@ def parse_args() -> Tuple[str, str, int, bool]:
     browser_path = parser.parse_args().browser_path
     port = parser.parse_args().port
     owner = parser.parse_args().owner
+    workers = parser.parse_args().workers
+    record = parser.parse_args().record
+    replay = parser.parse_args().replay
+    headless = parser.parse_args().headless
     
-    return origin, target, steps, ui, browser_path, port, owner
+    return origin, target, steps, ui, browser_path, port, owner, workers, record, replay, headless
 
 
 def get_starting_step(exp_name: str) -> int:
@@ -157,7 +190,8 @@ def get_new_checkpoint(step: int, tot_steps: int, checkpoint_freq: int) -> int:
 
 
 def save_checkpoint(rs, idx: int, th: Process) -> Tuple[str, int, int]:
-    """Save the checkpoint and return the data to start the new one.
+    """Save the checkpoint and finish the simulation server. Used after an
+    error: the server is then rebuilt from the saved checkpoint.
 
     Args:
         rs (ReverieServer): The reverie server object.
@@ -173,9 +207,28 @@ def save_checkpoint(rs, idx: int, th: Process) -> Tuple[str, int, int]:
     return target, get_starting_step(target), idx+1
 
 
+def save_running_checkpoint(rs, idx: int) -> Tuple[str, int, int]:
+    """Save the checkpoint of a running simulation server, which keeps its
+    in-memory state and goes on stepping from there.
+
+    Args:
+        rs (ReverieServer): The reverie server object.
+        idx (int): The index of the checkpoint.
+
+    Returns:
+        Tuple[str, int, int]: The name of the experiment, the step reached and the index of the next checkpoint.
+    """
+    target = rs.sim_code
+    rs.open_server(input_command="save")
+    print(f"(Auto-Exec): Checkpoint saved: {target}", flush=True)
+    return target, get_starting_step(target), idx+1
+
+
 ###封装一个自动化服务类用于接口调用：
 class AutomaticReverieServer:
-    def __init__(self, origin: str, target: str, steps: int, ui: bool, port: str, isCreate: bool = False):
+    def __init__(self, origin: str, target: str, steps: int, ui: bool, port: str, isCreate: bool = False,
+                 cognition_workers: int = 1, record_llm: bool = False, replay_llm: str = None,
+                 headless: bool = False):
         self.origin = origin
         self.target = target
         self.steps = steps
@@ -186,6 +239,10 @@ class AutomaticReverieServer:
         self.idx = 0
         self.current_step = get_starting_step(origin)  # 使用外部函数
         self.isCreate = isCreate
+        self.cognition_workers = cognition_workers  # Threads for persona cognition per step
+        self.record_llm = record_llm  # Record the LLM calls to the target's llm_log.jsonl
+        self.replay_llm = replay_llm  # Simulation whose recorded LLM calls are replayed
+        self.headless = headless  # Step without the frontend
 
     def get_new_checkpoint(self, step: int) -> int:
         """Get the new checkpoint based on the current step."""
@@ -201,13 +258,21 @@ class AutomaticReverieServer:
         print(f"(Auto-Exec): Total steps: {self.steps}", flush=True)
         print(f"(Auto-Exec): Checkpoint Freq: {self.checkpoint_freq}", flush=True)
 
+        # The server is kept between checkpoints, which are saved in-process;
+        # it is only rebuilt from the last checkpoint after an error.
+        rs = None
         while self.current_step < self.steps:
             try:
                 curr_checkpoint = self.get_new_checkpoint(self.current_step)
                 steps_to_run = curr_checkpoint - self.current_step
                 print(f"(Auto-Exec): Running experiment '{self.target}' from step '{self.current_step}' to '{curr_checkpoint}'", flush=True)
 
-                rs = reverie.ReverieServer(self.origin, self.target, self.isCreate)
+                if rs is None:
+                    rs = reverie.ReverieServer(self.origin, self.target, self.isCreate,
+                                               cognition_workers=self.cognition_workers,
+                                               record_llm=self.record_llm,
+                                               replay_llm=self.replay_llm,
+                                               headless=self.headless)
                 rs.open_server(input_command=f"run {steps_to_run}")
 
             except KeyboardInterrupt:
@@ -222,11 +287,10 @@ class AutomaticReverieServer:
                     shutil.rmtree(f"../../environment/frontend_server/storage/{self.target}")
                 print(f"(Auto-Exec): Error at step {self.current_step}", flush=True)
                 print(f"(Auto-Exec): Exception {e.args[0]}", flush=True)
-            else:
-                self.origin, self.current_step, self.idx = self.save_checkpoint(rs)
-
-            finally:
+                rs = None
                 time.sleep(10)  # Wait for the server to finish
+            else:
+                self.origin, self.current_step, self.idx = save_running_checkpoint(rs, self.idx)
 
         print(f"(Auto-Exec): EXPERIMENT FINISHED: {self.target}")
         print(f"(Auto-Exec): Execution time: {datetime.now() - start_time}")
@@ -243,7 +307,7 @@ if __name__ == '__main__':
     checkpoint_freq = 200 # 1 step = 10 sec
     log_path = "cost-logs" # where the simulations' prints are stored
     idx = 0
-    origin, target, tot_steps, ui, browser_path, port, owner = parse_args()
+    origin, target, tot_steps, ui, browser_path, port, owner, workers, record, replay, headless = parse_args()
     current_step = get_starting_step(origin)
     exp_name = target
     start_time = datetime.now()
@@ -256,20 +320,25 @@ if __name__ == '__main__':
     print(f"(Auto-Exec): Total steps: {tot_steps}", flush=True)
     print(f"(Auto-Exec): Checkpoint Freq: {checkpoint_freq}", flush=True)    
         
+    # The server (and the web tab) is kept between checkpoints, which are
+    # saved in-process; both are only restarted after an error.
+    rs, th, pid = None, None, None
     while current_step < tot_steps:
         try:
             steps_to_run = curr_checkpoint - current_step
             # target = f"{exp_name}-s-{idx}-{current_step}-{curr_checkpoint}" # 原项目为了分段储存，这里不需要（后面reverie中的copyanything对应调整）
             print(f"(Auto-Exec): STAGE {idx}", flush=True)
             print(f"(Auto-Exec): Running experiment '{exp_name}' from step '{current_step}' to '{curr_checkpoint}'", flush=True)
-            rs = reverie.ReverieServer(origin, target, owner=owner)
-            th, pid = None, None 
-            # Headless chrome doesn't need a thread since it create a dedicated thread by itself
-            if ui:
-                th = Process(target=start_web_tab, args=(ui, browser_path, port))
-                th.start()
-            else:
-                pid = start_web_tab(ui, browser_path, port)
+            if rs is None:
+                rs = reverie.ReverieServer(origin, target, owner=owner, cognition_workers=workers,
+                                           record_llm=record, replay_llm=replay, headless=headless)
+                # Headless chrome doesn't need a thread since it create a dedicated thread by itself
+                # In headless mode the backend moves the personas itself: no browser is needed
+                if ui and not headless:
+                    th = Process(target=start_web_tab, args=(ui, browser_path, port))
+                    th.start()
+                elif not headless:
+                    pid = start_web_tab(ui, browser_path, port)
             rs.open_server(input_command=f"run {steps_to_run}")
         except KeyboardInterrupt:
             print("(Auto-Exec): KeyboardInterrupt: Stopping the experiment.", flush=True)
@@ -283,10 +352,7 @@ if __name__ == '__main__':
                 shutil.rmtree(f"../../environment/frontend_server/storage/{target}") # Remove the experiment folder if no steps were run
             print(f"(Auto-Exec): Error at step {current_step}", flush=True)
             print(f"(Auto-Exec): Exception {e.args[0]}", flush=True)
-        else:
-            origin, current_step, idx = save_checkpoint(rs, idx, th)
-            curr_checkpoint = get_new_checkpoint(current_step, tot_steps, checkpoint_freq)
-        finally:
+            rs = None
             time.sleep(10) # Wait for the server to finish and then kill the process
             if th and th.is_alive():
                 th.kill()
@@ -298,9 +364,21 @@ if __name__ == '__main__':
                 os.system(f"kill -9 {pid}")
                 print(f"(Auto-Exec): Killed web tab process with pid {pid}", flush=True)
                 pid = None
+            th = None
+        else:
+            origin, current_step, idx = save_running_checkpoint(rs, idx)
+            curr_checkpoint = get_new_checkpoint(current_step, tot_steps, checkpoint_freq)
 
+    if th and th.is_alive():
+        th.kill()
+        th.join()
+    if pid:
+        os.system(f"kill -9 {pid}")
     print(f"(Auto-Exec): EXPERIMENT FINISHED: {exp_name}")
     OpenAICostLoggerViz.print_experiment_cost(experiment=exp_name, path=log_path)
     OpenAICostLoggerViz.print_total_cost(path=log_path)
+    cost_logger.write_cache_stats()
+    print_experiment_cache_stats(experiment=cost_logger.experiment_name, path=log_path)
+    print_total_cache_stats(path=log_path)
     print(f"(Auto-Exec): Execution time: {datetime.now() - start_time}")
     sys.exit(0)
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""
+File: env_channel.py
+Description: Local channel between the frontend server and a running
+simulation. The frontend pushes each step's environment (the personas'
+positions) to the backend, and long-polls the movements the backend computes
+for that step, over a Unix socket instead of polling the environment/ and
+movement/ files.
+
+Each connection carries one newline-terminated JSON request and its JSON
+reply:
+  {"type": "environment", "step": 12, "environment": {...}} -> {"ok": true}
+  {"type": "movement", "step": 12, "timeout": 10}
+    -> the movements of step 12, or {} if they are not ready in time.
+
+The sockets live in a directory of the temporary directory that only the 
+current user can access, and connections from other users are refused where
+the platform reports the peer's credentials (SO_PEERCRED on Linux).
+
+This module only uses the standard library so that the frontend server can
+import it as well. The files are still written by both sides, so a
+simulation without the channel (e.g., on a platform without Unix sockets)
+falls back on them.
+"""
+import os
+import json
+import stat
+import socket
+import struct
+import tempfile
+import threading
+
+
+def channel_dir():
+  """
+  Returns the directory of the sockets of the current user, creating it (with
+  mode 0700) if needed. Raises OSError if it exists but could be accessed by
+  someone else.
+  """
+  path = os.path.join(tempfile.gettempdir(), f"reverie-{os.getuid()}")
+  try:
+    os.mkdir(path, 0o700)
+  except FileExistsError:
+    pass
+  st = os.lstat(path)
+  if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() 
+      or st.st_mode & 0o077):
+    raise OSError(f"Unsafe channel directory: {path}")
+  return path
+
+
+def channel_path(sim_code):
+  """
+  Returns the socket path of a simulation. It does not depend on the working
+  directory, which differs between the frontend and the backend.
+  """
+  return os.path.join(channel_dir(), f"{sim_code}.sock")
+
+
+def _peer_uid(conn):
+  """
+  Returns the user id of the process at the other end of <conn>, or None if 
+  the platform does not report it.
+  """
+  if not hasattr(socket, "SO_PEERCRED"):
+    return None
+  creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 
+                          struct.calcsize("3i"))
+  return struct.unpack("3i", creds)[1]
+
+
+class EnvironmentChannel:
+  def __init__(self, sim_code):
+    self.sim_code = sim_code
+    self.path = None
+    # <environments> holds the pushed environments not consumed yet, by
+    # step; <movement_step> and <movement> the latest published movements.
+    self.environments = dict()
+    self.movement_step = None
+    self.movement = None
+    self.cond = threading.Condition()
+    self.sock = None
+
+
+  def start(self):
+    """
+    Starts listening for the frontend. Returns False if Unix sockets are not
+    available, in which case the simulation relies on the files only.
+    """
+    if self.sock is not None:
+      return True
+    if not hasattr(socket, "AF_UNIX"):
+      return False
+    try:
+      self.path = channel_path(self.sim_code)
+      os.unlink(self.path)
+    except FileNotFoundError:
+      pass
+    except OSError:
+      return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.bind(self.path)
+      os.chmod(self.path, 0o600)
+      sock.listen()
+    except OSError:
+      sock.close()
+      return False
+    self.sock = sock
+    threading.Thread(target=self._accept, args=(sock,), daemon=True).start()
+    return True
+
+
+  def close(self):
+    if self.sock is None:
+      return
+    self.sock.close()
+    self.sock = None
+    try:
+      os.unlink(self.path)
+    except FileNotFoundError:
+      pass
+
+
+  def _accept(self, sock):
+    while True:
+      try:
+        conn, _ = sock.accept()
+      except OSError:
+        # The socket was closed.
+        return
+      threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+
+  def _serve(self, conn):
+    uid = _peer_uid(conn)
+    if uid is not None and uid != os.getuid():
+      conn.close()
+      return
+    with conn, conn.makefile("rwb") as f:
+      try:
+        request = json.loads(f.readline())
+      except ValueError:
+        return
+      if request.get("type") == "environment":
+        with self.cond:
+          self.environments[int(request["step"])] = request["environment"]
+          self.cond.notify_all()
+        reply = {"ok": True}
+      elif request.get("type") == "movement":
+        step = int(request["step"])
+        with self.cond:
+          self.cond.wait_for(lambda: self.movement_step == step,
+                             timeout=float(request.get("timeout", 10)))
+          reply = self.movement if self.movement_step == step else dict()
+      else:
+        return
+      try:
+        f.write((json.dumps(reply) + "\n").encode())
+        f.flush()
+      except OSError:
+        pass
+
+
+  def wait_environment(self, step, timeout):
+    """
+    Waits up to <timeout> seconds for the environment of <step> to be pushed.
+
+    INPUT
+      step: the simulation step.
+      timeout: seconds to wait.
+    OUTPUT
+      The environment dictionary, or None if it was not pushed in time.
+    """
+    with self.cond:
+      self.cond.wait_for(lambda: step in self.environments, timeout=timeout)
+      for old_step in [i for i in self.environments if i < step]:
+        del self.environments[old_step]
+      return self.environments.pop(step, None)
+
+
+  def publish_movement(self, step, movements):
+    """
+    Makes the movements of <step> available to the frontend, waking up its
+    pending requests.
+    """
+    with self.cond:
+      self.movement_step = step
+      self.movement = movements
+      self.cond.notify_all()
+
+
+def _request(sim_code, request, timeout):
+  if not hasattr(socket, "AF_UNIX"):
+    return None
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(timeout)
+      sock.connect(channel_path(sim_code))
+      with sock.makefile("rwb") as f:
+        f.write((json.dumps(request) + "\n").encode())
+        f.flush()
+        return json.loads(f.readline())
+  except (OSError, ValueError):
+    return None
+
+
+def send_environment(sim_code, step, environment):
+  """
+  Pushes the environment of <step> to the simulation. Returns False if the
+  simulation is not listening.
+  """
+  request = {"type": "environment", "step": step, "environment": environment}
+  return _request(sim_code, request, 5) is not None
+
+
+def request_movement(sim_code, step, timeout=10):
+  """
+  Waits up to <timeout> seconds for the movements of <step>. Returns them,
+  {} if the simulation is listening but not done in time, or None if it is 
+  not listening.
+  """
+  request = {"type": "movement", "step": step, "timeout": timeout}
+  return _request(sim_code, request, timeout + 5)
@@ -8,6 +8,7 @@ import random
 import re
 import string
 import csv
+import json
 import time
 import datetime as dt
 import pathlib
@@ -249,6 +250,129 @@ def copyanything(src, dst):
           raise  # 重新抛出其他异常
 
 
+def write_json_atomic(obj, curr_file, **kwargs):
+  """
+  Writes obj to curr_file as JSON, atomically: the data goes to a temporary
+  file that then replaces curr_file, so a crash never leaves a partly 
+  written file behind. 
+  ARGS:
+    obj: the object to write. 
+    curr_file: path to the json file. 
+    kwargs: passed on to json.dump (e.g., indent). 
+  RETURNS: 
+    None
+  """
+  tmp_file = f"{curr_file}.tmp"
+  with open(tmp_file, "w") as outfile:
+    json.dump(obj, outfile, **kwargs)
+    outfile.flush()
+    os.fsync(outfile.fileno())
+  os.replace(tmp_file, curr_file)
+
+
+# A checkpoint of a simulation folder is written to <CHECKPOINT_STAGING> in 
+# it, then renamed to <CHECKPOINT_COMMIT> (the commit point) and moved into 
+# place. See CheckpointWriter. 
+CHECKPOINT_STAGING = ".checkpoint-staging"
+CHECKPOINT_COMMIT = ".checkpoint-commit"
+
+
+def _fsync_path(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+class CheckpointWriter:
+  """
+  Writes a checkpoint of a simulation folder as a whole. The files of the 
+  checkpoint are written to a staging folder mirroring the simulation 
+  folder (see stage). commit() then renames the staging folder in one 
+  os.replace, and moves its files into place. Until that rename, the 
+  previous checkpoint is left untouched; after it, an interrupted move is 
+  completed by finish_checkpoint. 
+  """
+  def __init__(self, root):
+    """
+    ARGS:
+      root: the simulation folder. 
+    """
+    self.root = root
+    self.staging = f"{root}/{CHECKPOINT_STAGING}"
+    finish_checkpoint(root)
+    os.makedirs(self.staging)
+
+  def stage(self, folder):
+    """
+    Returns the staging folder of <folder>, a folder of the simulation: the 
+    files written there replace the ones in <folder> when committed. 
+    """
+    staged = os.path.join(self.staging, os.path.relpath(folder, self.root))
+    os.makedirs(staged, exist_ok=True)
+    return staged
+
+  def commit(self):
+    for dirpath, _, filenames in os.walk(self.staging):
+      for filename in filenames:
+        _fsync_path(os.path.join(dirpath, filename))
+    os.replace(self.staging, f"{self.root}/{CHECKPOINT_COMMIT}")
+    _fsync_path(self.root)
+    finish_checkpoint(self.root)
+
+
+def finish_checkpoint(root):
+  """
+  Completes the checkpoint of a simulation folder committed but not moved 
+  into place yet, and discards the one that was not committed. 
+  ARGS:
+    root: the simulation folder. 
+  RETURNS: 
+    None
+  """
+  committed = f"{root}/{CHECKPOINT_COMMIT}"
+  if os.path.isdir(committed):
+    for dirpath, _, filenames in os.walk(committed):
+      folder = os.path.join(root, os.path.relpath(dirpath, committed))
+      os.makedirs(folder, exist_ok=True)
+      for filename in filenames:
+        os.replace(os.path.join(dirpath, filename), 
+                   os.path.join(folder, filename))
+    shutil.rmtree(committed)
+  if os.path.isdir(f"{root}/{CHECKPOINT_STAGING}"):
+    shutil.rmtree(f"{root}/{CHECKPOINT_STAGING}")
+
+
+def linkanything(src, dst, link_file):
+  """
+  Like copyanything, but the files for which link_file returns True are 
+  hard-linked to the ones in src instead of being copied (they are copied 
+  if the file system does not support it). Only files that are never 
+  written again should be linked, since writing to a link changes both. 
+  ARGS:
+    src: address of the source folder  
+    dst: address of the destination folder  
+    link_file: function taking a file path relative to src
+  RETURNS: 
+    None
+  """
+  if os.path.exists(dst):
+    print(f"目标目录已存在，跳过复制: {dst}")
+    return
+
+  def link_or_copy(src_file, dst_file):
+    if link_file(os.path.relpath(src_file, src)):
+      try:
+        os.link(src_file, dst_file)
+        return dst_file
+      except OSError:
+        pass
+    return shutil.copy2(src_file, dst_file)
+
+  shutil.copytree(src, dst, copy_function=link_or_copy)
+
+
 def clean_json_tags(response):
   # 移除多余的反引号和 json 标签
   cleaned_response = re.sub(r'```json|```', '', response).strip()
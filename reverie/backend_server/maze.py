@@ -5,15 +5,261 @@ File: maze.py
 Description: Defines the Maze class, which represents the map of the simulated
 world in a 2-dimensional matrix. 
 """
+import os
 import json
 import numpy
 import datetime
 import pickle
 import time
 import math
+import shutil
+import hashlib
+import threading
+from collections import deque, OrderedDict
 
 from global_methods import *
 from utils import *
+from path_finder import collision_grid, clear_collision_grids
+
+# Bump this whenever compile_maze changes what it produces, so that stale 
+# compiled mazes are not loaded. 
+MAZE_COMPILE_VERSION = 1
+# The compiled arrays, saved as .npy files (so that they can be memory-mapped)
+# next to the tables.json file holding the interned strings. 
+MAZE_ARRAYS = ["collision_codes", "sector_codes", "arena_codes", 
+               "game_object_codes", "spawning_location_codes", 
+               "sector_address_codes", "arena_address_codes", 
+               "game_object_address_codes"]
+# Compiled mazes already loaded by this process, keyed by their input hash.
+_compiled_mazes = dict()
+_compiled_mazes_lock = threading.Lock()
+
+
+def maze_input_files(): 
+  """
+  Returns the paths of all the files a maze is built from. 
+  """
+  blocks_folder = f"{env_matrix}/special_blocks"
+  maze_folder = f"{env_matrix}/maze"
+  return ([f"{env_matrix}/maze_meta_info.json"] 
+          + [f"{blocks_folder}/{i}_blocks.csv" 
+             for i in ["world", "sector", "arena", "game_object", 
+                       "spawning_location"]]
+          + [f"{maze_folder}/{i}_maze.csv" 
+             for i in ["collision", "sector", "arena", "game_object", 
+                       "spawning_location"]])
+
+
+def maze_input_hash(): 
+  """
+  Returns a hash of the maze input files and of MAZE_COMPILE_VERSION. It 
+  names the compiled maze, which is rebuilt whenever any input changes. 
+  """
+  sha = hashlib.sha1(f"maze-v{MAZE_COMPILE_VERSION}".encode())
+  for f_input in maze_input_files(): 
+    with open(f_input, "rb") as f: 
+      sha.update(f.read())
+  return sha.hexdigest()
+
+
+def compile_maze(): 
+  """
+  Parses the maze CSVs (exported from Tiled) into integer arrays. 
+
+  OUTPUT
+    A dictionary with the MAZE_ARRAYS, each an int32 array indexed [y][x], 
+    and the string tables they index into: "world", "labels" (one list per
+    layer, "" being code 0) and "addresses". 
+  """
+  meta_info = json.load(open(f"{env_matrix}/maze_meta_info.json"))
+  maze_width = int(meta_info["maze_width"])
+
+  # READING IN SPECIAL BLOCKS
+  # Special blocks are those that are colored in the Tiled map. 
+
+  # Here is an example row for the arena block file: 
+  # e.g., "25335, Double Studio, Studio, Common Room"
+  # And here is another example row for the game object block file: 
+  # e.g, "25331, Double Studio, Studio, Bedroom 2, Painting"
+
+  # Notice that the first element here is the color marker digit from the 
+  # Tiled export. Then we basically have the block path: 
+  # World, Sector, Arena, Game Object -- again, these paths need to be 
+  # unique within an instance of Reverie. 
+  blocks_folder = f"{env_matrix}/special_blocks"
+
+  _wb = blocks_folder + "/world_blocks.csv"
+  wb_rows = read_file_to_list(_wb, header=False)
+  wb = wb_rows[0][-1]
+ 
+  _sb = blocks_folder + "/sector_blocks.csv"
+  sb_rows = read_file_to_list(_sb, header=False)
+  sb_dict = dict()
+  for i in sb_rows: sb_dict[i[0]] = i[-1] 
+  
+  _ab = blocks_folder + "/arena_blocks.csv"
+  ab_rows = read_file_to_list(_ab, header=False)
+  ab_dict = dict()
+  for i in ab_rows: ab_dict[i[0]] = i[-1]
+  
+  _gob = blocks_folder + "/game_object_blocks.csv"
+  gob_rows = read_file_to_list(_gob, header=False)
+  gob_dict = dict()
+  for i in gob_rows: gob_dict[i[0]] = i[-1]
+  
+  _slb = blocks_folder + "/spawning_location_blocks.csv"
+  slb_rows = read_file_to_list(_slb, header=False)
+  slb_dict = dict()
+  for i in slb_rows: slb_dict[i[0]] = i[-1]
+
+  # [SECTION 3] Reading in the matrices 
+  # This is your typical two dimensional matrices. It's made up of 0s and 
+  # the number that represents the color block from the blocks folder. 
+  maze_folder = f"{env_matrix}/maze"
+
+  _cm = maze_folder + "/collision_maze.csv"
+  collision_maze_raw = read_file_to_list(_cm, header=False)[0]
+  _sm = maze_folder + "/sector_maze.csv"
+  sector_maze_raw = read_file_to_list(_sm, header=False)[0]
+  _am = maze_folder + "/arena_maze.csv"
+  arena_maze_raw = read_file_to_list(_am, header=False)[0]
+  _gom = maze_folder + "/game_object_maze.csv"
+  game_object_maze_raw = read_file_to_list(_gom, header=False)[0]
+  _slm = maze_folder + "/spawning_location_maze.csv"
+  spawning_location_maze_raw = read_file_to_list(_slm, header=False)[0]
+
+  # Loading the maze. The mazes are taken directly from the json exports of
+  # Tiled maps. They should be in csv format. 
+  # Importantly, they are "not" in a 2-d matrix format -- they are single 
+  # row matrices with the length of width x height of the maze. So we need
+  # to convert here. 
+  # We can do this all at once since the dimension of all these matrices are
+  # identical (e.g., 70 x 40).
+  # example format: [['0', '0', ... '25309', '0',...], ['0',...]...]
+  # 25309 is the collision bar number right now.
+  collision_maze = []
+  sector_maze = []
+  arena_maze = []
+  game_object_maze = []
+  spawning_location_maze = []
+  for i in range(0, len(collision_maze_raw), maze_width): 
+    tw = maze_width
+    collision_maze += [collision_maze_raw[i:i+tw]]
+    sector_maze += [sector_maze_raw[i:i+tw]]
+    arena_maze += [arena_maze_raw[i:i+tw]]
+    game_object_maze += [game_object_maze_raw[i:i+tw]]
+    spawning_location_maze += [spawning_location_maze_raw[i:i+tw]]
+
+  # Every layer is kept as an integer array of label codes indexed [y][x], 
+  # with the label strings interned in <labels> (code 0 is the empty label 
+  # ""). The world is the same for every tile. The collision layer keeps the
+  # raw block ids as its labels, "0" (code 0) being a walkable tile. 
+  # e.g., labels["arena"][arena_codes[9][58]] == 'bedroom 2'
+  #       labels["sector"][sector_codes[32][59]] == ''
+  compiled = dict()
+  compiled["world"] = wb
+  compiled["labels"] = dict()
+  collision_dict = {i: i for row in collision_maze for i in row if i != "0"}
+  for layer, layer_maze, block_dict in [
+      ("collision", collision_maze, collision_dict), 
+      ("sector", sector_maze, sb_dict), 
+      ("arena", arena_maze, ab_dict), 
+      ("game_object", game_object_maze, gob_dict), 
+      ("spawning_location", spawning_location_maze, slb_dict)]: 
+    labels = ["0"] if layer == "collision" else [""]
+    label_codes = {labels[0]: 0}
+    block_codes = dict()
+    for block_id, label in block_dict.items(): 
+      if label not in label_codes: 
+        label_codes[label] = len(labels)
+        labels += [label]
+      block_codes[block_id] = label_codes[label]
+    compiled["labels"][layer] = labels
+    compiled[f"{layer}_codes"] = numpy.array(
+      [[block_codes.get(i, 0) for i in row] for row in layer_maze], 
+      dtype=numpy.int32)
+
+  # String addresses are interned as well: for the sector, arena and game 
+  # object levels, "<level>_address_codes" holds indices into <addresses>, 
+  # the table of all full string addresses (built as in get_tile_path, so 
+  # they may have empty parts). 
+  # e.g., addresses[arena_address_codes[9][58]] 
+  #         == 'double studio:double studio:bedroom 2'
+  compiled["addresses"] = []
+  address_ids = dict()
+  for level, layers in [
+      ("sector", ["sector"]), 
+      ("arena", ["sector", "arena"]), 
+      ("game_object", ["sector", "arena", "game_object"])]: 
+    codes = numpy.stack([compiled[f"{i}_codes"].ravel() for i in layers], 
+                        axis=1)
+    combos, inverse = numpy.unique(codes, axis=0, return_inverse=True)
+    combo_ids = []
+    for combo in combos.tolist(): 
+      address = ":".join([wb] + [compiled["labels"][layer][code] 
+                                 for layer, code in zip(layers, combo)])
+      if address not in address_ids: 
+        address_ids[address] = len(compiled["addresses"])
+        compiled["addresses"] += [address]
+      combo_ids += [address_ids[address]]
+    compiled[f"{level}_address_codes"] = numpy.array(
+      combo_ids, dtype=numpy.int32)[inverse.ravel()].reshape(
+        compiled["sector_codes"].shape)
+  return compiled
+
+
+def save_compiled_maze(compiled, folder): 
+  """
+  Saves a compiled maze to <folder>. The files are written to a temporary 
+  folder that is then renamed, so that concurrent simulations never see a 
+  partial one; if another process got there first, its copy is kept. 
+  """
+  tmp_folder = f"{folder}.{os.getpid()}.tmp"
+  os.makedirs(tmp_folder, exist_ok=True)
+  for name in MAZE_ARRAYS: 
+    numpy.save(f"{tmp_folder}/{name}.npy", compiled[name])
+  tables = {key: compiled[key] for key in ["world", "labels", "addresses"]}
+  with open(f"{tmp_folder}/tables.json", "w") as outfile:
+    outfile.write(json.dumps(tables))
+  try: 
+    os.rename(tmp_folder, folder)
+  except OSError: 
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def load_compiled_maze(): 
+  """
+  Returns the compiled maze (see compile_maze) of the current maze files. 
+  It is compiled once and cached in the "matrix_compiled" folder next to 
+  the matrix folder, under the hash of its inputs. The arrays are 
+  memory-mapped read-only, so that concurrent simulations share one copy of
+  them, and a process loads each compiled maze only once. 
+  """
+  key = maze_input_hash()
+  with _compiled_mazes_lock: 
+    if key in _compiled_mazes: 
+      return _compiled_mazes[key]
+
+    folder = f"{env_matrix}_compiled/{key}"
+    compiled = None
+    if os.path.exists(f"{folder}/tables.json"): 
+      try: 
+        compiled = json.load(open(f"{folder}/tables.json"))
+        for name in MAZE_ARRAYS: 
+          compiled[name] = numpy.asarray(
+            numpy.load(f"{folder}/{name}.npy", mmap_mode="r"))
+      except (OSError, ValueError): 
+        compiled = None
+    if compiled is None: 
+      compiled = compile_maze()
+      try: 
+        save_compiled_maze(compiled, folder)
+      except OSError: 
+        # e.g., a read-only assets folder; we simply run uncached. 
+        pass
+    _compiled_mazes[key] = compiled
+    return compiled
+
 
 class Maze: 
   def __init__(self, maze_name): 
@@ -33,176 +279,115 @@ class Maze:
     # e.g., "planning to stay at home all day and never go out of her home"
     self.special_constraint = meta_info["special_constraint"]
 
-    # READING IN SPECIAL BLOCKS
-    # Special blocks are those that are colored in the Tiled map. 
-
-    # Here is an example row for the arena block file: 
-    # e.g., "25335, Double Studio, Studio, Common Room"
-    # And here is another example row for the game object block file: 
-    # e.g, "25331, Double Studio, Studio, Bedroom 2, Painting"
-
-    # Notice that the first element here is the color marker digit from the 
-    # Tiled export. Then we basically have the block path: 
-    # World, Sector, Arena, Game Object -- again, these paths need to be 
-    # unique within an instance of Reverie. 
-    blocks_folder = f"{env_matrix}/special_blocks"
-
-    _wb = blocks_folder + "/world_blocks.csv"
-    wb_rows = read_file_to_list(_wb, header=False)
-    wb = wb_rows[0][-1]
-   
-    _sb = blocks_folder + "/sector_blocks.csv"
-    sb_rows = read_file_to_list(_sb, header=False)
-    sb_dict = dict()
-    for i in sb_rows: sb_dict[i[0]] = i[-1] 
-    
-    _ab = blocks_folder + "/arena_blocks.csv"
-    ab_rows = read_file_to_list(_ab, header=False)
-    ab_dict = dict()
-    for i in ab_rows: ab_dict[i[0]] = i[-1]
-    
-    _gob = blocks_folder + "/game_object_blocks.csv"
-    gob_rows = read_file_to_list(_gob, header=False)
-    gob_dict = dict()
-    for i in gob_rows: gob_dict[i[0]] = i[-1]
-    
-    _slb = blocks_folder + "/spawning_location_blocks.csv"
-    slb_rows = read_file_to_list(_slb, header=False)
-    slb_dict = dict()
-    for i in slb_rows: slb_dict[i[0]] = i[-1]
-
-    # [SECTION 3] Reading in the matrices 
-    # This is your typical two dimensional matrices. It's made up of 0s and 
-    # the number that represents the color block from the blocks folder. 
-    maze_folder = f"{env_matrix}/maze"
-
-    _cm = maze_folder + "/collision_maze.csv"
-    collision_maze_raw = read_file_to_list(_cm, header=False)[0]
-    _sm = maze_folder + "/sector_maze.csv"
-    sector_maze_raw = read_file_to_list(_sm, header=False)[0]
-    _am = maze_folder + "/arena_maze.csv"
-    arena_maze_raw = read_file_to_list(_am, header=False)[0]
-    _gom = maze_folder + "/game_object_maze.csv"
-    game_object_maze_raw = read_file_to_list(_gom, header=False)[0]
-    _slm = maze_folder + "/spawning_location_maze.csv"
-    spawning_location_maze_raw = read_file_to_list(_slm, header=False)[0]
-
-    # Loading the maze. The mazes are taken directly from the json exports of
-    # Tiled maps. They should be in csv format. 
-    # Importantly, they are "not" in a 2-d matrix format -- they are single 
-    # row matrices with the length of width x height of the maze. So we need
-    # to convert here. 
-    # We can do this all at once since the dimension of all these matrices are
-    # identical (e.g., 70 x 40).
-    # example format: [['0', '0', ... '25309', '0',...], ['0',...]...]
-    # 25309 is the collision bar number right now.
-    self.collision_maze = []
-    sector_maze = []
-    arena_maze = []
-    game_object_maze = []
-    spawning_location_maze = []
-    for i in range(0, len(collision_maze_raw), meta_info["maze_width"]): 
-      tw = meta_info["maze_width"]
-      self.collision_maze += [collision_maze_raw[i:i+tw]]
-      sector_maze += [sector_maze_raw[i:i+tw]]
-      arena_maze += [arena_maze_raw[i:i+tw]]
-      game_object_maze += [game_object_maze_raw[i:i+tw]]
-      spawning_location_maze += [spawning_location_maze_raw[i:i+tw]]
-
-    # Once we are done loading in the maze, we now set up self.tiles. This is
-    # a matrix accessed by row:col where each access point is a dictionary
-    # that contains all the things that are taking place in that tile. 
-    # More specifically, it contains information about its "world," "sector,"
-    # "arena," "game_object," "spawning_location," as well as whether it is a
-    # collision block, and a set of all events taking place in it. 
-    # e.g., self.tiles[32][59] = {'world': 'double studio', 
-    #            'sector': '', 'arena': '', 'game_object': '', 
-    #            'spawning_location': '', 'collision': False, 'events': set()}
-    # e.g., self.tiles[9][58] = {'world': 'double studio', 
-    #         'sector': 'double studio', 'arena': 'bedroom 2', 
-    #         'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
-    #         'collision': False,
-    #         'events': {('double studio:double studio:bedroom 2:bed',
-    #                    None, None)}} 
-    self.tiles = []
-    for i in range(self.maze_height): 
-      row = []
-      for j in range(self.maze_width):
-        tile_details = dict()
-        tile_details["world"] = wb
-        
-        tile_details["sector"] = ""
-        if sector_maze[i][j] in sb_dict: 
-          tile_details["sector"] = sb_dict[sector_maze[i][j]]
-        
-        tile_details["arena"] = ""
-        if arena_maze[i][j] in ab_dict: 
-          tile_details["arena"] = ab_dict[arena_maze[i][j]]
-        
-        tile_details["game_object"] = ""
-        if game_object_maze[i][j] in gob_dict: 
-          tile_details["game_object"] = gob_dict[game_object_maze[i][j]]
-        
-        tile_details["spawning_location"] = ""
-        if spawning_location_maze[i][j] in slb_dict: 
-          tile_details["spawning_location"] = slb_dict[spawning_location_maze[i][j]]
-        
-        tile_details["collision"] = False
-        if self.collision_maze[i][j] != "0": 
-          tile_details["collision"] = True
-
-        tile_details["events"] = set()
-        
-        row += [tile_details]
-      self.tiles += [row]
+    # READING IN THE TILES
+    # The special blocks and the maze CSVs are compiled into integer arrays 
+    # once (see compile_maze) and loaded from the compiled copy afterwards. 
+    # Instead of a dictionary per tile, every layer is an array of label 
+    # codes indexed [y][x], with the label strings interned in <self.labels>
+    # (code 0 is the empty label ""). The world is the same for every tile. 
+    # e.g., self.labels["arena"][self.arena_codes[9][58]] == 'bedroom 2'
+    #       self.labels["sector"][self.sector_codes[32][59]] == ''
+    # These arrays are shared (read-only) by all the mazes of the process. 
+    compiled = load_compiled_maze()
+    self.world = compiled["world"]
+    self.labels = compiled["labels"]
+    self.sector_codes = compiled["sector_codes"]
+    self.arena_codes = compiled["arena_codes"]
+    self.game_object_codes = compiled["game_object_codes"]
+    self.spawning_location_codes = compiled["spawning_location_codes"]
+
+    # String addresses are interned as well: <self.address_codes> holds, for
+    # the sector, arena and game object levels, an array of indices into 
+    # <self.addresses>, the table of all full string addresses (built as in 
+    # get_tile_path, so they may have empty parts). 
+    # e.g., self.addresses[self.address_codes["arena"][9][58]] 
+    #         == 'double studio:double studio:bedroom 2'
+    self.addresses = compiled["addresses"]
+    self.address_ids = {add: i for i, add in enumerate(self.addresses)}
+    self.address_codes = dict()
+    self.address_codes["sector"] = compiled["sector_address_codes"]
+    self.address_codes["arena"] = compiled["arena_address_codes"]
+    self.address_codes["game object"] = compiled["game_object_address_codes"]
+
+    # The collision layer can be changed (see set_collision), so each maze 
+    # has its own copy of it. <self.collision_maze> holds the block ids as 
+    # strings, e.g., [['0', '0', ... '32125', '0',...], ['0',...]...], and 
+    # <self.collision> is True for the collision blocks. 
+    collision_labels = compiled["labels"]["collision"]
+    self.collision_maze = [[collision_labels[i] for i in row] 
+                           for row in compiled["collision_codes"].tolist()]
+    self.collision = compiled["collision_codes"] != 0
+
+    # <self.tile_events> is a sparse map from (x, y) tile coordinates to the 
+    # set of events taking place in that tile. Only tiles with events are 
+    # kept in it. 
+    # e.g., self.tile_events[(58, 9)] = 
+    #         {('double studio:double studio:bedroom 2:bed', None, None, None)}
+    self.tile_events = dict()
+    # The reverse event indexes, kept in sync by the event methods below. 
+    # <self.event_tiles> maps each event to the set of tiles holding it, and
+    # <self.subject_events> maps an event subject to {tile: events of that 
+    # subject in the tile}. For a persona (whose events have its name as 
+    # subject) the latter is its tile occupancy. 
+    # e.g., self.subject_events['Isabella Rodriguez'] = 
+    #         {(72, 14): {('Isabella Rodriguez', 'is', 'sleeping', 
+    #                      'Isabella Rodriguez is sleeping')}}
+    self.event_tiles = dict()
+    self.subject_events = dict()
+    # <self.event_counts> is the number of events in each tile, indexed 
+    # [y][x], so that the tiles with events can be found with array masks. 
+    self.event_counts = numpy.zeros((self.maze_height, self.maze_width), 
+                                    dtype=numpy.int32)
     # Each game object occupies an event in the tile. We are setting up the 
     # default event value here. 
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        if self.tiles[i][j]["game_object"]:
-          object_name = ":".join([self.tiles[i][j]["world"], 
-                                  self.tiles[i][j]["sector"], 
-                                  self.tiles[i][j]["arena"], 
-                                  self.tiles[i][j]["game_object"]])
-          go_event = (object_name, None, None, None)
-          self.tiles[i][j]["events"].add(go_event)
+    ys, xs = numpy.nonzero(self.game_object_codes)
+    for x, y, code in zip(xs.tolist(), ys.tolist(), 
+                          self.address_codes["game object"][ys, xs].tolist()): 
+      object_name = self.addresses[code]
+      go_event = (object_name, None, None, None)
+      self.add_event_from_tile(go_event, (x, y))
 
     # Reverse tile access. 
     # <self.address_tiles> -- given a string address, we return a set of all 
     # tile coordinates belonging to that address (this is opposite of  
-    # self.tiles that give you the string address given a coordinate). This is
-    # an optimization component for finding paths for the personas' movement. 
+    # get_tile_path that gives you the string address given a coordinate). 
+    # This is an optimization component for finding paths for the personas' 
+    # movement. 
     # self.address_tiles['<spawn_loc>bedroom-2-a'] == {(58, 9)}
     # self.address_tiles['double studio:recreation:pool table'] 
     #   == {(29, 14), (31, 11), (30, 14), (32, 11), ...}, 
     self.address_tiles = dict()
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        addresses = []
-        if self.tiles[i][j]["sector"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}'
-          addresses += [add]
-        if self.tiles[i][j]["arena"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}'
-          addresses += [add]
-        if self.tiles[i][j]["game_object"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}:'
-          add += f'{self.tiles[i][j]["game_object"]}'
-          addresses += [add]
-        if self.tiles[i][j]["spawning_location"]: 
-          add = f'<spawn_loc>{self.tiles[i][j]["spawning_location"]}'
-          addresses += [add]
-
-        for add in addresses: 
-          if add in self.address_tiles: 
-            self.address_tiles[add].add((j, i))
-          else: 
-            self.address_tiles[add] = set([(j, i)])
+    for level, layer_codes in [("sector", self.sector_codes), 
+                               ("arena", self.arena_codes), 
+                               ("game object", self.game_object_codes)]: 
+      ys, xs = numpy.nonzero(layer_codes)
+      for x, y, code in zip(xs.tolist(), ys.tolist(), 
+                            self.address_codes[level][ys, xs].tolist()): 
+        add = self.addresses[code]
+        self.address_tiles.setdefault(add, set()).add((x, y))
+    ys, xs = numpy.nonzero(self.spawning_location_codes)
+    for x, y, code in zip(xs.tolist(), ys.tolist(), 
+                          self.spawning_location_codes[ys, xs].tolist()): 
+      add = f'<spawn_loc>{self.labels["spawning_location"][code]}'
+      self.address_tiles.setdefault(add, set()).add((x, y))
+
+    # Distance fields. 
+    # <self.distance_fields> is an LRU cache of BFS distance fields, keyed by 
+    # a frozenset of target tiles (all the tiles of an address). Each 
+    # field is an int16 array over the grid holding the number of steps to 
+    # the nearest target tile, or -1 if none can be reached. It is only 
+    # invalidated when the collision maze changes (see set_collision), which
+    # bumps <self.distance_fields_version>. The fields are computed outside 
+    # the lock, which only guards the cache. 
+    self.distance_fields = OrderedDict()
+    self.distance_fields_size = 256
+    self.distance_fields_lock = threading.Lock()
+    self.distance_fields_version = 0
+
+    # <self.square_distances> caches, per vision radius r, the (2r+1, 2r+1) 
+    # array of squared distances from its center tile, used by 
+    # get_nearby_events. 
+    self.square_distances = dict()
 
 
   def turn_coordinate_to_tile(self, px_coordinate): 
@@ -225,8 +410,10 @@ class Maze:
 
   def access_tile(self, tile): 
     """
-    Returns the tiles details dictionary that is stored in self.tiles of the 
-    designated x, y location. 
+    Returns the tile details dictionary of the designated x, y location. The
+    dictionary is built from the tile arrays on every call; its "events" set 
+    is a copy of the tile's events, so changes to it are not applied to the
+    maze (use add_event_from_tile and the other event methods below). 
 
     INPUT
       tile: The tile coordinate of our interest in (x, y) form.
@@ -234,16 +421,62 @@ class Maze:
       The tile detail dictionary for the designated tile. 
     EXAMPLE OUTPUT
       Given (58, 9), 
-      self.tiles[9][58] = {'world': 'double studio', 
-            'sector': 'double studio', 'arena': 'bedroom 2', 
-            'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
-            'collision': False,
-            'events': {('double studio:double studio:bedroom 2:bed',
-                       None, None)}} 
+      {'world': 'double studio', 
+       'sector': 'double studio', 'arena': 'bedroom 2', 
+       'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
+       'collision': False,
+       'events': {('double studio:double studio:bedroom 2:bed',
+                  None, None)}} 
     """
     x = tile[0]
     y = tile[1]
-    return self.tiles[y][x]
+    world, sector, arena, game_object = self.get_tile_labels(tile)
+    tile_details = dict()
+    tile_details["world"] = world
+    tile_details["sector"] = sector
+    tile_details["arena"] = arena
+    tile_details["game_object"] = game_object
+    tile_details["spawning_location"] = (
+      self.labels["spawning_location"][self.spawning_location_codes[y][x]])
+    tile_details["collision"] = bool(self.collision[y][x])
+    # A copy: reading a tile must not add it to (or expose) the event index. 
+    tile_details["events"] = set(self.tile_events.get((x, y), ()))
+    return tile_details
+
+
+  def get_tile_labels(self, tile): 
+    """
+    Returns the world, sector, arena and game object labels of a tile, 
+    without building its detail dictionary. 
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+    OUTPUT
+      A (world, sector, arena, game_object) tuple of strings; missing labels
+      are "". 
+    EXAMPLE OUTPUT
+      Given (58, 9), 
+      ('double studio', 'double studio', 'bedroom 2', 'bed')
+    """
+    x = tile[0]
+    y = tile[1]
+    return (self.world, 
+            self.labels["sector"][self.sector_codes.item(y, x)], 
+            self.labels["arena"][self.arena_codes.item(y, x)], 
+            self.labels["game_object"][self.game_object_codes.item(y, x)])
+
+
+  def get_tile_events(self, tile): 
+    """
+    Returns the events taking place in a tile. 
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+    OUTPUT
+      The tile's set of events (an empty frozenset if there are none). It 
+      must not be modified. 
+    """
+    return self.tile_events.get((tile[0], tile[1]), frozenset())
 
 
   def get_tile_path(self, tile, level): 
@@ -260,27 +493,11 @@ class Maze:
       Given tile=(58, 9), and level=arena,
       "double studio:double studio:bedroom 2"
     """
-    x = tile[0]
-    y = tile[1]
-    tile = self.tiles[y][x]
-
-    path = f"{tile['world']}"
     if level == "world": 
-      return path
-    else: 
-      path += f":{tile['sector']}"
-    
-    if level == "sector": 
-      return path
-    else: 
-      path += f":{tile['arena']}"
-
-    if level == "arena": 
-      return path
-    else: 
-      path += f":{tile['game_object']}"
-
-    return path
+      return self.world
+    if level not in self.address_codes: 
+      level = "game object"
+    return self.addresses[self.address_codes[level].item(tile[1], tile[0])]
 
 
   def get_nearby_tiles(self, tile, vision_r): 
@@ -301,6 +518,23 @@ class Maze:
     OUTPUT: 
       nearby_tiles: a list of tiles that are within the radius. 
     """
+    rows, cols = self.get_nearby_window(tile, vision_r)
+    return [(i, j) for i in range(cols.start, cols.stop) 
+                   for j in range(rows.start, rows.stop)]
+
+
+  def get_nearby_window(self, tile, vision_r): 
+    """
+    Returns the square of tiles of get_nearby_tiles as a pair of slices, so
+    that it can index the maze arrays directly. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      vision_r: The radius of the persona's vision. 
+    OUTPUT: 
+      (rows, cols): the y and x slices of the window, e.g., 
+      self.arena_codes[rows, cols] 
+    """
     left_end = 0
     if tile[0] - vision_r > left_end: 
       left_end = tile[0] - vision_r
@@ -317,11 +551,179 @@ class Maze:
     if tile[1] - vision_r > top_end: 
       top_end = tile[1] - vision_r 
 
-    nearby_tiles = []
-    for i in range(left_end, right_end): 
-      for j in range(top_end, bottom_end): 
-        nearby_tiles += [(i, j)]
-    return nearby_tiles
+    return slice(top_end, bottom_end), slice(left_end, right_end)
+
+
+  def get_nearby_addresses(self, tile, vision_r): 
+    """
+    Returns the distinct game object level addresses of the tiles within the
+    vision square, as label tuples. They come in the order in which they 
+    first appear in get_nearby_tiles. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      vision_r: The radius of the persona's vision. 
+    OUTPUT: 
+      A list of (world, sector, arena, game_object) tuples; missing labels 
+      are "". 
+    """
+    rows, cols = self.get_nearby_window(tile, vision_r)
+    # Transposed, so that the window is flattened in get_nearby_tiles order.
+    codes = self.address_codes["game object"][rows, cols].T.ravel()
+    _, first = numpy.unique(codes, return_index=True)
+    first.sort()
+    height = rows.stop - rows.start
+    return [self.get_tile_labels((cols.start + i // height, 
+                                  rows.start + i % height)) 
+            for i in first.tolist()]
+
+
+  def get_nearby_events(self, tile, vision_r, level="arena"): 
+    """
+    Returns the tiles with events within the vision square that have the 
+    same address as <tile> at the given level, with their squared distance 
+    to <tile>. They come in get_nearby_tiles order. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      vision_r: The radius of the persona's vision. 
+      level: sector, arena, or game object
+    OUTPUT: 
+      A list of (squared distance, (x, y)) pairs. 
+    """
+    rows, cols = self.get_nearby_window(tile, vision_r)
+    level_codes = self.address_codes[level]
+    mask = self.event_counts[rows, cols] > 0
+    mask &= level_codes[rows, cols] == level_codes.item(tile[1], tile[0])
+
+    if vision_r not in self.square_distances: 
+      offsets = numpy.arange(-vision_r, vision_r + 1) ** 2
+      self.square_distances[vision_r] = offsets[:, None] + offsets[None, :]
+    # The window is clipped at the maze borders; <tile> is at 
+    # [vision_r][vision_r] of the full square. 
+    top = rows.start - tile[1] + vision_r
+    left = cols.start - tile[0] + vision_r
+    sq_dists = self.square_distances[vision_r][
+      top:top + rows.stop - rows.start, left:left + cols.stop - cols.start]
+
+    xs, ys = numpy.nonzero(mask.T)
+    return list(zip(sq_dists[ys, xs].tolist(), 
+                    zip((xs + cols.start).tolist(), 
+                        (ys + rows.start).tolist())))
+
+
+  def set_collision(self, tile, collision): 
+    """
+    Marks a tile as a collision block or as walkable, invalidating the cached
+    collision grids and distance fields. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      collision: True if the tile becomes a collision block. 
+    OUTPUT: 
+      None
+    """
+    x = tile[0]
+    y = tile[1]
+    self.collision_maze[y][x] = collision_block_id if collision else "0"
+    self.collision[y][x] = collision
+    clear_collision_grids()
+    with self.distance_fields_lock: 
+      self.distance_fields.clear()
+      self.distance_fields_version += 1
+
+
+  def get_distance_field(self, target_tiles): 
+    """
+    Returns the (cached) BFS distance field toward a set of target tiles. 
+
+    INPUT: 
+      target_tiles: The target tile coordinates in (x, y) form, e.g., 
+                    self.address_tiles[address]. 
+    OUTPUT: 
+      An int16 array indexed [y][x] with the number of steps from each tile 
+      to the nearest target tile, -1 where no target can be reached. Target
+      tiles that are collision blocks are not reachable. 
+    """
+    key = frozenset(tuple(i) for i in target_tiles)
+    with self.distance_fields_lock: 
+      if key in self.distance_fields: 
+        self.distance_fields.move_to_end(key)
+        return self.distance_fields[key]
+      version = self.distance_fields_version
+
+    # A miss is computed without the lock, so that the personas' misses do 
+    # not queue up behind each other. 
+    height, width, blocked = collision_grid(self.collision_maze, 
+                                            collision_block_id)
+    dist = [-1] * (height * width)
+    queue = deque()
+    for x, y in key: 
+      idx = y * width + x
+      if not blocked[idx] and dist[idx] < 0: 
+        dist[idx] = 0
+        queue.append(idx)
+    while queue: 
+      idx = queue.popleft()
+      k = dist[idx] + 1
+      i, j = divmod(idx, width)
+      if i > 0 and dist[idx - width] < 0 and not blocked[idx - width]: 
+        dist[idx - width] = k
+        queue.append(idx - width)
+      if j > 0 and dist[idx - 1] < 0 and not blocked[idx - 1]: 
+        dist[idx - 1] = k
+        queue.append(idx - 1)
+      if i < height - 1 and dist[idx + width] < 0 and not blocked[idx + width]: 
+        dist[idx + width] = k
+        queue.append(idx + width)
+      if j < width - 1 and dist[idx + 1] < 0 and not blocked[idx + 1]: 
+        dist[idx + 1] = k
+        queue.append(idx + 1)
+    field = numpy.array(dist, dtype=numpy.int16).reshape(height, width)
+
+    # The field is only cached if the collision maze did not change while it
+    # was computed. 
+    with self.distance_fields_lock: 
+      if version == self.distance_fields_version: 
+        self.distance_fields[key] = field
+        if len(self.distance_fields) > self.distance_fields_size: 
+          self.distance_fields.popitem(last=False)
+    return field
+
+
+  def path_to_tiles(self, curr_tile, target_tiles): 
+    """
+    Finds a shortest path from curr_tile to the nearest of the target tiles 
+    by walking down their cached distance field, in O(path length). 
+
+    INPUT: 
+      curr_tile: The start tile coordinate in (x, y) form. 
+      target_tiles: The target tile coordinates in (x, y) form. 
+    OUTPUT: 
+      The path as a list of (x, y) tiles, curr_tile and the reached target 
+      included, or None if no target can be reached from curr_tile. 
+    """
+    field = self.get_distance_field(target_tiles)
+    x = curr_tile[0]
+    y = curr_tile[1]
+    k = int(field[y][x])
+    if k < 0: 
+      return None
+
+    path = [(x, y)]
+    while k > 0: 
+      # Preferring up, left, down, right like path_finder. 
+      if y > 0 and field[y - 1][x] == k - 1: 
+        y -= 1
+      elif x > 0 and field[y][x - 1] == k - 1: 
+        x -= 1
+      elif y < self.maze_height - 1 and field[y + 1][x] == k - 1: 
+        y += 1
+      else: 
+        x += 1
+      path += [(x, y)]
+      k -= 1
+    return path
 
 
   def add_event_from_tile(self, curr_event, tile): 
@@ -336,7 +738,38 @@ class Maze:
     OUPUT: 
       None
     """
-    self.tiles[tile[1]][tile[0]]["events"].add(curr_event)
+    tile = (tile[0], tile[1])
+    events = self.tile_events.setdefault(tile, set())
+    if curr_event not in events: 
+      events.add(curr_event)
+      self.event_counts[tile[1]][tile[0]] += 1
+      self.event_tiles.setdefault(curr_event, set()).add(tile)
+      (self.subject_events.setdefault(curr_event[0], dict())
+                          .setdefault(tile, set()).add(curr_event))
+
+
+  def _drop_event(self, curr_event, tile): 
+    """
+    Removes an event that is in the tile from the tile and from the event 
+    indexes, dropping the entries that become empty. 
+    """
+    events = self.tile_events[tile]
+    events.remove(curr_event)
+    self.event_counts[tile[1]][tile[0]] -= 1
+    if not events: 
+      del self.tile_events[tile]
+
+    tiles = self.event_tiles[curr_event]
+    tiles.remove(tile)
+    if not tiles: 
+      del self.event_tiles[curr_event]
+
+    subject_events = self.subject_events[curr_event[0]]
+    subject_events[tile].remove(curr_event)
+    if not subject_events[tile]: 
+      del subject_events[tile]
+      if not subject_events: 
+        del self.subject_events[curr_event[0]]
 
 
   def remove_event_from_tile(self, curr_event, tile):
@@ -351,19 +784,16 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
+    tile = (tile[0], tile[1])
+    if tile in self.event_tiles.get(curr_event, ()): 
+      self._drop_event(curr_event, tile)
 
 
   def turn_event_from_tile_idle(self, curr_event, tile):
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
-        new_event = (event[0], None, None, None)
-        self.tiles[tile[1]][tile[0]]["events"].add(new_event)
+    tile = (tile[0], tile[1])
+    if tile in self.event_tiles.get(curr_event, ()): 
+      self._drop_event(curr_event, tile)
+      self.add_event_from_tile((curr_event[0], None, None, None), tile)
 
 
   def remove_subject_events_from_tile(self, subject, tile):
@@ -376,27 +806,35 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event[0] == subject:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
-
-
-
-
-
-
-
-
-
-
-
+    tile = (tile[0], tile[1])
+    for event in list(self.subject_events.get(subject, dict()).get(tile, ())): 
+      self._drop_event(event, tile)
 
 
+  def get_event_tiles(self, curr_event): 
+    """
+    Returns the tiles where an event is taking place. 
 
+    INPUT: 
+      curr_event: An event triple. 
+    OUPUT: 
+      A set of (x, y) tiles (empty if the event is nowhere). It must not be
+      modified. 
+    """
+    return self.event_tiles.get(curr_event, frozenset())
 
 
+  def get_subject_tiles(self, subject): 
+    """
+    Returns the tiles holding an event with the given subject. For a persona
+    this is the tile it occupies. 
 
+    INPUT: 
+      subject: "Isabella Rodriguez"
+    OUPUT: 
+      A view of the (x, y) tiles (empty if there are none). 
+    """
+    return self.subject_events.get(subject, dict()).keys()
 
 
 
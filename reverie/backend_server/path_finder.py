@@ -6,6 +6,7 @@ Description: Implements various path finding functions for generative agents.
 Some of the functions are defunct. 
 """
 import numpy as np
+from collections import deque
 
 def print_maze(maze):
   for row in maze:
@@ -161,13 +162,122 @@ def path_finder_v2(a, start, end, collision_block_char, verbose=False):
   return the_path
 
 
+# <_collision_grids> caches the flattened collision grid of each maze, keyed 
+# by id(maze). The entry keeps a reference to the maze so the id stays valid.
+_collision_grids = dict()
+
+
+def collision_grid(maze, collision_block_char): 
+  """
+  Returns the flattened collision grid of a maze. 
+
+  INPUT
+    maze: the collision maze, either as a list of rows (e.g., 
+          Maze.collision_maze) or as a 2-d numpy boolean array where True
+          marks a collision tile. 
+    collision_block_char: the value of collision tiles in a list maze. 
+  OUTPUT 
+    (height, width, blocked) where <blocked> is a flat row-major list of 
+    bools. The result is cached; call clear_collision_grids() if a maze is 
+    edited in place. 
+  """
+  cached = _collision_grids.get(id(maze))
+  if cached and cached[0] is maze and cached[1] == collision_block_char: 
+    return cached[2]
+
+  if isinstance(maze, np.ndarray) and maze.dtype == bool: 
+    blocked = maze
+  else: 
+    blocked = np.asarray(maze) == collision_block_char
+  grid = (blocked.shape[0], blocked.shape[1], blocked.ravel().tolist())
+  _collision_grids[id(maze)] = (maze, collision_block_char, grid)
+  return grid
+
+
+def clear_collision_grids(): 
+  _collision_grids.clear()
+
+
+def _bfs_to_nearest(a, start, ends, collision_block_char): 
+  """
+  Queue-based BFS from <start> that stops as soon as one of <ends> is 
+  reached. All coordinates are (row, col). 
+
+  OUTPUT 
+    (end, path): the reached end and the path from <start> to it (both 
+    included), or (None, None) if none of <ends> is reachable. 
+  """
+  height, width, blocked = collision_grid(a, collision_block_char)
+  start_idx = start[0] * width + start[1]
+  end_idxs = {end[0] * width + end[1]: end for end in ends}
+
+  # <m> holds the BFS distance + 1 of every reached tile, 0 otherwise. 
+  m = [0] * (height * width)
+  m[start_idx] = 1
+  found = start_idx if start_idx in end_idxs else None
+  queue = deque([start_idx])
+  while queue and found is None: 
+    idx = queue.popleft()
+    k = m[idx] + 1
+    i, j = divmod(idx, width)
+    neighbors = []
+    if i > 0 and not m[idx - width] and not blocked[idx - width]: 
+      neighbors.append(idx - width)
+    if j > 0 and not m[idx - 1] and not blocked[idx - 1]: 
+      neighbors.append(idx - 1)
+    if i < height - 1 and not m[idx + width] and not blocked[idx + width]: 
+      neighbors.append(idx + width)
+    if j < width - 1 and not m[idx + 1] and not blocked[idx + 1]: 
+      neighbors.append(idx + 1)
+    for n in neighbors: 
+      m[n] = k
+      queue.append(n)
+      if found is None and n in end_idxs: 
+        found = n
+  if found is None: 
+    return None, None
+
+  # Walking back from the end, preferring up, left, down, right like v2. 
+  i, j = divmod(found, width)
+  k = m[found]
+  the_path = [(i, j)]
+  while k > 1: 
+    idx = i * width + j
+    if i > 0 and m[idx - width] == k - 1: 
+      i -= 1
+    elif j > 0 and m[idx - 1] == k - 1: 
+      j -= 1
+    elif i < height - 1 and m[idx + width] == k - 1: 
+      i += 1
+    else: 
+      j += 1
+    the_path.append((i, j))
+    k -= 1
+
+  the_path.reverse()
+  return end_idxs[found], the_path
+
+
+def path_finder_v3(a, start, end, collision_block_char, verbose=False):
+  """
+  Queue-based BFS version of path_finder_v2 with the same (row, col) API and
+  the same tie-breaking, so it returns the same paths. Unlike v2 it does not
+  give up after 150 steps; an unreachable <end> still returns [end]. 
+  """
+  end = tuple(end)
+  _, the_path = _bfs_to_nearest(a, tuple(start), [end], collision_block_char)
+  if the_path is None: 
+    return [end]
+  return the_path
+
+
 def path_finder(maze, start, end, collision_block_char, verbose=False):
   # EMERGENCY PATCH
   start = (start[1], start[0])
   end = (end[1], end[0])
   # END EMERGENCY PATCH
 
-  path = path_finder_v2(maze, start, end, collision_block_char, verbose)
+  path = path_finder_v3(maze, start, end, collision_block_char, verbose)
 
   new_path = []
   for i in path: 
@@ -177,6 +287,31 @@ def path_finder(maze, start, end, collision_block_char, verbose=False):
   return path
 
 
+def path_to_nearest(maze, start, targets, collision_block_char): 
+  """
+  Finds the shortest path from <start> to the nearest of <targets> with a 
+  single search. Coordinates are (x, y) like path_finder. 
+
+  INPUT
+    maze: the collision maze (see collision_grid). 
+    start: the start tile. 
+    targets: a non-empty collection of candidate target tiles. 
+    collision_block_char: the value of collision tiles. 
+  OUTPUT 
+    (target, path): the nearest reachable target (as given in <targets>) and
+    the path to it, start and target included. If no target is reachable, 
+    the first target and [target], as path_finder does. 
+  """
+  targets = list(targets)
+  ends = [(target[1], target[0]) for target in targets]
+  end, path = _bfs_to_nearest(maze, (start[1], start[0]), ends, 
+                              collision_block_char)
+  if path is None: 
+    return targets[0], [tuple(targets[0])]
+  return (targets[ends.index(end)], 
+          [(i[1], i[0]) for i in path])
+
+
 def closest_coordinate(curr_coordinate, target_coordinates): 
   min_dist = None
   closest_coordinate = None
@@ -0,0 +1,63 @@
+"""
+File: path_finder_benchmark.py
+Description: Compares path_finder_v2 (wavefront sweeps over the whole grid)
+with path_finder_v3 (queue-based BFS) on the collision maze of the_ville.
+Run it from reverie/backend_server:
+
+  python path_finder_benchmark.py --pairs 100
+"""
+import json
+import time
+import random
+import argparse
+
+from utils import *
+from global_methods import *
+from path_finder import *
+
+
+def load_collision_maze():
+  meta_info = json.load(open(f"{env_matrix}/maze_meta_info.json"))
+  width = int(meta_info["maze_width"])
+  collision_maze_raw = read_file_to_list(
+    f"{env_matrix}/maze/collision_maze.csv", header=False)[0]
+  return [collision_maze_raw[i:i+width]
+          for i in range(0, len(collision_maze_raw), width)]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Path finder benchmark')
+  parser.add_argument('--pairs', type=int, default=100,
+                      help='Number of random (start, end) pairs')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  collision_maze = load_collision_maze()
+  free_tiles = [(x, y) for y, row in enumerate(collision_maze)
+                for x, val in enumerate(row) if val != collision_block_id]
+  rng = random.Random(args.seed)
+  pairs = [(rng.choice(free_tiles), rng.choice(free_tiles))
+           for _ in range(args.pairs)]
+
+  results = dict()
+  for name, finder in [("path_finder_v2", path_finder_v2),
+                       ("path_finder_v3", path_finder_v3)]:
+    start_time = time.perf_counter()
+    results[name] = [finder(collision_maze, (s[1], s[0]), (e[1], e[0]),
+                            collision_block_id)
+                     for s, e in pairs]
+    elapsed = time.perf_counter() - start_time
+    print (f"{name}: {elapsed:.3f}s total, "
+           f"{1000 * elapsed / len(pairs):.2f}ms per path")
+
+  # v2 gives up after 150 wavefronts and returns [end]; count those apart.
+  same = 0
+  v2_gave_up = 0
+  for (s, e), v2_path, v3_path in zip(pairs, results["path_finder_v2"],
+                                      results["path_finder_v3"]):
+    if s != e and len(v2_path) == 1:
+      v2_gave_up += 1
+    elif v2_path == v3_path:
+      same += 1
+  print (f"identical paths: {same}/{len(pairs) - v2_gave_up}, "
+         f"pairs v2 gave up on: {v2_gave_up}")
@@ -79,7 +79,7 @@ def execute(persona, maze, personas, plan):
       # Executing a random location action.
       plan = ":".join(plan.split(":")[:-1])
       target_tiles = maze.address_tiles[plan]
-      target_tiles = random.sample(list(target_tiles), 1)
+      target_tiles = persona.rng.sample(list(target_tiles), 1)
 
     else: 
       # This is our default execution. We simply take the persona to the
@@ -94,51 +94,47 @@ def execute(persona, maze, personas, plan):
         target_tiles = maze.address_tiles[plan]
 
     # There are sometimes more than one tile returned from this (e.g., a tabe
-    # may stretch many coordinates). So, we sample a few here. And from that 
-    # random sample, we will take the closest ones. 
-    if len(target_tiles) < 4: 
-      target_tiles = random.sample(list(target_tiles), len(target_tiles))
-    else:
-      target_tiles = random.sample(list(target_tiles), 4)
+    # may stretch many coordinates). We consider all of them and take the 
+    # closest one below. 
+    target_tiles = list(target_tiles)
+    address_tiles = target_tiles
     # If possible, we want personas to occupy different tiles when they are 
     # headed to the same location on the maze. It is ok if they end up on the 
     # same time, but we try to lower that probability. 
-    # We take care of that overlap here.  
-    persona_name_set = set(personas.keys())
+    # We take care of that overlap here: the tiles occupied by personas are 
+    # looked up in the maze's subject index. 
+    occupied_tiles = set()
+    for persona_name in personas: 
+      occupied_tiles.update(maze.get_subject_tiles(persona_name))
     new_target_tiles = []
     for i in target_tiles: 
-      curr_event_set = maze.access_tile(i)["events"]
-      pass_curr_tile = False
-      for j in curr_event_set: 
-        if j[0] in persona_name_set: 
-          pass_curr_tile = True
-      if not pass_curr_tile: 
+      if (i[0], i[1]) not in occupied_tiles: 
         new_target_tiles += [i]
     if len(new_target_tiles) == 0: 
       new_target_tiles = target_tiles
     target_tiles = new_target_tiles
 
-    # Now that we've identified the target tile, we find the shortest path to
-    # one of the target tiles. 
-    curr_tile = persona.scratch.curr_tile
-    collision_maze = maze.collision_maze
-    closest_target_tile = None
+    # Now that we've identified the target tiles, we find the shortest path to
+    # the closest of them. Addresses spanning several tiles are shared by 
+    # many personas, so we walk down the maze's cached distance field toward
+    # all the tiles of the address (the field does not depend on who stands
+    # where). If that leads to an occupied tile while free ones are left, or
+    # no tile is reachable that way, path_to_nearest takes a collision_maze,
+    # the curr_tile coordinate and the free targets as an input, and returns 
+    # the reached target and a list of coordinate tuples that becomes the 
+    # path. 
+    # e.g., [(0, 1), (1, 1), (1, 2), (1, 3), (1, 4)...]
     path = None
-    for i in target_tiles: 
-      # path_finder takes a collision_mze and the curr_tile coordinate as 
-      # an input, and returns a list of coordinate tuples that becomes the
-      # path. 
-      # e.g., [(0, 1), (1, 1), (1, 2), (1, 3), (1, 4)...]
-      curr_path = path_finder(maze.collision_maze, 
-                              curr_tile, 
-                              i, 
-                              collision_block_id)
-      if not closest_target_tile: 
-        closest_target_tile = i
-        path = curr_path
-      elif len(curr_path) < len(path): 
-        closest_target_tile = i
-        path = curr_path
+    if len(address_tiles) > 1: 
+      path = maze.path_to_tiles(persona.scratch.curr_tile, address_tiles)
+      if (path is not None and path[-1] in occupied_tiles 
+          and len(target_tiles) < len(address_tiles)): 
+        path = None
+    if path is None: 
+      closest_target_tile, path = path_to_nearest(maze.collision_maze, 
+                                                  persona.scratch.curr_tile, 
+                                                  target_tiles, 
+                                                  collision_block_id)
 
     # Actually setting the <planned_path> and <act_path_set>. We cut the 
     # first element in the planned_path because it includes the curr_tile. 
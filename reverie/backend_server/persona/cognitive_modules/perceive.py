@@ -41,36 +41,33 @@ def perceive(persona, maze):
     ret_events: a list of <ConceptNode> that are perceived and new. 
   """
   # PERCEIVE SPACE
-  # We get the nearby tiles given our current tile and the persona's vision
-  # radius. 
-  nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
-                                       persona.scratch.vision_r)
+  # We get the distinct addresses of the nearby tiles given our current tile
+  # and the persona's vision radius. 
+  nearby_addresses = maze.get_nearby_addresses(persona.scratch.curr_tile, 
+                                               persona.scratch.vision_r)
 
   # We then store the perceived space. Note that the s_mem of the persona is
   # in the form of a tree constructed using dictionaries. 
-  for i in nearby_tiles: 
-    i = maze.access_tile(i)
-    if i["world"]: 
-      if (i["world"] not in persona.s_mem.tree): 
-        persona.s_mem.tree[i["world"]] = {}
-    if i["sector"]: 
-      if (i["sector"] not in persona.s_mem.tree[i["world"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]] = {}
-    if i["arena"]: 
-      if (i["arena"] not in persona.s_mem.tree[i["world"]]
-                                              [i["sector"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] = []
-    if i["game_object"]: 
-      if (i["game_object"] not in persona.s_mem.tree[i["world"]]
-                                                    [i["sector"]]
-                                                    [i["arena"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] += [
-                                                             i["game_object"]]
+  for world, sector, arena, game_object in nearby_addresses: 
+    if world: 
+      if (world not in persona.s_mem.tree): 
+        persona.s_mem.tree[world] = {}
+    if sector: 
+      if (sector not in persona.s_mem.tree[world]): 
+        persona.s_mem.tree[world][sector] = {}
+    if arena: 
+      if (arena not in persona.s_mem.tree[world][sector]): 
+        persona.s_mem.tree[world][sector][arena] = []
+    if game_object: 
+      if (game_object not in persona.s_mem.tree[world][sector][arena]): 
+        persona.s_mem.tree[world][sector][arena] += [game_object]
 
   # PERCEIVE EVENTS. 
   # We will perceive events that take place in the same arena as the
-  # persona's current arena. 
-  curr_arena_path = maze.get_tile_path(persona.scratch.curr_tile, "arena")
+  # persona's current arena. The maze gives us the nearby tiles of that arena
+  # that have events, with their squared distance to the persona. 
+  nearby_events = maze.get_nearby_events(persona.scratch.curr_tile, 
+                                         persona.scratch.vision_r, "arena")
   # We do not perceive the same event twice (this can happen if an object is
   # extended across multiple tiles).
   percept_events_set = set()
@@ -79,20 +76,12 @@ def perceive(persona, maze):
   percept_events_list = []
   # First, we put all events that are occuring in the nearby tiles into the
   # percept_events_list
-  for tile in nearby_tiles: 
-    tile_details = maze.access_tile(tile)
-    if tile_details["events"]: 
-      if maze.get_tile_path(tile, "arena") == curr_arena_path:  
-        # This calculates the distance between the persona's current tile, 
-        # and the target tile.
-        dist = math.dist([tile[0], tile[1]], 
-                         [persona.scratch.curr_tile[0], 
-                          persona.scratch.curr_tile[1]])
-        # Add any relevant events to our temp set/list with the distant info. 
-        for event in tile_details["events"]: 
-          if event not in percept_events_set: 
-            percept_events_list += [[dist, event]]
-            percept_events_set.add(event)
+  for dist, tile in nearby_events: 
+    # Add any relevant events to our temp set/list with the distant info. 
+    for event in maze.get_tile_events(tile): 
+      if event not in percept_events_set: 
+        percept_events_list += [[dist, event]]
+        percept_events_set.add(event)
 
   # We sort, and perceive only persona.scratch.att_bandwidth of the closest
   # events. If the bandwidth is larger, then it means the persona can perceive
@@ -116,12 +105,10 @@ def perceive(persona, maze):
     desc = f"{s.split(':')[-1]} is {desc}"
     p_event = (s, p, o)
 
-    # We retrieve the latest persona.scratch.retention events. If there is  
-    # something new that is happening (that is, p_event not in latest_events),
+    # We check the latest persona.scratch.retention events. If there is  
+    # something new that is happening (that is, p_event is not among them),
     # then we add that event to the a_mem and return it. 
-    latest_events = persona.a_mem.get_summarized_latest_events(
-                                    persona.scratch.retention)
-    if p_event not in latest_events:
+    if not persona.a_mem.is_latest_event(p_event, persona.scratch.retention):
       # We start by managing keywords. 
       keywords = set()
       sub = p_event[0]
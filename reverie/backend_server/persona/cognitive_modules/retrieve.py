@@ -10,6 +10,7 @@ sys.path.append('../../')
 from global_methods import *
 from persona.prompt_template.gpt_structure import *
 
+import numpy as np
 from numpy import dot
 from numpy.linalg import norm
 
@@ -129,6 +130,47 @@ def top_highest_x_values(d, x):
   return top_v
 
 
+def normalize_array_floats(a, target_min, target_max): 
+  """
+  Array version of normalize_dict_floats: scales the values of the 1-D numpy
+  array 'a' to the range [target_min, target_max]. 
+
+  INPUT: 
+    a: 1-D numpy array of floats. 
+    target_min: Integer or float. The minimum of the scaled values. 
+    target_max: Integer or float. The maximum of the scaled values. 
+  OUTPUT: 
+    A new float64 array with the normalized values. 
+  """
+  a = np.asarray(a, dtype=np.float64)
+  min_val = a.min()
+  range_val = a.max() - min_val
+  if range_val == 0: 
+    return np.full(a.shape, (target_max - target_min)/2)
+  return (a - min_val) * (target_max - target_min) / range_val + target_min
+
+
+def top_highest_x_indices(a, x): 
+  """
+  Array version of top_highest_x_values: returns the indices of the 'x' 
+  highest values of the 1-D numpy array 'a', highest first. Equal values keep
+  their order in 'a'. 
+
+  INPUT: 
+    a: 1-D numpy array of floats. 
+    x: Integer. The number of indices to return. 
+  OUTPUT: 
+    A 1-D numpy array of indices into 'a'. 
+  """
+  if x <= 0: 
+    return np.zeros(0, dtype=np.int64)
+  if x < a.size: 
+    top = np.argpartition(-a, x - 1)[:x]
+  else: 
+    top = np.arange(a.size)
+  return top[np.lexsort((top, -a[top]))]
+
+
 def extract_recency(persona, nodes):
   """
   Gets the current Persona object and a list of nodes that are in a 
@@ -217,54 +259,87 @@ def new_retrieve(persona, focal_points, n_count=30):
   """
   # <retrieved> is the main dictionary that we are returning
   retrieved = dict() 
-  for focal_pt in focal_points: 
-    # Getting all nodes from the agent's memory (both thoughts and events) and
-    # sorting them by the datetime of creation.
-    # You could also imagine getting the raw conversation, but for now. 
-    nodes = [[i.last_accessed, i]
-              for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
-              if "idle" not in i.embedding_key]
-    nodes = sorted(nodes, key=lambda x: x[0])
-    nodes = [i for created, i in nodes]
-
-    # Calculating the component dictionaries and normalizing them.
-    recency_out = extract_recency(persona, nodes)
-    recency_out = normalize_dict_floats(recency_out, 0, 1)
-    importance_out = extract_importance(persona, nodes)
-    importance_out = normalize_dict_floats(importance_out, 0, 1)  
-    relevance_out = extract_relevance(persona, nodes, focal_pt)
-    relevance_out = normalize_dict_floats(relevance_out, 0, 1)
+  a_mem = persona.a_mem
+
+  # Getting all nodes from the agent's memory (both thoughts and events) as 
+  # rows of the retrieval index. <candidates> lists them in the order of 
+  # seq_event + seq_thought (newest first), skipping the idle ones. 
+  # You could also imagine getting the raw conversation, but for now. 
+  n_candidates = (a_mem.n_rows 
+                  - np.count_nonzero(a_mem.row_is_idle[:a_mem.n_rows]))
+  if not n_candidates: 
+    for focal_pt in focal_points: 
+      retrieved[focal_pt] = []
+    return retrieved
+
+  # The relevance of every candidate to every focal point, in one 
+  # matrix-matrix product of the normalized embeddings. With an ANN index 
+  # (see ann_index.py), each focal point instead pre-filters the top-M 
+  # candidates by relevance, and recency and importance are ranked among 
+  # those. 
+  focal_matrix = np.asarray([get_embedding(focal_pt) 
+                             for focal_pt in focal_points], dtype=np.float32)
+  focal_norms = np.linalg.norm(focal_matrix, axis=1, keepdims=True)
+  focal_matrix = focal_matrix / np.where(focal_norms == 0, 1, focal_norms)
+  ann_index = a_mem.ann_index
+  use_ann = ann_index is not None and n_candidates > ann_index.prefilter
+  if not use_ann: 
+    rows = np.arange(a_mem.n_rows)
+    is_thought = a_mem.row_is_thought[:a_mem.n_rows]
+    candidates = np.concatenate([rows[~is_thought][::-1], 
+                                 rows[is_thought][::-1]])
+    candidates = candidates[~a_mem.row_is_idle[candidates]]
+    relevance_all = focal_matrix @ a_mem.embedding_matrix[candidates].T
+
+  # Note to self: test out different weights. [1, 1, 1] tends to work
+  # decently, but in the future, these weights should likely be learned, 
+  # perhaps through an RL-like process.
+  # gw = [1, 1, 1]
+  # gw = [1, 2, 1]
+  gw = [0.5, 3, 2]
+  for count, focal_pt in enumerate(focal_points): 
+    if use_ann: 
+      focal_rows = ann_index.search(focal_matrix[count], 
+                                    a_mem.embedding_matrix, 
+                                    ann_index.prefilter)
+      focal_rows = focal_rows[~a_mem.row_is_idle[focal_rows]]
+      # Same order as <candidates>: events, then thoughts, newest first. 
+      focal_rows = focal_rows[np.lexsort((-focal_rows, 
+                                          a_mem.row_is_thought[focal_rows]))]
+      focal_relevance = a_mem.embedding_matrix[focal_rows] @ focal_matrix[count]
+    else: 
+      focal_rows = candidates
+      focal_relevance = relevance_all[count]
+    if not focal_rows.size: 
+      retrieved[focal_pt] = []
+      continue
+
+    # Sorting the candidates by the datetime of last access. This is done 
+    # per focal point since retrieving marks the returned nodes as accessed.
+    by_access = np.argsort(a_mem.row_last_accessed[focal_rows], kind="stable")
+    nodes_rows = focal_rows[by_access]
+
+    # Calculating the component arrays and normalizing them.
+    recency_vals = normalize_array_floats(
+      persona.scratch.recency_decay ** np.arange(1, nodes_rows.size + 1), 0, 1)
+    importance = normalize_array_floats(a_mem.row_poignancy[nodes_rows], 0, 1)
+    relevance = normalize_array_floats(focal_relevance[by_access], 0, 1)
 
     # Computing the final scores that combines the component values. 
-    # Note to self: test out different weights. [1, 1, 1] tends to work
-    # decently, but in the future, these weights should likely be learned, 
-    # perhaps through an RL-like process.
-    # gw = [1, 1, 1]
-    # gw = [1, 2, 1]
-    gw = [0.5, 3, 2]
-    master_out = dict()
-    for key in recency_out.keys(): 
-      master_out[key] = (persona.scratch.recency_w*recency_out[key]*gw[0] 
-                     + persona.scratch.relevance_w*relevance_out[key]*gw[1] 
-                     + persona.scratch.importance_w*importance_out[key]*gw[2])
-
-    master_out = top_highest_x_values(master_out, len(master_out.keys()))
-    for key, val in master_out.items(): 
-      print (persona.a_mem.id_to_node[key].embedding_key, val)
-      print (persona.scratch.recency_w*recency_out[key]*1, 
-             persona.scratch.relevance_w*relevance_out[key]*1, 
-             persona.scratch.importance_w*importance_out[key]*1)
-
-    # Extracting the highest x values.
-    # <master_out> has the key of node.id and value of float. Once we get the 
-    # highest x values, we want to translate the node.id into nodes and return
-    # the list of nodes.
-    master_out = top_highest_x_values(master_out, n_count)
-    master_nodes = [persona.a_mem.id_to_node[key] 
-                    for key in list(master_out.keys())]
-
-    for n in master_nodes: 
-      n.last_accessed = persona.scratch.curr_time
+    master_out = (persona.scratch.recency_w*recency_vals*gw[0] 
+                  + persona.scratch.relevance_w*relevance*gw[1] 
+                  + persona.scratch.importance_w*importance*gw[2])
+
+    # Extracting the highest x values, ties broken by recency order. 
+    top = top_highest_x_indices(master_out, n_count)
+    for i in top: 
+      print (a_mem.row_nodes[nodes_rows[i]].embedding_key, master_out[i])
+      print (persona.scratch.recency_w*recency_vals[i]*1, 
+             persona.scratch.relevance_w*relevance[i]*1, 
+             persona.scratch.importance_w*importance[i]*1)
+    master_nodes = [a_mem.row_nodes[nodes_rows[i]] for i in top]
+
+    a_mem.touch(master_nodes, persona.scratch.curr_time)
       
     retrieved[focal_pt] = master_nodes
 
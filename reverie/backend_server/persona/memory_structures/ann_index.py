@@ -0,0 +1,255 @@
+"""
+File: ann_index.py
+Description: Approximate nearest-neighbor indexes over the rows of the
+AssociativeMemory retrieval index. new_retrieve uses them to pre-filter the
+top-M nodes by relevance before the exact recency/importance re-rank.
+
+Two backends are available: "ivf", an inverted-file index on top of NumPy,
+and "hnsw", which needs the optional hnswlib package. Both are built
+incrementally as nodes are added and are saved next to nodes.json. The
+costly upkeep (retraining the IVF centroids) is left to refresh(), called
+when the memory is saved rather than while nodes are added.
+"""
+import os
+import numpy as np
+
+try:
+  import hnswlib
+except ImportError:
+  hnswlib = None
+
+
+class IVFIndex:
+  kind = "ivf"
+
+  def __init__(self, dim, prefilter=200, n_probe=8, min_train=1024):
+    """
+    INPUT
+      dim: the embedding dimension.
+      prefilter: M, the number of nodes returned per query.
+      n_probe: the minimum number of inverted lists scanned per query.
+      min_train: the number of rows before the first k-means training;
+                 until then queries scan every row.
+    """
+    self.dim = dim
+    self.prefilter = prefilter
+    self.n_probe = n_probe
+    self.min_train = min_train
+
+    # <centroids> is None until the index is trained. <lists> holds the rows
+    # of each inverted list and <rows> all indexed rows in insertion order.
+    self.centroids = None
+    self.lists = []
+    self.rows = []
+    self.trained_size = 0
+    # <list_arrays> caches each inverted list as a numpy array.
+    self.list_arrays = dict()
+
+
+  def __len__(self):
+    return len(self.rows)
+
+
+  def add(self, rows, matrix):
+    """
+    Indexes the given rows of the (normalized) embedding matrix. Once the
+    index is trained, new rows go to the list of their nearest centroid; 
+    the centroids are only retrained by refresh(). The first training 
+    happens here, once <min_train> rows are indexed. 
+    """
+    rows = list(rows)
+    self.rows += rows
+    if self.centroids is None:
+      if len(self.rows) >= self.min_train:
+        self.train(matrix)
+    elif rows:
+      assign = np.argmax(matrix[rows] @ self.centroids.T, axis=1)
+      for row, list_id in zip(rows, assign):
+        self.lists[list_id] += [row]
+
+
+  def refresh(self, matrix):
+    """
+    Retrains the index if it has doubled since the last training, so that 
+    the number of lists keeps up with the number of rows. 
+    """
+    if (self.centroids is not None 
+        and len(self.rows) >= 2 * self.trained_size):
+      self.train(matrix)
+
+
+  def train(self, matrix, n_iter=10):
+    """
+    Runs spherical k-means on the indexed rows (on a sample of at most
+    50,000 of them) and rebuilds the inverted lists.
+    """
+    rows = np.asarray(self.rows)
+    n_lists = int(min(1024, max(1, np.sqrt(rows.size))))
+    rng = np.random.default_rng(0)
+    sample = rows
+    if sample.size > 50000:
+      sample = rng.choice(rows, 50000, replace=False)
+    vectors = matrix[sample]
+    centroids = vectors[rng.choice(sample.size, n_lists, replace=False)]
+    for _ in range(n_iter):
+      assign = np.argmax(vectors @ centroids.T, axis=1)
+      for list_id in range(n_lists):
+        members = vectors[assign == list_id]
+        if members.shape[0]:
+          centroid = members.sum(axis=0)
+          centroid_norm = np.linalg.norm(centroid)
+          if centroid_norm:
+            centroids[list_id] = centroid / centroid_norm
+
+    self.centroids = centroids.astype(np.float32)
+    self.lists = [[] for _ in range(n_lists)]
+    self.list_arrays = dict()
+    assign = np.argmax(matrix[rows] @ self.centroids.T, axis=1)
+    for row, list_id in zip(rows.tolist(), assign.tolist()):
+      self.lists[list_id] += [row]
+    self.trained_size = rows.size
+
+
+  def search(self, query, matrix, m):
+    """
+    Returns (up to) the <m> indexed rows most similar to <query>, a
+    normalized vector, in no particular order.
+    """
+    if self.centroids is None:
+      candidates = np.asarray(self.rows, dtype=np.int64)
+    else:
+      by_score = np.argsort(-(self.centroids @ query))
+      probed = []
+      count = 0
+      for n, list_id in enumerate(by_score):
+        if n >= self.n_probe and count >= m:
+          break
+        probed += [self.list_array(list_id)]
+        count += probed[-1].size
+      candidates = np.concatenate(probed)
+    if candidates.size <= m:
+      return candidates
+    scores = matrix[candidates] @ query
+    return candidates[np.argpartition(-scores, m - 1)[:m]]
+
+
+  def list_array(self, list_id):
+    rows = self.list_arrays.get(list_id)
+    if rows is None or rows.size != len(self.lists[list_id]):
+      rows = np.asarray(self.lists[list_id], dtype=np.int64)
+      self.list_arrays[list_id] = rows
+    return rows
+
+
+  def save(self, folder):
+    list_ids = np.zeros(len(self.rows), dtype=np.int64)
+    list_rows = np.zeros(len(self.rows), dtype=np.int64)
+    n = 0
+    for list_id, rows in enumerate(self.lists):
+      list_ids[n:n + len(rows)] = list_id
+      list_rows[n:n + len(rows)] = rows
+      n += len(rows)
+    centroids = self.centroids
+    if centroids is None:
+      centroids = np.zeros((0, self.dim), dtype=np.float32)
+    np.savez(f"{folder}/ann_index.npz",
+             rows=np.asarray(self.rows, dtype=np.int64),
+             centroids=centroids,
+             list_ids=list_ids[:n], list_rows=list_rows[:n],
+             trained_size=self.trained_size)
+
+
+  def load(self, folder):
+    """
+    Loads a saved index. Returns False if there is none.
+    """
+    f_saved = f"{folder}/ann_index.npz"
+    if not os.path.exists(f_saved):
+      return False
+    saved = np.load(f_saved)
+    if saved["centroids"].shape[1] != self.dim:
+      return False
+    self.rows = saved["rows"].tolist()
+    self.trained_size = int(saved["trained_size"])
+    if saved["centroids"].shape[0]:
+      self.centroids = saved["centroids"]
+      self.lists = [[] for _ in range(self.centroids.shape[0])]
+      for list_id, row in zip(saved["list_ids"].tolist(),
+                              saved["list_rows"].tolist()):
+        self.lists[list_id] += [row]
+    return True
+
+
+class HNSWIndex:
+  kind = "hnsw"
+
+  def __init__(self, dim, prefilter=200, m=16, ef_construction=200, ef=100):
+    """
+    INPUT
+      dim: the embedding dimension.
+      prefilter: M, the number of nodes returned per query.
+      m, ef_construction, ef: the hnswlib graph parameters.
+    """
+    if hnswlib is None:
+      raise ValueError("The hnsw retrieval index needs hnswlib installed")
+    self.dim = dim
+    self.prefilter = prefilter
+    self.ef = ef
+    self.index = hnswlib.Index(space="ip", dim=dim)
+    self.index.init_index(max_elements=1024, M=m,
+                          ef_construction=ef_construction)
+
+
+  def __len__(self):
+    return self.index.get_current_count()
+
+
+  def add(self, rows, matrix):
+    rows = list(rows)
+    if not rows:
+      return
+    needed = len(self) + len(rows)
+    if needed > self.index.get_max_elements():
+      self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+    self.index.add_items(matrix[rows], rows)
+
+
+  def refresh(self, matrix):
+    # The graph needs no upkeep.
+    pass
+
+
+  def search(self, query, matrix, m):
+    k = min(m, len(self))
+    if not k:
+      return np.zeros(0, dtype=np.int64)
+    self.index.set_ef(max(self.ef, k))
+    labels, _ = self.index.knn_query(query, k=k)
+    return labels[0].astype(np.int64)
+
+
+  def save(self, folder):
+    self.index.save_index(f"{folder}/ann_index.hnsw")
+
+
+  def load(self, folder):
+    f_saved = f"{folder}/ann_index.hnsw"
+    if not os.path.exists(f_saved):
+      return False
+    self.index.load_index(f_saved, max_elements=0)
+    return self.index.dim == self.dim
+
+
+def make_ann_index(config, dim):
+  """
+  Creates the ANN index described by a simulation's "retrieval_index" meta
+  entry, e.g. {"type": "ivf", "prefilter": 200, "n_probe": 8} or
+  {"type": "hnsw", "prefilter": 200, "m": 16, "ef": 100}.
+  """
+  params = {key.replace("-", "_"): val
+            for key, val in config.items() if key != "type"}
+  if config["type"] == "ivf":
+    return IVFIndex(dim, **params)
+  elif config["type"] == "hnsw":
+    return HNSWIndex(dim, **params)
+  raise ValueError("Invalid retrieval index type")
@@ -7,16 +7,162 @@ Description: Defines the core long-term memory module for generative agents.
 Note (May 1, 2023) -- this class is the Memory Stream module in the generative
 agents paper. 
 """
+import os
 import sys
 sys.path.append('../../')
 
 import json
 import datetime
+import numpy as np
+from collections import Counter
 
 from global_methods import *
+from persona.memory_structures.ann_index import make_ann_index
+from persona.memory_structures.embedding_table import EmbeddingTable
+from persona.prompt_template.gpt_structure import (embedding_store, 
+  embedding_dtype, get_embedding, get_stored_embedding, store_embedding)
+
+
+def load_embedding(key): 
+  """
+  Returns the embedding of a key saved without its vector, from the global 
+  embedding store or, if it is not there, from the embedding model. 
+  """
+  embedding = get_stored_embedding(key)
+  if embedding is None: 
+    embedding = get_embedding(key)
+  return embedding
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def time_to_seconds(curr_time): 
+  """
+  Converts a (naive) datetime into float seconds, the unit of the 
+  last-accessed column of the retrieval index. 
+  """
+  return (curr_time - EPOCH).total_seconds()
+
+
+def _to_epoch(curr_time): 
+  if curr_time is None: 
+    return None
+  return int(time_to_seconds(curr_time))
+
+
+def _from_epoch(seconds): 
+  if seconds is None: 
+    return None
+  return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def _intern(value): 
+  if isinstance(value, str): 
+    return sys.intern(value)
+  return value
+
+
+# New nodes are appended to <JOURNAL_FILE> next to nodes.json on save, instead
+# of rewriting nodes.json. The journal is compacted into it once it holds more
+# than JOURNAL_COMPACT_MIN nodes and more nodes than nodes.json. 
+JOURNAL_FILE = "nodes_journal.jsonl"
+JOURNAL_COMPACT_MIN = 1000
+
+# The journal and the embedding table are appended to in place. 
+# <SAVE_STATE_FILE>, rewritten with the other files on each save, holds how 
+# much of them the save covers: what an interrupted save appended past it is
+# ignored on load and overwritten by the next save. 
+SAVE_STATE_FILE = "save_state.json"
+
+
+def read_journal(f_saved, size=None): 
+  """
+  Reads the node records appended to the journal of a saved associative 
+  memory, stopping at a partly written last line. 
+
+  INPUT
+    f_saved: the folder of the saved associative memory. 
+    size: the number of bytes of the journal covered by the save, if known. 
+  OUTPUT 
+    The list of records (node details with their "node_id"), whether the 
+    whole journal could be read, and the number of bytes read. 
+  """
+  records = []
+  n_bytes = 0
+  if not os.path.exists(f"{f_saved}/{JOURNAL_FILE}"): 
+    return records, True, n_bytes
+  with open(f"{f_saved}/{JOURNAL_FILE}", "rb") as infile: 
+    data = infile.read(size) if size is not None else infile.read()
+  for line in data.splitlines(keepends=True): 
+    try: 
+      records += [json.loads(line)]
+    except ValueError: 
+      return records, False, n_bytes
+    n_bytes += len(line)
+  return records, True, n_bytes
+
+
+def _grow(array, capacity): 
+  grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+  grown[:array.shape[0]] = array
+  return grown
+
+
+class NewestFirst: 
+  """
+  A sequence of nodes read newest first, like the lists the memory used to 
+  prepend to, but stored newest last so that adding a node is O(1). 
+  Indexing, slicing, iteration and + (which returns a list) follow the 
+  newest-first order. 
+  """
+  __slots__ = ("items",)
+
+  def __init__(self, items=None): 
+    # <items> holds the nodes oldest first. 
+    self.items = items if items is not None else []
+
+  def append(self, node): 
+    self.items.append(node)
+
+  def __len__(self): 
+    return len(self.items)
+
+  def __iter__(self): 
+    return reversed(self.items)
+
+  def __getitem__(self, index): 
+    if isinstance(index, slice): 
+      return [self.items[-1 - i] for i in range(len(self.items))[index]]
+    return self.items[-1 - index]
+
+  def __add__(self, other): 
+    return list(self) + list(other)
+
+  def __radd__(self, other): 
+    return list(other) + list(self)
+
+  def __eq__(self, other): 
+    if isinstance(other, NewestFirst): 
+      return self.items == other.items
+    return list(self) == other
+
+  def __repr__(self): 
+    return f"NewestFirst({list(self)!r})"
 
 
 class ConceptNode: 
+  # A persona keeps tens of thousands of nodes over a multi-day run, so the 
+  # nodes have no __dict__: their times are kept as epoch seconds, and their
+  # subject, predicate, object and keywords (a tuple) as interned strings, 
+  # shared by all the nodes. The properties below give back the datetimes 
+  # and the keyword set. 
+  __slots__ = ("node_id", "node_count", "type_count", "type", "depth", 
+               "_created", "_expiration", "_last_accessed", 
+               "subject", "predicate", "object", 
+               "description", "embedding_key", "poignancy", "_keywords", 
+               "filling")
+
   def __init__(self,
                node_id, node_count, type_count, node_type, depth,
                created, expiration, 
@@ -30,11 +176,11 @@ class ConceptNode:
 
     self.created = created
     self.expiration = expiration
-    self.last_accessed = self.created
+    self._last_accessed = self._created
 
-    self.subject = s
-    self.predicate = p
-    self.object = o
+    self.subject = _intern(s)
+    self.predicate = _intern(p)
+    self.object = _intern(o)
 
     self.description = description
     self.embedding_key = embedding_key
@@ -43,17 +189,55 @@ class ConceptNode:
     self.filling = filling
 
 
+  @property
+  def created(self): 
+    return _from_epoch(self._created)
+
+  @created.setter
+  def created(self, curr_time): 
+    self._created = _to_epoch(curr_time)
+
+
+  @property
+  def expiration(self): 
+    return _from_epoch(self._expiration)
+
+  @expiration.setter
+  def expiration(self, curr_time): 
+    self._expiration = _to_epoch(curr_time)
+
+
+  @property
+  def last_accessed(self): 
+    return _from_epoch(self._last_accessed)
+
+  @last_accessed.setter
+  def last_accessed(self, curr_time): 
+    self._last_accessed = _to_epoch(curr_time)
+
+
+  @property
+  def keywords(self): 
+    return set(self._keywords)
+
+  @keywords.setter
+  def keywords(self, keywords): 
+    self._keywords = tuple(_intern(kw) for kw in keywords)
+
+
   def spo_summary(self): 
     return (self.subject, self.predicate, self.object)
 
 
 class AssociativeMemory: 
-  def __init__(self, f_saved): 
+  def __init__(self, f_saved, retrieval_index=None): 
     self.id_to_node = dict()
 
-    self.seq_event = []
-    self.seq_thought = []
-    self.seq_chat = []
+    # The sequences and keyword lists are <NewestFirst>: they read newest 
+    # first but are appended to. 
+    self.seq_event = NewestFirst()
+    self.seq_thought = NewestFirst()
+    self.seq_chat = NewestFirst()
 
     self.kw_to_event = dict()
     self.kw_to_thought = dict()
@@ -62,45 +246,86 @@ class AssociativeMemory:
     self.kw_strength_event = dict()
     self.kw_strength_thought = dict()
 
-    self.embeddings = json.load(open(f_saved + "/embeddings.json"))
+    # <latest_events> counts the s, p, o summaries of the newest 
+    # <latest_retention> events. It is kept up to date by add_event, so that 
+    # perceive can tell whether an event is new without a set per lookup; 
+    # it is rebuilt when another retention is asked for. 
+    self.latest_retention = None
+    self.latest_events = Counter()
+
+    # Retrieval index over the event and thought nodes, one row per node in 
+    # insertion order. <embedding_matrix> holds the L2-normalized float32 
+    # embeddings; <row_last_accessed> (seconds, see time_to_seconds), 
+    # <row_poignancy>, <row_is_thought> and <row_is_idle> are aligned with it,
+    # and <row_nodes> / <node_to_row> map rows to nodes and back. The arrays
+    # grow by doubling; only the first <n_rows> rows are in use. 
+    self.n_rows = 0
+    self.embedding_matrix = None
+    self.row_last_accessed = np.zeros(0, dtype=np.float64)
+    self.row_poignancy = np.zeros(0, dtype=np.float64)
+    self.row_is_thought = np.zeros(0, dtype=bool)
+    self.row_is_idle = np.zeros(0, dtype=bool)
+    self.row_nodes = []
+    self.node_to_row = dict()
+
+    # <ann_index> is the optional approximate nearest-neighbor index over 
+    # the rows (see ann_index.py), configured by <retrieval_index>. It is 
+    # created once the saved nodes are loaded. 
+    self.retrieval_index = None
+    self.ann_index = None
+
+    # <embeddings> maps the embedding keys to their vectors, memory-mapped 
+    # from the binary table (see embedding_table.py). With the global 
+    # embedding store enabled, the vectors are kept there and the table only
+    # saves the keys. Memories saved before it have an embeddings.json 
+    # instead, converted by the next save. 
+    save_state = dict()
+    if os.path.exists(f"{f_saved}/{SAVE_STATE_FILE}"): 
+      save_state = json.load(open(f"{f_saved}/{SAVE_STATE_FILE}"))
+    self.embeddings = EmbeddingTable(
+      embedding_dtype, lookup=load_embedding, 
+      store=store_embedding if embedding_store is not None else None)
+    if not self.embeddings.load(f_saved, save_state.get("embedding_rows"), 
+                                save_state.get("embeddings") == "keys"): 
+      embeddings_load = json.load(open(f_saved + "/embeddings.json"))
+      # Keys saved without a vector reference the global embedding store. 
+      for key, embedding in embeddings_load.items(): 
+        if embedding is None: 
+          embedding = load_embedding(key)
+        self.embeddings[key] = embedding
 
     nodes_load = json.load(open(f_saved + "/nodes.json"))
     for count in range(len(nodes_load.keys())): 
       node_id = f"node_{str(count+1)}"
-      node_details = nodes_load[node_id]
-
-      node_count = node_details["node_count"]
-      type_count = node_details["type_count"]
-      node_type = node_details["type"]
-      depth = node_details["depth"]
-
-      created = datetime.datetime.strptime(node_details["created"], 
-                                           '%Y-%m-%d %H:%M:%S')
-      expiration = None
-      if node_details["expiration"]: 
-        expiration = datetime.datetime.strptime(node_details["expiration"],
-                                                '%Y-%m-%d %H:%M:%S')
-
-      s = node_details["subject"]
-      p = node_details["predicate"]
-      o = node_details["object"]
-
-      description = node_details["description"]
-      embedding_pair = (node_details["embedding_key"], 
-                        self.embeddings[node_details["embedding_key"]])
-      poignancy =node_details["poignancy"]
-      keywords = set(node_details["keywords"])
-      filling = node_details["filling"]
-      
-      if node_type == "event": 
-        self.add_event(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "chat": 
-        self.add_chat(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "thought": 
-        self.add_thought(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
+      self.add_saved_node(nodes_load[node_id])
+
+    # Replaying the journal. Records already in nodes.json (when a 
+    # compaction was interrupted) are skipped; replay stops at a gap. 
+    # <saved_folder>, <snapshot_nodes> and <saved_nodes> tell save() what 
+    # <saved_folder> already holds: nodes.json the first <snapshot_nodes> 
+    # nodes, and the journal the nodes after them up to <saved_nodes> in its
+    # first <journal_size> bytes. 
+    self.snapshot_nodes = len(self.id_to_node)
+    journal, journal_clean, self.journal_size = read_journal(
+      f_saved, save_state.get("journal_size"))
+    for record in journal: 
+      if record["node_count"] <= len(self.id_to_node): 
+        continue
+      if record["node_count"] != len(self.id_to_node) + 1: 
+        journal_clean = False
+        break
+      # The embeddings are saved before the journal; one missing (after an 
+      # interrupted save) is computed again. 
+      if record["embedding_key"] not in self.embeddings: 
+        self.embeddings[record["embedding_key"]] = load_embedding(
+          record["embedding_key"])
+      self.add_saved_node(record)
+    self.saved_folder = os.path.abspath(f_saved)
+    self.saved_nodes = len(self.id_to_node)
+    # A journal with a torn or out of order tail cannot be appended to; the 
+    # next save compacts it. 
+    if not journal_clean: 
+      self.saved_folder = None
 
     kw_strength_load = json.load(open(f_saved + "/kw_strength.json"))
     if kw_strength_load["kw_strength_event"]: 
@@ -108,46 +333,158 @@ class AssociativeMemory:
     if kw_strength_load["kw_strength_thought"]: 
       self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
 
+    self.retrieval_index = retrieval_index
+    if retrieval_index and self.embedding_matrix is not None: 
+      self.setup_ann_index(retrieval_index, f_saved)
+
+
+  def add_saved_node(self, node_details): 
+    """
+    Adds a node saved by save() (from nodes.json or the journal) back to the
+    memory. Its embedding must already be in <self.embeddings>. 
+    """
+    node_count = node_details["node_count"]
+    type_count = node_details["type_count"]
+    node_type = node_details["type"]
+    depth = node_details["depth"]
+
+    created = datetime.datetime.strptime(node_details["created"], 
+                                         '%Y-%m-%d %H:%M:%S')
+    expiration = None
+    if node_details["expiration"]: 
+      expiration = datetime.datetime.strptime(node_details["expiration"],
+                                              '%Y-%m-%d %H:%M:%S')
+
+    s = node_details["subject"]
+    p = node_details["predicate"]
+    o = node_details["object"]
+
+    description = node_details["description"]
+    embedding_pair = (node_details["embedding_key"], 
+                      self.embeddings[node_details["embedding_key"]])
+    poignancy =node_details["poignancy"]
+    keywords = set(node_details["keywords"])
+    filling = node_details["filling"]
     
-  def save(self, out_json): 
+    if node_type == "event": 
+      self.add_event(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "chat": 
+      self.add_chat(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "thought": 
+      self.add_thought(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+
+    
+  def save(self, out_json, stage=None): 
+    """
+    Saves the memory to <out_json>. If it was loaded from (or last saved to) 
+    that folder, only the nodes added since are appended to the journal; 
+    otherwise, or once the journal grows too long, everything is rewritten
+    and the journal emptied. 
+
+    INPUT
+      out_json: the folder of the saved associative memory. 
+      stage: the folder where the files replacing those of <out_json> are 
+             written, when the save is part of a checkpoint that moves them
+             into place (see CheckpointWriter); <out_json> by default. Only 
+             the appends go to <out_json> directly. 
+    OUTPUT 
+      None
+    """
+    if stage is None: 
+      stage = out_json
+    # A table already saved in <out_json> replaces its embeddings.json. 
+    if (self.embeddings.saved_folder == os.path.abspath(out_json) 
+        and os.path.exists(f"{out_json}/embeddings.json")): 
+      os.remove(f"{out_json}/embeddings.json")
+    self.embeddings.save(out_json, stage)
+
+    n_nodes = len(self.id_to_node)
+    journal_nodes = n_nodes - self.snapshot_nodes
+    if (self.saved_folder != os.path.abspath(out_json) 
+        or journal_nodes > max(JOURNAL_COMPACT_MIN, self.snapshot_nodes)): 
+      self.compact(out_json, stage)
+    elif n_nodes > self.saved_nodes: 
+      records = ""
+      for count in range(self.saved_nodes + 1, n_nodes + 1): 
+        node = self.id_to_node[f"node_{str(count)}"]
+        record = self.node_details(node)
+        record["node_id"] = node.node_id
+        records += json.dumps(record) + "\n"
+      records = records.encode()
+      with open(f"{out_json}/{JOURNAL_FILE}", "ab") as outfile: 
+        # Dropping what an interrupted save appended. 
+        outfile.truncate(self.journal_size)
+        outfile.write(records)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+      self.saved_nodes = n_nodes
+      self.journal_size += len(records)
+
+    r = dict()
+    r["kw_strength_event"] = self.kw_strength_event
+    r["kw_strength_thought"] = self.kw_strength_thought
+    write_json_atomic(r, stage+"/kw_strength.json")
+
+    r = dict()
+    r["journal_size"] = self.journal_size
+    r["embedding_rows"] = self.embeddings.n_saved
+    r["embeddings"] = "keys" if self.embeddings.keys_only else "rows"
+    write_json_atomic(r, f"{stage}/{SAVE_STATE_FILE}")
+
+    # The index is refreshed (e.g., the IVF centroids retrained) here rather
+    # than while nodes are added, so that perception does not stall on it. 
+    if self.ann_index is not None: 
+      self.ann_index.refresh(self.embedding_matrix)
+      self.ann_index.save(stage)
+
+
+  def compact(self, out_json, stage): 
+    """
+    Rewrites nodes.json (in <stage>, see save) with all the nodes and empties
+    the journal of <out_json>: its size in the save state becomes 0, and the
+    next append truncates it. The journal records already in nodes.json are 
+    skipped on load, should the save state not follow. 
+    """
     r = dict()
     for count in range(len(self.id_to_node.keys()), 0, -1): 
       node_id = f"node_{str(count)}"
-      node = self.id_to_node[node_id]
+      r[node_id] = self.node_details(self.id_to_node[node_id])
+    write_json_atomic(r, stage+"/nodes.json")
 
-      r[node_id] = dict()
-      r[node_id]["node_count"] = node.node_count
-      r[node_id]["type_count"] = node.type_count
-      r[node_id]["type"] = node.type
-      r[node_id]["depth"] = node.depth
+    self.journal_size = 0
+    self.saved_folder = os.path.abspath(out_json)
+    self.snapshot_nodes = len(self.id_to_node)
+    self.saved_nodes = len(self.id_to_node)
 
-      r[node_id]["created"] = node.created.strftime('%Y-%m-%d %H:%M:%S')
-      r[node_id]["expiration"] = None
-      if node.expiration: 
-        r[node_id]["expiration"] = (node.expiration
-                                        .strftime('%Y-%m-%d %H:%M:%S'))
 
-      r[node_id]["subject"] = node.subject
-      r[node_id]["predicate"] = node.predicate
-      r[node_id]["object"] = node.object
+  def node_details(self, node): 
+    """
+    Returns the dictionary a node is saved as in nodes.json. 
+    """
+    r = dict()
+    r["node_count"] = node.node_count
+    r["type_count"] = node.type_count
+    r["type"] = node.type
+    r["depth"] = node.depth
 
-      r[node_id]["description"] = node.description
-      r[node_id]["embedding_key"] = node.embedding_key
-      r[node_id]["poignancy"] = node.poignancy
-      r[node_id]["keywords"] = list(node.keywords)
-      r[node_id]["filling"] = node.filling
+    r["created"] = node.created.strftime('%Y-%m-%d %H:%M:%S')
+    r["expiration"] = None
+    if node.expiration: 
+      r["expiration"] = node.expiration.strftime('%Y-%m-%d %H:%M:%S')
 
-    with open(out_json+"/nodes.json", "w") as outfile:
-      json.dump(r, outfile)
+    r["subject"] = node.subject
+    r["predicate"] = node.predicate
+    r["object"] = node.object
 
-    r = dict()
-    r["kw_strength_event"] = self.kw_strength_event
-    r["kw_strength_thought"] = self.kw_strength_thought
-    with open(out_json+"/kw_strength.json", "w") as outfile:
-      json.dump(r, outfile)
-
-    with open(out_json+"/embeddings.json", "w") as outfile:
-      json.dump(self.embeddings, outfile)
+    r["description"] = node.description
+    r["embedding_key"] = node.embedding_key
+    r["poignancy"] = node.poignancy
+    r["keywords"] = list(node.keywords)
+    r["filling"] = node.filling
+    return r
 
 
   def add_event(self, created, expiration, s, p, o, 
@@ -174,13 +511,20 @@ class AssociativeMemory:
                        poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_event[0:0] = [node]
+    self.seq_event.append(node)
+    if self.latest_retention: 
+      self.latest_events[node.spo_summary()] += 1
+      if len(self.seq_event) > self.latest_retention: 
+        dropped = self.seq_event[self.latest_retention].spo_summary()
+        self.latest_events[dropped] -= 1
+        if not self.latest_events[dropped]: 
+          del self.latest_events[dropped]
     keywords = [i.lower() for i in keywords]
     for kw in keywords: 
       if kw in self.kw_to_event: 
-        self.kw_to_event[kw][0:0] = [node]
+        self.kw_to_event[kw].append(node)
       else: 
-        self.kw_to_event[kw] = [node]
+        self.kw_to_event[kw] = NewestFirst([node])
     self.id_to_node[node_id] = node 
 
     # Adding in the kw_strength
@@ -192,6 +536,7 @@ class AssociativeMemory:
           self.kw_strength_event[kw] = 1
 
     self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.index_node(node, embedding_pair[1])
 
     return node
 
@@ -218,13 +563,13 @@ class AssociativeMemory:
                        description, embedding_pair[0], poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_thought[0:0] = [node]
+    self.seq_thought.append(node)
     keywords = [i.lower() for i in keywords]
     for kw in keywords: 
       if kw in self.kw_to_thought: 
-        self.kw_to_thought[kw][0:0] = [node]
+        self.kw_to_thought[kw].append(node)
       else: 
-        self.kw_to_thought[kw] = [node]
+        self.kw_to_thought[kw] = NewestFirst([node])
     self.id_to_node[node_id] = node 
 
     # Adding in the kw_strength
@@ -236,6 +581,7 @@ class AssociativeMemory:
           self.kw_strength_thought[kw] = 1
 
     self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.index_node(node, embedding_pair[1])
 
     return node
 
@@ -257,13 +603,13 @@ class AssociativeMemory:
                        description, embedding_pair[0], poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_chat[0:0] = [node]
+    self.seq_chat.append(node)
     keywords = [i.lower() for i in keywords]
     for kw in keywords: 
       if kw in self.kw_to_chat: 
-        self.kw_to_chat[kw][0:0] = [node]
+        self.kw_to_chat[kw].append(node)
       else: 
-        self.kw_to_chat[kw] = [node]
+        self.kw_to_chat[kw] = NewestFirst([node])
     self.id_to_node[node_id] = node 
 
     self.embeddings[embedding_pair[0]] = embedding_pair[1]
@@ -271,6 +617,80 @@ class AssociativeMemory:
     return node
 
 
+  def index_node(self, node, embedding): 
+    """
+    Appends an event or thought node to the retrieval index. 
+
+    INPUT
+      node: the <ConceptNode> that was just added. 
+      embedding: its embedding vector. 
+    OUTPUT 
+      None
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    vector_norm = np.linalg.norm(vector)
+    if vector_norm: 
+      vector = vector / vector_norm
+
+    if self.embedding_matrix is None: 
+      self.embedding_matrix = np.zeros((0, vector.shape[0]), dtype=np.float32)
+    if self.n_rows == self.embedding_matrix.shape[0]: 
+      capacity = max(64, 2 * self.n_rows)
+      self.embedding_matrix = _grow(self.embedding_matrix, capacity)
+      self.row_last_accessed = _grow(self.row_last_accessed, capacity)
+      self.row_poignancy = _grow(self.row_poignancy, capacity)
+      self.row_is_thought = _grow(self.row_is_thought, capacity)
+      self.row_is_idle = _grow(self.row_is_idle, capacity)
+
+    row = self.n_rows
+    self.embedding_matrix[row] = vector
+    self.row_last_accessed[row] = time_to_seconds(node.last_accessed)
+    self.row_poignancy[row] = node.poignancy
+    self.row_is_thought[row] = node.type == "thought"
+    self.row_is_idle[row] = "idle" in node.embedding_key
+    self.row_nodes += [node]
+    self.node_to_row[node.node_id] = row
+    self.n_rows += 1
+
+    if self.retrieval_index and self.ann_index is None: 
+      self.setup_ann_index(self.retrieval_index)
+    elif self.ann_index is not None: 
+      self.ann_index.add([row], self.embedding_matrix)
+
+
+  def setup_ann_index(self, retrieval_index, f_saved=None): 
+    """
+    Creates the ANN index, loading the one saved in <f_saved> if there is 
+    one, and indexes the rows it does not cover yet. 
+
+    INPUT
+      retrieval_index: the "retrieval_index" entry of the simulation meta. 
+      f_saved: the folder of the saved associative memory, if any. 
+    OUTPUT 
+      None
+    """
+    self.ann_index = make_ann_index(retrieval_index, 
+                                    self.embedding_matrix.shape[1])
+    if (not f_saved or not self.ann_index.load(f_saved) 
+        or len(self.ann_index) > self.n_rows): 
+      self.ann_index = make_ann_index(retrieval_index, 
+                                      self.embedding_matrix.shape[1])
+    self.ann_index.add(range(len(self.ann_index), self.n_rows), 
+                       self.embedding_matrix)
+
+
+  def touch(self, nodes, curr_time): 
+    """
+    Marks the nodes as accessed at <curr_time>, keeping the retrieval index 
+    in sync with node.last_accessed. 
+    """
+    curr_seconds = time_to_seconds(curr_time)
+    for node in nodes: 
+      node.last_accessed = curr_time
+      if node.node_id in self.node_to_row: 
+        self.row_last_accessed[self.node_to_row[node.node_id]] = curr_seconds
+
+
   def get_summarized_latest_events(self, retention): 
     ret_set = set()
     for e_node in self.seq_event[:retention]: 
@@ -278,6 +698,24 @@ class AssociativeMemory:
     return ret_set
 
 
+  def is_latest_event(self, spo_summary, retention): 
+    """
+    Returns whether an event is among the newest <retention> events, like 
+    spo_summary in get_summarized_latest_events(retention), in O(1). 
+
+    INPUT
+      spo_summary: the (subject, predicate, object) of the event. 
+      retention: the number of newest events considered. 
+    OUTPUT 
+      True if one of them has that summary. 
+    """
+    if retention != self.latest_retention: 
+      self.latest_retention = retention
+      self.latest_events = Counter(e_node.spo_summary() 
+                                   for e_node in self.seq_event[:retention])
+    return spo_summary in self.latest_events
+
+
   def get_str_seq_events(self): 
     ret_str = ""
     for count, event in enumerate(self.seq_event): 
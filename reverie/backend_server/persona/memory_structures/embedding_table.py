@@ -0,0 +1,285 @@
+"""
+File: embedding_table.py
+Description: Binary storage of the embeddings of an associative memory. The
+vectors are the rows of embeddings.npy (float32, or float16 to halve it) and
+embeddings_keys.jsonl holds the key of each row, one JSON string per line.
+
+Saved rows are memory-mapped on load. Saving to the folder the table was
+loaded from only appends the new rows and keys; the row count in the .npy
+header is updated last and commits them, so rows or keys written by an
+interrupted save are ignored (and overwritten by the next one). The row count
+saved with the rest of the memory (see associative_memory.py) can restrict
+them further, to the rows of the last complete checkpoint.
+
+With the global embedding store enabled (see embedding_store.py), the vectors
+are kept there once for all personas, and the table only saves the keys.
+"""
+import os
+import json
+import struct
+import numpy as np
+
+MATRIX_FILE = "embeddings.npy"
+KEYS_FILE = "embeddings_keys.jsonl"
+
+# The .npy header (format version 1.0) is written with a fixed size so that
+# the row count can be updated in place.
+HEADER_SIZE = 128
+
+
+def _write_header(outfile, dtype, n_rows, dim):
+  header = repr({"descr": dtype.str, "fortran_order": False,
+                 "shape": (n_rows, dim)}).encode("latin1")
+  prefix = b"\x93NUMPY\x01\x00" + struct.pack("<H", HEADER_SIZE - 10)
+  outfile.seek(0)
+  outfile.write(prefix + header.ljust(HEADER_SIZE - len(prefix) - 1) + b"\n")
+
+
+def _grow(array, capacity):
+  grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+  grown[:array.shape[0]] = array
+  return grown
+
+
+class EmbeddingTable:
+  def __init__(self, dtype="float32", lookup=None, store=None):
+    """
+    INPUT
+      dtype: the dtype of the saved rows.
+      lookup: returns the vector of a key saved without it (e.g., from the
+              global embedding store).
+      store: adds a vector to the global embedding store. When given, the 
+             table only keeps the keys: vectors are stored on add and read 
+             back with <lookup>.
+    """
+    self.dtype = np.dtype(dtype)
+    self.dim = None
+    self.lookup = lookup
+    self.store = store
+    self.keys_only = store is not None
+
+    # <key_to_row> maps the keys to their rows. The first <n_mapped> rows are
+    # the memory-mapped <mapped> matrix, the ones added since are in
+    # <added>, which grows by doubling.
+    self.key_to_row = dict()
+    self.row_keys = []
+    self.mapped = None
+    self.n_mapped = 0
+    self.added = None
+
+    # <saved_folder> holds the first <n_saved> rows; its keys file is
+    # <keys_size> bytes long up to them.
+    self.saved_folder = None
+    self.n_saved = 0
+    self.keys_size = 0
+
+
+  def load(self, f_saved, n_rows=None, keys_only=False):
+    """
+    Memory-maps the table saved in <f_saved>.
+
+    INPUT
+      f_saved: the folder of the saved associative memory.
+      n_rows: the number of rows covered by the save, if known.
+      keys_only: True if the table was saved without its rows.
+    OUTPUT
+      False if there is no table there (e.g., a memory saved with
+      embeddings.json), True otherwise.
+    """
+    mapped = None
+    dtype = self.dtype
+    if keys_only:
+      if not os.path.exists(f"{f_saved}/{KEYS_FILE}"):
+        return False
+    else:
+      if not os.path.exists(f"{f_saved}/{MATRIX_FILE}"):
+        return False
+      with open(f"{f_saved}/{MATRIX_FILE}", "rb") as infile:
+        np.lib.format.read_magic(infile)
+        shape, _, dtype = np.lib.format.read_array_header_1_0(infile)
+      if n_rows is None or n_rows > shape[0]:
+        n_rows = shape[0]
+      if n_rows:
+        mapped = np.memmap(f"{f_saved}/{MATRIX_FILE}", dtype=dtype,
+                           mode="r", offset=HEADER_SIZE, 
+                           shape=(n_rows, shape[1]))
+
+    keys = []
+    keys_size = 0
+    with open(f"{f_saved}/{KEYS_FILE}", "rb") as infile:
+      while n_rows is None or len(keys) < n_rows:
+        line = infile.readline()
+        if not line.endswith(b"\n"):
+          break
+        keys_size += len(line)
+        keys += [json.loads(line)]
+
+    # A table saved with or without its rows, unlike this one, is converted
+    # (and written whole by the next save). 
+    if keys_only != self.keys_only:
+      for row, key in enumerate(keys):
+        self[key] = mapped[row] if mapped is not None else self.lookup(key)
+      return True
+
+    if mapped is not None:
+      self.dim = mapped.shape[1]
+      self.mapped = mapped
+    self.n_mapped = len(keys)
+    for row, key in enumerate(keys):
+      self.key_to_row[key] = row
+    self.row_keys = keys
+
+    self.n_saved = len(keys)
+    self.keys_size = keys_size
+    self.saved_folder = os.path.abspath(f_saved)
+    # A table saved with another dtype is rewritten by the next save.
+    if dtype != self.dtype:
+      self.saved_folder = None
+    return True
+
+
+  def __len__(self):
+    return len(self.row_keys)
+
+
+  def __contains__(self, key):
+    return key in self.key_to_row
+
+
+  def __getitem__(self, key):
+    row = self.key_to_row[key]
+    if self.keys_only:
+      return np.asarray(self.lookup(key), dtype=np.float32)
+    return self.row(row)
+
+
+  def __setitem__(self, key, embedding):
+    """
+    Adds the embedding of <key>. The rows are never rewritten: a key that is
+    already in the table keeps its vector (the embedding of a text does not
+    change).
+    """
+    if key in self.key_to_row:
+      return
+    if self.keys_only:
+      self.store(key, np.asarray(embedding, dtype=np.float32))
+      self.key_to_row[key] = len(self.row_keys)
+      self.row_keys += [key]
+      return
+    vector = np.asarray(embedding, dtype=self.dtype)
+    if self.dim is None:
+      self.dim = vector.shape[0]
+    if vector.shape != (self.dim,):
+      raise ValueError(f"Embedding of size {vector.shape} in a table of "
+                       f"dimension {self.dim}")
+
+    n_added = len(self.row_keys) - self.n_mapped
+    if self.added is None:
+      self.added = np.zeros((64, self.dim), dtype=self.dtype)
+    elif n_added == self.added.shape[0]:
+      self.added = _grow(self.added, 2 * n_added)
+    self.added[n_added] = vector
+    self.key_to_row[key] = len(self.row_keys)
+    self.row_keys += [key]
+
+
+  def row(self, row):
+    """
+    Returns the vector of a row, as a float32 array.
+    """
+    if row < self.n_mapped:
+      return np.asarray(self.mapped[row], dtype=np.float32)
+    return np.asarray(self.added[row - self.n_mapped], dtype=np.float32)
+
+
+  def rows(self, start, end):
+    """
+    Returns the rows from <start> to <end> as a matrix of the table's dtype.
+    """
+    parts = []
+    if start < self.n_mapped:
+      parts += [self.mapped[start:min(end, self.n_mapped)]]
+    if end > self.n_mapped:
+      parts += [self.added[max(start, self.n_mapped) - self.n_mapped:
+                           end - self.n_mapped]]
+    if not parts:
+      return np.zeros((0, self.dim or 0), dtype=self.dtype)
+    return np.concatenate(parts).astype(self.dtype, copy=False)
+
+
+  def save(self, out_json, stage=None):
+    """
+    Saves the table to <out_json>: the rows added since the last save are
+    appended if it holds the table already, otherwise it is written whole.
+
+    INPUT
+      out_json: the folder of the saved associative memory.
+      stage: the folder where a whole table is written instead, to be moved
+             into <out_json> (see AssociativeMemory.save); <out_json> by 
+             default.
+    OUTPUT
+      None
+    """
+    n_rows = len(self.row_keys)
+    if self.saved_folder != os.path.abspath(out_json):
+      self.write(out_json, stage or out_json)
+      return
+    if n_rows == self.n_saved:
+      return
+
+    keys = "".join(json.dumps(key) + "\n" 
+                   for key in self.row_keys[self.n_saved:]).encode()
+    with open(f"{out_json}/{KEYS_FILE}", "r+b") as outfile:
+      outfile.truncate(self.keys_size)
+      outfile.seek(self.keys_size)
+      outfile.write(keys)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+    self.keys_size += len(keys)
+    if self.keys_only:
+      self.n_saved = n_rows
+      return
+
+    row_size = self.dim * self.dtype.itemsize
+    with open(f"{out_json}/{MATRIX_FILE}", "r+b") as outfile:
+      outfile.truncate(HEADER_SIZE + self.n_saved * row_size)
+      outfile.seek(HEADER_SIZE + self.n_saved * row_size)
+      outfile.write(self.rows(self.n_saved, n_rows).tobytes())
+      outfile.flush()
+      os.fsync(outfile.fileno())
+      _write_header(outfile, self.dtype, n_rows, self.dim)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+
+    self.n_saved = n_rows
+
+
+  def write(self, out_json, stage):
+    """
+    Writes the whole table of <out_json> to <stage> (which may be the same
+    folder), replacing the files atomically (the keys first: keys past the
+    row count are ignored).
+    """
+    keys = "".join(json.dumps(key) + "\n" for key in self.row_keys).encode()
+    with open(f"{stage}/{KEYS_FILE}.tmp", "wb") as outfile:
+      outfile.write(keys)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+    os.replace(f"{stage}/{KEYS_FILE}.tmp", f"{stage}/{KEYS_FILE}")
+
+    n_rows = len(self.row_keys)
+    if self.keys_only:
+      self.saved_folder = os.path.abspath(out_json)
+      self.n_saved = n_rows
+      self.keys_size = len(keys)
+      return
+    with open(f"{stage}/{MATRIX_FILE}.tmp", "wb") as outfile:
+      _write_header(outfile, self.dtype, n_rows, self.dim or 0)
+      outfile.write(self.rows(0, n_rows).tobytes())
+      outfile.flush()
+      os.fsync(outfile.fileno())
+    os.replace(f"{stage}/{MATRIX_FILE}.tmp", f"{stage}/{MATRIX_FILE}")
+
+    self.saved_folder = os.path.abspath(out_json)
+    self.n_saved = n_rows
+    self.keys_size = len(keys)
@@ -7,10 +7,87 @@ Description: Defines the short-term memory module for generative agents.
 import datetime
 import json
 import sys
+import bisect
+import itertools
 sys.path.append('../../')
 
 from global_methods import *
 
+
+class Schedule(list): 
+  """
+  A schedule: a list of [task, duration] rows that keeps the cumulative 
+  durations, to find the row at a given minute of the day by bisection. The 
+  cumulative durations are dropped by every change to the list, and 
+  recomputed on the next lookup. The rows themselves are replaced (e.g., 
+  spliced in by the task decomposition), not changed in place. 
+  """
+  _ends = None
+
+  def index_at(self, minute): 
+    """
+    Returns the index of the row ongoing at <minute> (the first one ending 
+    after it), or len(self) if the schedule ends before. 
+    """
+    if self._ends is None: 
+      # The running maximum keeps the array sorted should a duration be 
+      # negative (e.g., the "sleeping" filler of an overfull day). 
+      ends = itertools.accumulate(duration for task, duration in self)
+      self._ends = list(itertools.accumulate(ends, max))
+    return bisect.bisect_right(self._ends, minute)
+
+  def _changed(self): 
+    self._ends = None
+
+  def __setitem__(self, index, value): 
+    self._changed()
+    super().__setitem__(index, value)
+
+  def __delitem__(self, index): 
+    self._changed()
+    super().__delitem__(index)
+
+  def __iadd__(self, other): 
+    self._changed()
+    return super().__iadd__(other)
+
+  def __imul__(self, n): 
+    self._changed()
+    return super().__imul__(n)
+
+  def append(self, row): 
+    self._changed()
+    super().append(row)
+
+  def extend(self, rows): 
+    self._changed()
+    super().extend(rows)
+
+  def insert(self, index, row): 
+    self._changed()
+    super().insert(index, row)
+
+  def pop(self, *args): 
+    self._changed()
+    return super().pop(*args)
+
+  def remove(self, row): 
+    self._changed()
+    super().remove(row)
+
+  def clear(self): 
+    self._changed()
+    super().clear()
+
+  def sort(self, *args, **kwargs): 
+    self._changed()
+    super().sort(*args, **kwargs)
+
+  def reverse(self): 
+    self._changed()
+    super().reverse()
+
+
 class Scratch: 
   def __init__(self, f_saved): 
     # PERSONA HYPERPARAMETERS
@@ -306,8 +383,30 @@ class Scratch:
     scratch["act_path_set"] = self.act_path_set
     scratch["planned_path"] = self.planned_path
 
-    with open(out_json, "w") as outfile:
-      json.dump(scratch, outfile, indent=2) 
+    write_json_atomic(scratch, out_json, indent=2) 
+
+
+  @property
+  def f_daily_schedule(self): 
+    return self._f_daily_schedule
+
+  @f_daily_schedule.setter
+  def f_daily_schedule(self, schedule): 
+    # The schedules are kept as <Schedule> lists, whatever is assigned. 
+    if not isinstance(schedule, Schedule): 
+      schedule = Schedule(schedule)
+    self._f_daily_schedule = schedule
+
+
+  @property
+  def f_daily_schedule_hourly_org(self): 
+    return self._f_daily_schedule_hourly_org
+
+  @f_daily_schedule_hourly_org.setter
+  def f_daily_schedule_hourly_org(self, schedule): 
+    if not isinstance(schedule, Schedule): 
+      schedule = Schedule(schedule)
+    self._f_daily_schedule_hourly_org = schedule
 
 
   def get_f_daily_schedule_index(self, advance=0):
@@ -333,23 +432,9 @@ class Scratch:
     today_min_elapsed += self.curr_time.minute
     today_min_elapsed += advance
 
-    x = 0
-    for task, duration in self.f_daily_schedule: 
-      x += duration
-    x = 0
-    for task, duration in self.f_daily_schedule_hourly_org: 
-      x += duration
-
-    # We then calculate the current index based on that. 
-    curr_index = 0
-    elapsed = 0
-    for task, duration in self.f_daily_schedule: 
-      elapsed += duration
-      if elapsed > today_min_elapsed: 
-        return curr_index
-      curr_index += 1
-
-    return curr_index
+    # We then calculate the current index based on that, bisecting the 
+    # cumulative durations kept by the <Schedule>. 
+    return self.f_daily_schedule.index_at(today_min_elapsed)
 
 
   def get_f_daily_schedule_hourly_org_index(self, advance=0):
@@ -369,14 +454,7 @@ class Scratch:
     today_min_elapsed += self.curr_time.minute
     today_min_elapsed += advance
     # We then calculate the current index based on that. 
-    curr_index = 0
-    elapsed = 0
-    for task, duration in self.f_daily_schedule_hourly_org: 
-      elapsed += duration
-      if elapsed > today_min_elapsed: 
-        return curr_index
-      curr_index += 1
-    return curr_index
+    return self.f_daily_schedule_hourly_org.index_at(today_min_elapsed)
 
 
   def get_str_iss(self): 
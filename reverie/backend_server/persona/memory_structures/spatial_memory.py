@@ -36,8 +36,7 @@ class MemoryTree:
     
 
   def save(self, out_json):
-    with open(out_json, "w") as outfile:
-      json.dump(self.tree, outfile) 
+    write_json_atomic(self.tree, out_json)
 
 
 
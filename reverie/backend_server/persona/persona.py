@@ -28,7 +28,7 @@ from persona.cognitive_modules.execute import *
 from persona.cognitive_modules.converse import *
 
 class Persona: 
-  def __init__(self, name, folder_mem_saved=False):
+  def __init__(self, name, folder_mem_saved=False, retrieval_index=None):
     # PERSONA BASE STATE 
     # <name> is the full name of the persona. This is a unique identifier for
     # the persona within Reverie. 
@@ -40,41 +40,57 @@ class Persona:
     # <s_mem> is the persona's spatial memory. 
     f_s_mem_saved = f"{folder_mem_saved}/bootstrap_memory/spatial_memory.json"
     self.s_mem = MemoryTree(f_s_mem_saved)
-    # <s_mem> is the persona's associative memory. 
+    # <s_mem> is the persona's associative memory. <retrieval_index> 
+    # optionally configures its approximate nearest-neighbor index. 
     f_a_mem_saved = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
-    self.a_mem = AssociativeMemory(f_a_mem_saved)
+    self.a_mem = AssociativeMemory(f_a_mem_saved, retrieval_index)
     # <scratch> is the persona's scratch (short term memory) space. 
     scratch_saved = f"{folder_mem_saved}/bootstrap_memory/scratch.json"
     self.scratch = Scratch(scratch_saved)
 
+    # <rng> is the persona's own random generator, used by its cognition 
+    # (e.g., choosing the event to focus on, a random tile). ReverieServer 
+    # reseeds it every step from the run's seed, the step and the persona's
+    # name, so the draws do not depend on how personas are scheduled. 
+    self.rng = random.Random()
 
-  def save(self, save_folder): 
+
+  def save(self, save_folder, stage_folder=None): 
     """
     Save persona's current state (i.e., memory). 
 
     INPUT: 
       save_folder: The folder where we wil be saving our persona's state. 
+      stage_folder: The folder where the files replacing the ones of 
+                    <save_folder> are written, when it is saved as part of a
+                    checkpoint (see CheckpointWriter). <save_folder> by 
+                    default. 
     OUTPUT: 
       None
     """
+    if stage_folder is None: 
+      stage_folder = save_folder
+
     # Spatial memory contains a tree in a json format. 
     # e.g., {"double studio": 
     #         {"double studio": 
     #           {"bedroom 2": 
     #             ["painting", "easel", "closet", "bed"]}}}
-    f_s_mem = f"{save_folder}/spatial_memory.json"
+    f_s_mem = f"{stage_folder}/spatial_memory.json"
     self.s_mem.save(f_s_mem)
     
     # Associative memory contains a csv with the following rows: 
     # [event.type, event.created, event.expiration, s, p, o]
     # e.g., event,2022-10-23 00:00:00,,Isabella Rodriguez,is,idle
     f_a_mem = f"{save_folder}/associative_memory"
-    self.a_mem.save(f_a_mem)
+    f_a_mem_stage = f"{stage_folder}/associative_memory"
+    os.makedirs(f_a_mem_stage, exist_ok=True)
+    self.a_mem.save(f_a_mem, f_a_mem_stage)
 
     # Scratch contains non-permanent data associated with the persona. When 
     # it is saved, it takes a json form. When we load it, we move the values
     # to Python variables. 
-    f_scratch = f"{save_folder}/scratch.json"
+    f_scratch = f"{stage_folder}/scratch.json"
     self.scratch.save(f_scratch)
 
 
@@ -201,6 +217,25 @@ class Persona:
         writing her next novel (editing her novel) 
         @ double studio:double studio:common room:sofa
     """
+    new_day, retrieved = self.move_perceive(maze, curr_tile, curr_time)
+    return self.move_act(maze, personas, new_day, retrieved)
+
+
+  def move_perceive(self, maze, curr_tile, curr_time): 
+    """
+    First half of move(): syncs the persona's clock and tile, then perceives
+    and retrieves. This half only touches the persona's own memory and reads 
+    the maze, so it is safe to run for several personas at once. 
+
+    INPUT: 
+      maze: The Maze class of the current world. 
+      curr_tile: A tuple that designates the persona's current tile location 
+                 in (row, col) form. e.g., (58, 39)
+      curr_time: datetime instance that indicates the game's current time. 
+    OUTPUT: 
+      new_day: False, "First day" or "New day" (see plan()). 
+      retrieved: dictionary of dictionary (see retrieve()). 
+    """
     # Updating persona's scratch memory with <curr_tile>. 
     self.scratch.curr_tile = curr_tile
 
@@ -219,6 +254,23 @@ class Persona:
     # Main cognitive sequence begins here. 
     perceived = self.perceive(maze)
     retrieved = self.retrieve(perceived)
+    return new_day, retrieved
+
+
+  def move_act(self, maze, personas, new_day, retrieved): 
+    """
+    Second half of move(): plans, reflects and executes. Planning may react
+    to (and write into) another persona when the two start a conversation. 
+
+    INPUT: 
+      maze: The Maze class of the current world. 
+      personas: A dictionary that contains all persona names as keys, and the 
+                Persona instance as values. 
+      new_day: The value returned by move_perceive(). 
+      retrieved: The value returned by move_perceive(). 
+    OUTPUT: 
+      execution: See move(). 
+    """
     plan = self.plan(maze, personas, new_day, retrieved)
     self.reflect()
 
@@ -231,6 +283,27 @@ class Persona:
     return self.execute(maze, personas, plan)
 
 
+  def reacts_to(self, retrieved, personas): 
+    """
+    Returns the names of the other personas that appear as the subject of a
+    retrieved event. Only these personas can be read or written by plan()
+    through a chat or wait reaction. 
+
+    INPUT: 
+      retrieved: The value returned by move_perceive(). 
+      personas: A dictionary that contains all persona names as keys, and the 
+                Persona instance as values. 
+    OUTPUT: 
+      a set of persona names. 
+    """
+    ret = set()
+    for desc, ctx in retrieved.items(): 
+      subject = ctx["curr_event"].subject
+      if subject in personas and subject != self.name: 
+        ret.add(subject)
+    return ret
+
+
   def open_convo_session(self, convo_mode, safe_mode=True, direct=False, question=None): 
     if direct:
       return open_convo_session(self, convo_mode, safe_mode, direct, question)
@@ -0,0 +1,77 @@
+"""
+File: embedding_batcher.py
+Description: Micro-batching queue for embedding requests. Texts submitted by
+concurrent callers (e.g. the personas perceiving in parallel within a step)
+are collected for a short window and sent as one multi-input request, in
+size-capped chunks, with each result handed back to its waiting caller.
+"""
+import threading
+from concurrent.futures import Future
+
+
+class EmbeddingBatcher:
+    def __init__(self, embed_many, max_batch: int = 64,
+                 max_wait: float = 0.02):
+        """Initializes the batcher. The worker thread starts on first use.
+
+        Args:
+            embed_many: function (texts, model) -> list of embeddings, in the
+                order of <texts>.
+            max_batch (int, optional): maximum number of texts per request.
+            max_wait (float, optional): seconds a request waits for others
+                to join its batch.
+        """
+        self.embed_many = embed_many
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = []
+        self.cond = threading.Condition()
+        self.worker = None
+
+    def embed(self, text: str, model: str):
+        """Queues <text> and blocks until its embedding is available.
+
+        Raises:
+            Exception: whatever the batched request raised.
+        """
+        future = Future()
+        with self.cond:
+            self.pending.append((model, text, future))
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+            self.cond.notify()
+        return future.result()
+
+    def _take_batch(self):
+        """Waits for a request, gives others <max_wait> seconds to join it,
+        then removes and returns up to <max_batch> requests."""
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            self.cond.wait_for(lambda: len(self.pending) >= self.max_batch,
+                               timeout=self.max_wait)
+            batch = self.pending[:self.max_batch]
+            del self.pending[:self.max_batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            # One request per model; identical texts are only sent once.
+            by_model = dict()
+            for model, text, future in batch:
+                by_model.setdefault(model, dict()).setdefault(
+                    text, []).append(future)
+            for model, text_futures in by_model.items():
+                texts = list(text_futures.keys())
+                try:
+                    embeddings = self.embed_many(texts, model)
+                except Exception as e:
+                    for futures in text_futures.values():
+                        for future in futures:
+                            future.set_exception(e)
+                    continue
+                for text, embedding in zip(texts, embeddings):
+                    for future in text_futures[text]:
+                        future.set_result(embedding)
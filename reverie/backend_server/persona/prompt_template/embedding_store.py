@@ -0,0 +1,94 @@
+"""
+File: embedding_store.py
+Description: Global embedding store shared by all personas and simulations.
+Vectors are keyed by (model, normalized text) and kept in an append-only
+binary file of float32 records, so a text is embedded (and stored) only once.
+"""
+import os
+import sys
+import struct
+import threading
+from array import array
+
+# Record layout: <key length><dimension> header, the utf-8 key, then the
+# vector as <dimension> little-endian float32 values.
+_HEADER = struct.Struct("<II")
+
+
+class EmbeddingStore:
+    def __init__(self, path: str):
+        """Loads (or creates) the store file.
+
+        Args:
+            path (str): the binary store file.
+        """
+        if array("f").itemsize != 4 or sys.byteorder != "little":
+            raise RuntimeError("EmbeddingStore needs little-endian float32")
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.vectors = dict()
+        if os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Returns the text the same way get_embedding sends it, with
+        whitespace runs collapsed."""
+        return " ".join(text.split()) or "this is blank"
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """Returns the store key of <text> embedded with <model>."""
+        return f"{model}\n{EmbeddingStore.normalize(text)}"
+
+    def _load(self):
+        """Reads every record of the file. A truncated last record (e.g. an
+        interrupted write) is ignored."""
+        with open(self.path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            key_len, dim = _HEADER.unpack_from(data, offset)
+            end = offset + _HEADER.size + key_len + 4 * dim
+            if end > len(data):
+                break
+            key_start = offset + _HEADER.size
+            key = data[key_start:key_start + key_len].decode("utf-8")
+            vector = array("f")
+            vector.frombytes(data[key_start + key_len:end])
+            self.vectors[key] = vector
+            offset = end
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def contains(self, model: str, text: str) -> bool:
+        return self.make_key(model, text) in self.vectors
+
+    def get(self, model: str, text: str):
+        """Returns the stored vector as a list of floats, or None."""
+        vector = self.vectors.get(self.make_key(model, text))
+        if vector is None:
+            return None
+        return vector.tolist()
+
+    def put(self, model: str, text: str, embedding):
+        """Stores a vector unless the key is already present."""
+        key = self.make_key(model, text)
+        if key in self.vectors:
+            return
+        vector = array("f", embedding)
+        key_bytes = key.encode("utf-8")
+        record = (_HEADER.pack(len(key_bytes), len(vector)) + key_bytes
+                  + vector.tobytes())
+        with self.lock:
+            if key in self.vectors:
+                return
+            self.vectors[key] = vector
+            # One write per record in append mode, so concurrent simulations
+            # sharing the file do not interleave records.
+            with open(self.path, "ab") as f:
+                f.write(record)
@@ -8,10 +8,19 @@ Description: Wrapper functions for calling OpenAI APIs.
 """
 import time 
 import json
+import asyncio
+import weakref
 from pathlib import Path
-from openai import AzureOpenAI, OpenAI
+import httpx
+from openai import AzureOpenAI, OpenAI, AsyncAzureOpenAI, AsyncOpenAI
+from openai import DefaultAsyncHttpxClient
 
 from persona.prompt_template.sparkai_embedding import get_sparkai_embedding
+from persona.prompt_template.rate_limiter import get_rate_limiter
+from persona.prompt_template.llm_cache import LLMResponseCache
+from persona.prompt_template.llm_record import recorded
+from persona.prompt_template.embedding_store import EmbeddingStore
+from persona.prompt_template.embedding_batcher import EmbeddingBatcher
 from utils import *
 from openai_cost_logger import DEFAULT_LOG_PATH
 from persona.prompt_template.openai_logger_singleton import OpenAICostLogger_Singleton
@@ -69,20 +78,84 @@ def setup_client(type: str, config: dict):
     raise ValueError("Invalid client")
   return client
 
+def setup_async_client(type: str, config: dict, max_connections: int):
+  """Setup the asyncio OpenAI client. Mirrors setup_client.
+
+  Args:
+      type (str): the type of client. Same values as setup_client.
+      config (dict): the configuration for the client.
+      max_connections (int): size of the pooled HTTP connections.
+
+  Raises:
+      ValueError: if the client is invalid.
+
+  Returns:
+      The client object created, either AsyncAzureOpenAI or AsyncOpenAI.
+  """
+  http_client = DefaultAsyncHttpxClient(
+    limits=httpx.Limits(max_connections=max_connections,
+                        max_keepalive_connections=max_connections))
+  if type == "azure":
+    client = AsyncAzureOpenAI(
+        azure_endpoint=config["endpoint"],
+        api_key=config["key"],
+        api_version=config["api-version"],
+        http_client=http_client,
+    )
+  elif type == "openai":
+    client = AsyncOpenAI(
+        api_key=config["key"],
+        http_client=http_client,
+    )
+  elif type in ["openai-transfer", "sparkai"]:
+    client = AsyncOpenAI(
+        api_key = config["key"],
+        base_url = config["url"],
+        http_client=http_client,
+    )
+  else:
+    raise ValueError("Invalid client")
+  return client
+
 if openai_config["client"] == "azure":
-  client = setup_client("azure", {
+  client_config = {
       "endpoint": openai_config["model-endpoint"],
       "key": openai_config["model-key"],
       "api-version": openai_config["model-api-version"],
-  })
+  }
 elif openai_config["client"] == "openai":
-  client = setup_client("openai", { "key": openai_config["model-key"] })
+  client_config = { "key": openai_config["model-key"] }
 elif openai_config["client"] == "openai-transfer":
-  client = setup_client("openai-transfer", {"key": openai_config["model-key"],
-                                            "url":openai_config["url"]})
+  client_config = {"key": openai_config["model-key"],
+                   "url":openai_config["url"]}
 elif openai_config["client"] == "sparkai":
-  client = setup_client("sparkai", {"key": openai_config["sparkai-apipassword"],
-                                    "url":openai_config["sparkai-openai-url"]})
+  client_config = {"key": openai_config["sparkai-apipassword"],
+                   "url":openai_config["sparkai-openai-url"]}
+else:
+  raise ValueError("Invalid client")
+client = setup_client(openai_config["client"], client_config)
+
+# <max-in-flight> caps the concurrent async requests (and sizes their 
+# connection pool). <requests-per-second> and <requests-burst> configure a
+# token bucket keyed by the selected client; it is shared by the sync and 
+# async paths. Without <requests-per-second>, the sync path keeps its fixed
+# temp_sleep and the async path is not rate limited.
+max_in_flight = openai_config.get("max-in-flight", 16)
+rate_limiter = get_rate_limiter(llm_configs["client"], 
+                                openai_config.get("requests-per-second"),
+                                openai_config.get("requests-burst"))
+
+# Async clients and semaphores are bound to the event loop they are used in.
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+  """Returns the (client, semaphore) pair for the running event loop."""
+  loop = asyncio.get_running_loop()
+  if loop not in _async_clients: 
+    _async_clients[loop] = (setup_async_client(openai_config["client"], 
+                                               client_config, max_in_flight),
+                            asyncio.Semaphore(max_in_flight))
+  return _async_clients[loop]
 
 if openai_config["embeddings-client"] == "azure":  
   embeddings_client = setup_client("azure", {
@@ -107,13 +180,94 @@ cost_logger = OpenAICostLogger_Singleton(
   cost_upperbound = openai_config["cost-upperbound"]
 )
 
+# <llm-cache> enables the persistent response cache, e.g. 
+# "llm-cache": {"path": "llm-cache/responses.sqlite3", "ttl": 604800,
+#               "max-entries": 200000, "cache-sampled": false}
+# Entries are namespaced by experiment, and requests sampled with 
+# temperature > 0 bypass the cache unless <cache-sampled> is set. 
+llm_cache = None
+if openai_config.get("llm-cache"): 
+  cache_config = openai_config["llm-cache"]
+  llm_cache = LLMResponseCache(
+    path=cache_config.get("path", "llm-cache/responses.sqlite3"),
+    namespace=cache_config.get("namespace", openai_config["experiment-name"]),
+    ttl=cache_config.get("ttl"),
+    max_entries=cache_config.get("max-entries"),
+    cache_sampled=cache_config.get("cache-sampled", False))
+
+# <embedding-store> enables the global embedding store shared by every 
+# persona and simulation, e.g. 
+# "embedding-store": {"path": "llm-cache/embeddings.bin"}
+# get_embedding consults it before the network. Personas' embeddings.json 
+# saved with it only reference the vectors it holds. 
+embedding_store = None
+if openai_config.get("embedding-store"): 
+  embedding_store = EmbeddingStore(
+    path=openai_config["embedding-store"].get("path", 
+                                              "llm-cache/embeddings.bin"))
+
+# <embedding-dtype> is the precision of the vectors in the personas' binary 
+# embedding tables: "float32" (default) or "float16", which halves them. 
+embedding_dtype = openai_config.get("embedding-dtype", "float32")
+
+# <embedding-batch> enables micro-batching of the embedding requests issued 
+# concurrently (e.g. with cognition workers), e.g. 
+# "embedding-batch": {"max-size": 64, "max-wait": 0.02}
+# Requests arriving within <max-wait> seconds are sent together, in chunks of
+# at most <max-size> texts. 
+embedding_batcher = None
+if openai_config.get("embedding-batch"): 
+  batch_config = openai_config["embedding-batch"]
+  embedding_batcher = EmbeddingBatcher(
+    lambda texts, model: _get_embeddings(texts, model),
+    max_batch=batch_config.get("max-size", 64),
+    max_wait=batch_config.get("max-wait", 0.02))
+
+
+def get_cache_key(model, prompt, params, temperature): 
+  """
+  Returns the cache key of a request, or None when the request must not be
+  served from (or stored in) the cache. 
+  """
+  if not llm_cache or not llm_cache.cacheable(temperature): 
+    return None
+  return llm_cache.make_key(model, prompt, params)
+
+
+def lookup_cache(key): 
+  """
+  Returns the cached response for <key> (None on a miss) and feeds the 
+  hit/miss counters of the cost logger. 
+  """
+  response = llm_cache.get(key)
+  cost_logger.update_cache_stats(hit=response is not None)
+  return response
+
+
+def discard_response(key): 
+  """
+  Drops a cached response that failed validation, so that it is neither 
+  served again nor kept. The request functions cache a response as soon as
+  it is received; the safe_generate_* functions discard it when it is 
+  rejected. 
+  """
+  if key: 
+    llm_cache.delete(key)
+
 
 def temp_sleep(seconds=0.1):
   time.sleep(seconds)
 
 
+def throttle(): 
+  if rate_limiter: 
+    rate_limiter.acquire()
+  else: 
+    temp_sleep()
+
+
 def ChatGPT_single_request(prompt): 
-  temp_sleep()
+  throttle()
   completion = client.chat.completions.create(
     model=openai_config["model"],
     messages=[{"role": "user", "content": prompt}]
@@ -122,7 +276,9 @@ def ChatGPT_single_request(prompt):
   return completion.choices[0].message.content
 
 
-def ChatGPT_request(prompt): 
+@recorded("chat", lambda prompt, use_cache=True: 
+          {"model": openai_config["model"], "prompt": prompt})
+def ChatGPT_request(prompt, use_cache=True): 
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
@@ -131,9 +287,18 @@ def ChatGPT_request(prompt):
     gpt_parameter: a python dictionary with the keys indicating the names of  
                    the parameter and the values indicating the parameter 
                    values.   
+    use_cache: look the prompt up in the response cache first. Retries pass
+               False (and discard_response drops the rejected response). 
   RETURNS: 
     a str of GPT-3's response. 
   """
+  # The chat request uses the provider's default (sampled) temperature.
+  key = get_cache_key(openai_config["model"], prompt, {"chat": True}, None)
+  if key and use_cache: 
+    cached = lookup_cache(key)
+    if cached is not None: 
+      return cached
+
   # temp_sleep()
   try: 
     completion = client.chat.completions.create(
@@ -141,7 +306,10 @@ def ChatGPT_request(prompt):
     messages=[{"role": "user", "content": prompt}]
     )
     # cost_logger.update_cost(completion, input_cost=openai_config["model-costs"]["input"], output_cost=openai_config["model-costs"]["output"])
-    return completion.choices[0].message.content
+    ret = completion.choices[0].message.content
+    if key and ret is not None: 
+      llm_cache.put(key, ret)
+    return ret
   
   except Exception as e: 
     print(f"Error: {e}")
@@ -166,10 +334,11 @@ def ChatGPT_safe_generate_response(prompt,
     print ("CHAT GPT PROMPT")
     print (prompt)
 
+  key = get_cache_key(openai_config["model"], prompt, {"chat": True}, None)
   for i in range(repeat): 
 
     try: 
-      curr_gpt_response = ChatGPT_request(prompt).strip()
+      curr_gpt_response = ChatGPT_request(prompt, use_cache=(i == 0)).strip()
       end_index = curr_gpt_response.rfind('}') + 1
       curr_gpt_response = curr_gpt_response[:end_index]
       curr_gpt_response = json.loads(curr_gpt_response)["output"]
@@ -184,6 +353,7 @@ def ChatGPT_safe_generate_response(prompt,
 
     except: 
       pass
+    discard_response(key)
 
   return False
 
@@ -198,9 +368,10 @@ def ChatGPT_safe_generate_response_OLD(prompt,
     print ("CHAT GPT PROMPT")
     print (prompt)
 
+  key = get_cache_key(openai_config["model"], prompt, {"chat": True}, None)
   for i in range(repeat): 
     try: 
-      curr_gpt_response = ChatGPT_request(prompt).strip()
+      curr_gpt_response = ChatGPT_request(prompt, use_cache=(i == 0)).strip()
       if func_validate(curr_gpt_response, prompt=prompt): 
         return func_clean_up(curr_gpt_response, prompt=prompt)
       if verbose: 
@@ -210,11 +381,15 @@ def ChatGPT_safe_generate_response_OLD(prompt,
 
     except: 
       pass
+    discard_response(key)
   print ("FAIL SAFE TRIGGERED") 
   return fail_safe_response
 
 
-def GPT_request(prompt, gpt_parameter): 
+@recorded("gpt", lambda prompt, gpt_parameter, use_cache=True: 
+          {"model": gpt_parameter["engine"], "prompt": prompt, 
+           "params": gpt_parameter})
+def GPT_request(prompt, gpt_parameter, use_cache=True): 
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
@@ -223,10 +398,19 @@ def GPT_request(prompt, gpt_parameter):
     gpt_parameter: a python dictionary with the keys indicating the names of  
                    the parameter and the values indicating the parameter 
                    values.   
+    use_cache: look the prompt up in the response cache first. Retries pass
+               False (and discard_response drops the rejected response). 
   RETURNS: 
     a str of GPT-3's response. 
   """
-  temp_sleep()
+  key = get_cache_key(gpt_parameter["engine"], prompt, gpt_parameter, 
+                      gpt_parameter["temperature"])
+  if key and use_cache: 
+    cached = lookup_cache(key)
+    if cached is not None: 
+      return cached
+
+  throttle()
   try: 
     messages = [{
       "role": "system", "content": prompt
@@ -242,12 +426,97 @@ def GPT_request(prompt, gpt_parameter):
                 stream=gpt_parameter["stream"],
                 stop=gpt_parameter["stop"],)
     # cost_logger.update_cost(response=response, input_cost=openai_config["model-costs"]["input"], output_cost=openai_config["model-costs"]["output"])
-    return response.choices[0].message.content
+    ret = response.choices[0].message.content
+    if key and ret is not None: 
+      llm_cache.put(key, ret)
+    return ret
   except Exception as e:
     print(f"Error: {e}")
     return "TOKEN LIMIT EXCEEDED"
 
 
+async def ChatGPT_request_async(prompt, use_cache=True): 
+  """
+  Asyncio version of ChatGPT_request. Bounded by <max-in-flight> and the 
+  client's rate limiter instead of a fixed sleep. 
+  ARGS:
+    prompt: a str prompt
+    use_cache: look the prompt up in the response cache first. 
+  RETURNS: 
+    a str of GPT-3's response. 
+  """
+  key = get_cache_key(openai_config["model"], prompt, {"chat": True}, None)
+  if key and use_cache: 
+    cached = lookup_cache(key)
+    if cached is not None: 
+      return cached
+
+  async_client, in_flight = get_async_client()
+  async with in_flight: 
+    if rate_limiter: 
+      await rate_limiter.acquire_async()
+    try: 
+      completion = await async_client.chat.completions.create(
+        model=openai_config["model"],
+        messages=[{"role": "user", "content": prompt}]
+      )
+      ret = completion.choices[0].message.content
+      if key and ret is not None: 
+        llm_cache.put(key, ret)
+      return ret
+
+    except Exception as e: 
+      print(f"Error: {e}")
+      return "ChatGPT ERROR"
+
+
+async def GPT_request_async(prompt, gpt_parameter, use_cache=True): 
+  """
+  Asyncio version of GPT_request. Bounded by <max-in-flight> and the 
+  client's rate limiter instead of a fixed sleep. 
+  ARGS:
+    prompt: a str prompt
+    gpt_parameter: a python dictionary with the keys indicating the names of  
+                   the parameter and the values indicating the parameter 
+                   values.   
+    use_cache: look the prompt up in the response cache first. 
+  RETURNS: 
+    a str of GPT-3's response. 
+  """
+  key = get_cache_key(gpt_parameter["engine"], prompt, gpt_parameter, 
+                      gpt_parameter["temperature"])
+  if key and use_cache: 
+    cached = lookup_cache(key)
+    if cached is not None: 
+      return cached
+
+  async_client, in_flight = get_async_client()
+  async with in_flight: 
+    if rate_limiter: 
+      await rate_limiter.acquire_async()
+    try: 
+      messages = [{
+        "role": "system", "content": prompt
+      }]
+      response = await async_client.chat.completions.create(
+                  model=gpt_parameter["engine"],
+                  messages=messages,
+                  temperature=gpt_parameter["temperature"],
+                  max_tokens=gpt_parameter["max_tokens"],
+                  top_p=gpt_parameter["top_p"],
+                  frequency_penalty=gpt_parameter["frequency_penalty"],
+                  presence_penalty=gpt_parameter["presence_penalty"],
+                  stream=gpt_parameter["stream"],
+                  stop=gpt_parameter["stop"],)
+      ret = response.choices[0].message.content
+      if key and ret is not None: 
+        llm_cache.put(key, ret)
+      return ret
+    except Exception as e:
+      print(f"Error: {e}")
+      return "TOKEN LIMIT EXCEEDED"
+
+
 def generate_prompt(curr_input, prompt_lib_file): 
   """
   Takes in the current input (e.g. comment that you want to classifiy) and 
@@ -286,8 +555,47 @@ def safe_generate_response(prompt,
   if verbose: 
     print (prompt)
 
+  # A response is only kept in the cache once it passes validation. 
+  key = get_cache_key(gpt_parameter["engine"], prompt, gpt_parameter, 
+                      gpt_parameter["temperature"])
+  for i in range(repeat): 
+    curr_gpt_response = GPT_request(prompt, gpt_parameter, 
+                                    use_cache=(i == 0))
+    try:
+      if func_validate(curr_gpt_response, prompt=prompt): 
+        return func_clean_up(curr_gpt_response, prompt=prompt)
+      if verbose: 
+        print ("---- repeat count: ", i, curr_gpt_response)
+        print (curr_gpt_response)
+        print ("~~~~")
+    except:
+      pass
+    discard_response(key)
+  return fail_safe_response
+
+
+async def safe_generate_response_async(prompt, 
+                                       gpt_parameter,
+                                       repeat=5,
+                                       fail_safe_response="error",
+                                       func_validate=None,
+                                       func_clean_up=None,
+                                       verbose=False): 
+  """
+  Asyncio version of safe_generate_response. Independent prompts can be 
+  awaited together, e.g. 
+    await asyncio.gather(safe_generate_response_async(p1, ...), 
+                         safe_generate_response_async(p2, ...))
+  """
+  if verbose: 
+    print (prompt)
+
+  # A response is only kept in the cache once it passes validation. 
+  key = get_cache_key(gpt_parameter["engine"], prompt, gpt_parameter, 
+                      gpt_parameter["temperature"])
   for i in range(repeat): 
-    curr_gpt_response = GPT_request(prompt, gpt_parameter)
+    curr_gpt_response = await GPT_request_async(prompt, gpt_parameter, 
+                                                use_cache=(i == 0))
     try:
       if func_validate(curr_gpt_response, prompt=prompt): 
         return func_clean_up(curr_gpt_response, prompt=prompt)
@@ -297,14 +605,64 @@ def safe_generate_response(prompt,
         print ("~~~~")
     except:
       pass
+    discard_response(key)
   return fail_safe_response
 
 
+@recorded("embedding", lambda text, model=openai_config["embeddings"]: 
+          {"model": model, "prompt": text})
 def get_embedding(text, model=openai_config["embeddings"]):
   # print("嵌入向量化输入：",text)
   text = text.replace("\n", " ")
   if not text: 
     text = "this is blank"
+  if embedding_store is not None: 
+    embedding = embedding_store.get(model, text)
+    if embedding is not None: 
+      return embedding
+    embedding = _get_embedding(text, model)
+    if embedding: 
+      embedding_store.put(model, text, embedding)
+    return embedding
+  return _get_embedding(text, model)
+
+
+def get_stored_embedding(text, model=openai_config["embeddings"]): 
+  """
+  Returns the embedding of <text> from the global embedding store, or None
+  if it is disabled or does not hold the text. 
+  """
+  if embedding_store is None: 
+    return None
+  return embedding_store.get(model, text)
+
+
+def store_embedding(text, embedding, model=openai_config["embeddings"]): 
+  """
+  Adds an already computed embedding to the global embedding store. Returns
+  True if the store is enabled (the text can then be referenced by key). 
+  """
+  if embedding_store is None: 
+    return False
+  embedding_store.put(model, text, embedding)
+  return True
+
+
+def _get_embedding(text, model): 
+  if embedding_batcher: 
+    return embedding_batcher.embed(text, model)
+  return _get_embeddings([text], model)[0]
+
+
+def _get_embeddings(texts, model): 
+  """
+  Embeds a list of texts with as few requests as the client allows. 
+  ARGS:
+    texts: a list of str, already normalized by get_embedding. 
+    model: the embedding model. 
+  RETURNS: 
+    a list of embeddings, in the order of <texts>. 
+  """
   # response = embeddings_client.embeddings.create(input=[text], model=model)
   # # cost_logger.update_cost(response=response, input_cost=openai_config["embeddings-costs"]["input"], output_cost=openai_config["embeddings-costs"]["output"])
   # # print("嵌入向量化输出：",response.data[0].embedding)
@@ -326,14 +684,14 @@ def get_embedding(text, model=openai_config["embeddings"]):
     #       time.sleep(2)  # Wait before retrying
 
     # version-3
-    response = get_sparkai_embedding(text=text,style=openai_config["embeddings-domin"])
-    # print("嵌入向量化输出：",response)
-    return response
+    # The sparkai embedding API takes a single text per request. 
+    return [get_sparkai_embedding(text=text,style=openai_config["embeddings-domin"])
+            for text in texts]
   else:
-    response = embeddings_client.embeddings.create(input=[text], model=model)
+    response = embeddings_client.embeddings.create(input=texts, model=model)
     cost_logger.update_cost(response=response, input_cost=openai_config["embeddings-costs"]["input"], output_cost=openai_config["embeddings-costs"]["output"])
-    return response.data[0].embedding
-
+    return [data.embedding for data in sorted(response.data, 
+                                              key=lambda data: data.index)]
 
 if __name__ == '__main__':
   gpt_parameter = {"engine": openai_config["model"], "max_tokens": 50, 
@@ -0,0 +1,139 @@
+"""
+File: llm_cache.py
+Description: Persistent, content-addressed cache of LLM responses used by
+gpt_structure.py. Entries live in a SQLite file and are keyed by the hash of
+(model, prompt, sampling parameters) inside a per-experiment namespace.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class LLMResponseCache:
+    def __init__(self, path: str, namespace: str, ttl: float = None,
+                 max_entries: int = None, cache_sampled: bool = False):
+        """Opens (or creates) the cache database.
+
+        Args:
+            path (str): the SQLite file.
+            namespace (str): entries are only shared inside one namespace,
+                usually the experiment name.
+            ttl (float, optional): seconds after which an entry expires.
+            max_entries (int, optional): per-namespace size; the least
+                recently used entries are evicted beyond it.
+            cache_sampled (bool, optional): also cache requests sampled with
+                temperature > 0. Off by default since those are meant to vary.
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_sampled = cache_sampled
+        self.puts_since_evict = 0
+        self.lock = threading.Lock() # One connection shared by all threads.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " response TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_access REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_lru"
+                " ON responses (namespace, last_access)")
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(model: str, prompt: str, params: dict = None) -> str:
+        """Returns the content address of a request.
+
+        Args:
+            model (str): the model name.
+            prompt (str): the full prompt.
+            params (dict, optional): the sampling parameters (gpt_parameter).
+        """
+        payload = json.dumps({"model": model,
+                              "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+                              "params": params or {}},
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def cacheable(self, temperature) -> bool:
+        """Applies the temperature > 0 bypass policy.
+
+        Args:
+            temperature: the request temperature. None means the provider
+                default, which is sampled.
+        """
+        if self.cache_sampled:
+            return True
+        return temperature is not None and temperature <= 0
+
+    def get(self, key: str):
+        """Returns the cached response, or None on a miss or expired entry."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, created FROM responses"
+                " WHERE namespace = ? AND key = ?",
+                (self.namespace, key)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE namespace = ? AND key = ?",
+                    (self.namespace, key))
+                self.conn.commit()
+                return None
+            self.conn.execute(
+                "UPDATE responses SET last_access = ?"
+                " WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        """Stores (or replaces) a response."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (namespace, key, response, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, response, now, now))
+            self.puts_since_evict += 1
+            if self.puts_since_evict >= 256:
+                self._evict(now)
+            self.conn.commit()
+
+    def delete(self, key: str):
+        """Drops a response, e.g. one that failed validation."""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM responses WHERE namespace = ? AND key = ?",
+                (self.namespace, key))
+            self.conn.commit()
+
+    def _evict(self, now: float):
+        """Drops expired entries and trims the namespace to max_entries.
+        Called with the lock held."""
+        self.puts_since_evict = 0
+        if self.ttl:
+            self.conn.execute(
+                "DELETE FROM responses WHERE namespace = ? AND created < ?",
+                (self.namespace, now - self.ttl))
+        if self.max_entries:
+            self.conn.execute(
+                "DELETE FROM responses WHERE namespace = ? AND key IN ("
+                " SELECT key FROM responses WHERE namespace = ?"
+                " ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.namespace, self.namespace, self.max_entries))
@@ -0,0 +1,181 @@
+"""
+File: llm_record.py
+Description: Record/replay of LLM and embedding calls. In "record" mode every
+call wrapped with @recorded is appended to a JSON-lines log together with its
+inputs and output. In "replay" mode the same calls are answered from that log
+without touching the network.
+
+The prompts depend on the random module (e.g. the IDs in the daily schedule
+prompt, the random choices of plan and execute), so each recorded run also
+logs the seed it is started with (see start_run), and replaying it starts
+from the same seed. The personas draw from their own generators, seeded from
+it (see Persona.rng), so this holds with concurrent cognition as well.
+
+Calls are also tagged with the persona that makes them (see call_context),
+and replayed from that persona's own sequence of outputs: with concurrent
+cognition, the personas' calls interleave differently from run to run, but
+each persona's calls come in the same order.
+"""
+import os
+import json
+import random
+import threading
+import functools
+import contextlib
+from collections import deque
+
+import numpy as np
+
+from persona.prompt_template.llm_cache import LLMResponseCache
+
+
+class LLMRecorder:
+    def __init__(self, path: str, mode: str):
+        """Opens the log for recording or loads it for replay.
+
+        Args:
+            path (str): the JSON-lines log file.
+            mode (str): either "record" or "replay".
+
+        Raises:
+            ValueError: if the mode is invalid.
+            FileNotFoundError: if there is no log to replay.
+        """
+        if mode not in ["record", "replay"]:
+            raise ValueError("Invalid recorder mode")
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        # <replay_log> maps a (context, call key) pair to the outputs 
+        # recorded for it, in call order. Identical calls (e.g. retries) are
+        # answered in the order they were recorded; the last output is reused
+        # once they run out. Logs recorded without contexts have None.
+        self.replay_log = dict()
+        # <replay_seeds> holds the seeds of the recorded runs, in order.
+        self.replay_seeds = deque()
+        if mode == "replay":
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry["kind"] == "seed":
+                        self.replay_seeds.append(entry["seed"])
+                        continue
+                    self.replay_log.setdefault(
+                        (entry.get("context"), entry["key"]), deque()).append(
+                            entry["output"])
+        else:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+    def start_run(self):
+        """Seeds random and numpy.random for a run (e.g. one segment of a
+        checkpointed run). Recording draws a new seed and logs it; replaying
+        uses the seed of the next recorded run.
+
+        Returns:
+            int: the seed, or None for a log recorded without seeds.
+        """
+        if self.mode == "replay":
+            with self.lock:
+                if not self.replay_seeds:
+                    return None
+                seed = self.replay_seeds.popleft()
+        else:
+            seed = random.SystemRandom().randrange(2 ** 32)
+            self._append({"kind": "seed", "seed": seed})
+        random.seed(seed)
+        np.random.seed(seed)
+        return seed
+
+    def record(self, kind: str, key: str, inputs: dict, output):
+        """Appends one call to the log."""
+        self._append({"kind": kind, "key": key, "context": get_call_context(),
+                      "input": inputs, "output": output})
+
+    def _append(self, entry: dict):
+        line = json.dumps(entry)
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def replay(self, kind: str, key: str, inputs: dict):
+        """Returns the recorded output of a call.
+
+        Raises:
+            LookupError: if the call was never recorded.
+        """
+        with self.lock:
+            outputs = (self.replay_log.get((get_call_context(), key))
+                       or self.replay_log.get((None, key)))
+            if not outputs:
+                raise LookupError(
+                    f"(replay): no recorded {kind} call for {inputs}")
+            if len(outputs) > 1:
+                return outputs.popleft()
+            return outputs[0]
+
+
+# The recorder used by every @recorded function; None disables recording.
+active_recorder = None
+
+# <_call_context.name> is the context (persona name) of the current thread's
+# calls.
+_call_context = threading.local()
+
+
+@contextlib.contextmanager
+def call_context(name):
+    """Tags the calls made by the current thread within the block with
+    <name>, e.g. the persona whose cognition makes them."""
+    previous = get_call_context()
+    _call_context.name = name
+    try:
+        yield
+    finally:
+        _call_context.name = previous
+
+
+def get_call_context():
+    """Returns the context of the current thread's calls, or None."""
+    return getattr(_call_context, "name", None)
+
+
+def set_recorder(recorder):
+    """Installs (or, with None, removes) the process-wide recorder."""
+    global active_recorder
+    active_recorder = recorder
+
+
+def get_recorder():
+    """Returns the process-wide recorder, or None."""
+    return active_recorder
+
+
+def recorded(kind: str, inputs_fn):
+    """Decorator that records or replays a request function.
+
+    Args:
+        kind (str): a label for the call, e.g. "gpt" or "embedding".
+        inputs_fn: maps the wrapped function's arguments to a dict with the
+            "model", "prompt" and "params" that identify the call.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            recorder = active_recorder
+            if recorder is None:
+                return fn(*args, **kwargs)
+            inputs = inputs_fn(*args, **kwargs)
+            key = LLMResponseCache.make_key(
+                inputs["model"], inputs["prompt"],
+                {"kind": kind, "params": inputs.get("params")})
+            if recorder.mode == "replay":
+                return recorder.replay(kind, key, inputs)
+            output = fn(*args, **kwargs)
+            recorder.record(kind, key, inputs, output)
+            return output
+        return wrapper
+    return decorator
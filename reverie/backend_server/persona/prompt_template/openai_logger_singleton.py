@@ -1,8 +1,20 @@
+import os
+import json
+import atexit
 import threading
+from datetime import datetime
 
 from openai_cost_logger import OpenAICostLogger, DEFAULT_LOG_PATH
 
 
+# The LLM response cache counters are written next to the cost logs, one file
+# per run: <experiment_name>_<creation_datetime>.cache-stats. The extension
+# keeps them out of the cost logs read by OpenAICostLoggerViz. They are 
+# rewritten every CACHE_STATS_FLUSH lookups and when the process exits.
+CACHE_STATS_EXT = ".cache-stats"
+CACHE_STATS_FLUSH = 100
+
+
 """ Metaclass for creating singletons."""
 class Singleton(type):
     _instance = None
@@ -36,6 +48,14 @@ class OpenAICostLogger_Singleton(metaclass=Singleton):
             log_folder=log_folder
         ) 
         self.lock = threading.Lock() # Lock to ensure thread safety when updating the cost logger.
+        self.cache_hits = 0 # Requests answered by the LLM response cache.
+        self.cache_misses = 0 # Cacheable requests that went to the model.
+        self.experiment_name = experiment_name
+        self.creation_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.cache_stats_path = os.path.join(
+            log_folder, 
+            f"{experiment_name}_{self.creation_datetime.replace(' ', '_')}{CACHE_STATS_EXT}")
+        atexit.register(self.write_cache_stats)
         
     
     def update_cost(self, response: dict, input_cost: float, output_cost: float = 0):
@@ -51,4 +71,90 @@ class OpenAICostLogger_Singleton(metaclass=Singleton):
                 response=response,
                 input_cost=input_cost,
                 output_cost=output_cost
-            )
\ No newline at end of file
+            )
+
+
+    def update_cache_stats(self, hit: bool):
+        """Counts one lookup in the LLM response cache.
+
+        Args:
+            hit (bool): whether the response was served from the cache.
+        """
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+            flush = (self.cache_hits + self.cache_misses) % CACHE_STATS_FLUSH == 0
+        if flush:
+            self.write_cache_stats()
+
+
+    def get_cache_stats(self) -> dict:
+        """Returns the cache hit/miss counters and the hit rate.
+
+        Returns:
+            dict: {"hits": int, "misses": int, "hit_rate": float}
+        """
+        with self.lock:
+            total = self.cache_hits + self.cache_misses
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / total if total else 0.0
+            }
+
+
+    def write_cache_stats(self):
+        """Writes the cache counters of this run next to the cost logs 
+        (nothing if the cache was never looked up)."""
+        stats = self.get_cache_stats()
+        if not stats["hits"] and not stats["misses"]:
+            return
+        stats["experiment_name"] = self.experiment_name
+        stats["creation_datetime"] = self.creation_datetime
+        with self.lock:
+            os.makedirs(os.path.dirname(self.cache_stats_path) or ".", exist_ok=True)
+            with open(self.cache_stats_path + ".tmp", "w") as file:
+                json.dump(stats, file, indent=4)
+            os.replace(self.cache_stats_path + ".tmp", self.cache_stats_path)
+
+
+def read_cache_stats(path: str = DEFAULT_LOG_PATH, experiment: str = None) -> dict:
+    """Sums the cache counters written in a cost-log folder.
+
+    Args:
+        path (str): the cost-log folder.
+        experiment (str, optional): only count the runs of this experiment.
+
+    Returns:
+        dict: {"hits": int, "misses": int, "hit_rate": float}
+    """
+    hits = misses = 0
+    if os.path.isdir(path):
+        for filename in os.listdir(path):
+            if not filename.endswith(CACHE_STATS_EXT):
+                continue
+            with open(os.path.join(path, filename)) as file:
+                stats = json.load(file)
+            if experiment is None or stats["experiment_name"] == experiment:
+                hits += stats["hits"]
+                misses += stats["misses"]
+    total = hits + misses
+    return {"hits": hits, "misses": misses,
+            "hit_rate": hits / total if total else 0.0}
+
+
+def print_experiment_cache_stats(experiment: str, path: str = DEFAULT_LOG_PATH):
+    """Prints the LLM response cache hit rate of an experiment, like 
+    OpenAICostLoggerViz.print_experiment_cost does for its cost."""
+    stats = read_cache_stats(path, experiment)
+    print(f"Cache hits for {experiment}: {stats['hits']}/"
+          f"{stats['hits'] + stats['misses']} ({stats['hit_rate']:.1%})")
+
+
+def print_total_cache_stats(path: str = DEFAULT_LOG_PATH):
+    """Prints the LLM response cache hit rate over all the experiments."""
+    stats = read_cache_stats(path)
+    print(f"Total cache hits: {stats['hits']}/"
+          f"{stats['hits'] + stats['misses']} ({stats['hit_rate']:.1%})")
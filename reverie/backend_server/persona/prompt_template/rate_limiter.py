@@ -0,0 +1,75 @@
+"""
+File: rate_limiter.py
+Description: Token-bucket rate limiters shared by the synchronous and the
+asynchronous LLM request paths in gpt_structure.py.
+"""
+import time
+import asyncio
+import threading
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """Initializes the token bucket.
+
+        Args:
+            rate (float): tokens (requests) added per second.
+            capacity (float, optional): maximum burst size. Defaults to rate.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock() # Shared by threads and event loops.
+
+    def _reserve(self) -> float:
+        """Takes one token, possibly going into debt.
+
+        Returns:
+            float: the number of seconds the caller has to wait before its
+                token is actually available (0 if it can go right away).
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Blocks the calling thread until a token is available."""
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Suspends the calling coroutine until a token is available."""
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+_buckets = dict()
+_buckets_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, rate: float, capacity: float = None):
+    """Returns the process-wide token bucket registered under <key>.
+
+    Args:
+        key (str): the limiter key, e.g. the client name of the llm config.
+        rate (float): requests per second. A falsy rate disables limiting.
+        capacity (float, optional): maximum burst size.
+
+    Returns:
+        TokenBucket or None: None when limiting is disabled.
+    """
+    if not rate:
+        return None
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(rate, capacity)
+        return _buckets[key]
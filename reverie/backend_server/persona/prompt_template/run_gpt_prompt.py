@@ -27,7 +27,7 @@ with open(config_path, "r") as f:
     llm_configs = json.load(f) 
 llm_config = llm_configs["clients"].get(llm_configs["client"]) # 选择模型相应的配置
 
-def get_random_alphanumeric(i=6, j=6): 
+def get_random_alphanumeric(i=6, j=6, rng=random): 
   """
   Returns a random alpha numeric strength that has the length of somewhere
   between i and j. 
@@ -35,11 +35,12 @@ def get_random_alphanumeric(i=6, j=6):
   INPUT: 
     i: min_range for the length
     j: max_range for the length
+    rng: the random generator (e.g., the persona's <rng>). 
   OUTPUT: 
     an alpha numeric str with the length of somewhere between i and j.
   """
-  k = random.randint(i, j)
-  x = ''.join(random.choices(string.ascii_letters + string.digits, k=k))
+  k = rng.randint(i, j)
+  x = ''.join(rng.choices(string.ascii_letters + string.digits, k=k))
   return x
 
 
@@ -199,13 +200,13 @@ def run_gpt_prompt_generate_hourly_schedule(persona,
     if p_f_ds_hourly_org: 
       prior_schedule = "\n"
       for count, i in enumerate(p_f_ds_hourly_org): 
-        prior_schedule += f"[(ID:{get_random_alphanumeric()})" 
+        prior_schedule += f"[(ID:{get_random_alphanumeric(rng=persona.rng)})" 
         prior_schedule += f" {persona.scratch.get_str_curr_date_str()} --"
         prior_schedule += f" {hour_str[count]}] Activity:"
         prior_schedule += f" {persona.scratch.get_str_firstname()}"
         prior_schedule += f" is {i}\n"
 
-    prompt_ending = f"[(ID:{get_random_alphanumeric()})"
+    prompt_ending = f"[(ID:{get_random_alphanumeric(rng=persona.rng)})"
     prompt_ending += f" {persona.scratch.get_str_curr_date_str()}"
     prompt_ending += f" -- {curr_hour_str}] Activity:"
     prompt_ending += f" {persona.scratch.get_str_firstname()} is"
@@ -726,7 +727,7 @@ def run_gpt_prompt_action_sector(action_description,
     # output = random.choice(x)
     output = persona.scratch.living_area.split(":")[1]
 
-  print ("DEBUG", random.choice(x), "------", output)
+  print ("DEBUG", persona.rng.choice(x), "------", output)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -879,7 +880,7 @@ def run_gpt_prompt_action_game_object(action_description,
 
   x = [i.strip() for i in persona.s_mem.get_str_accessible_arena_game_objects(temp_address).split(",")]
   if output not in x: 
-    output = random.choice(x)
+    output = persona.rng.choice(x)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -19,6 +19,7 @@ to the memory stream, and "reverie" to refer to the overarching simulation
 framework.
 """
 import json
+import random
 import numpy
 import datetime
 import pickle
@@ -28,13 +29,17 @@ import os
 import shutil
 import traceback
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from selenium import webdriver
 
 from global_methods import *
 from utils import *
 from maze import *
+from env_channel import EnvironmentChannel
 from persona.persona import *
+from persona.prompt_template.llm_record import (LLMRecorder, set_recorder, 
+  get_recorder, call_context)
 
 current_file = os.path.abspath(__file__)
 
@@ -52,12 +57,40 @@ def trace_calls_and_lines(frame, event, arg):
 #                                  REVERIE                                   #
 ##############################################################################
 
+def is_past_step_file(path, step): 
+  """
+  Returns True if <path>, relative to a simulation folder, is the 
+  environment or movement file of a step before <step>. These files are 
+  written once and never change afterwards. 
+  e.g., is_past_step_file("movement/2999.json", 3000) == True
+  """
+  parts = pathlib.PurePath(path).parts
+  if len(parts) != 2 or parts[0] not in ["environment", "movement"]: 
+    return False
+  step_name, ext = os.path.splitext(parts[1])
+  return ext == ".json" and step_name.isdigit() and int(step_name) < step
+
+
+def run_in_context(persona_name, fn, *args): 
+  """
+  Calls fn(*args) with the LLM calls it makes tagged with <persona_name> 
+  (see llm_record.call_context). Used to run persona cognition in a thread
+  pool. 
+  """
+  with call_context(persona_name): 
+    return fn(*args)
+
+
 class ReverieServer: 
   def __init__(self, 
                fork_sim_code,
                sim_code,
                owner = "public",
-               isCreate = False):
+               isCreate = False,
+               cognition_workers = 1,
+               record_llm = False,
+               replay_llm = None,
+               headless = False):
     # 通过默认参数重载初始化函数
     if isCreate:
         print("(reverie): 临时存储: ", fs_temp_storage)
@@ -74,6 +107,8 @@ class ReverieServer:
         # reverie/meta/json中的fork变量。
         self.sim_code = sim_code
         sim_folder = f"{fs_storage}/{self.sim_code}"
+        # 完成（或丢弃）上次运行中断的存档（见CheckpointWriter）。
+        finish_checkpoint(sim_folder)
 
         with open(f"{sim_folder}/reverie/meta.json") as json_file:  
             reverie_meta = json.load(json_file)
@@ -112,6 +147,10 @@ class ReverieServer:
         # 实际上是指我们的人物移动的数量（按瓷砖数计算）。
         self.step = reverie_meta['step']
 
+        # <retrieval_index> 是可选的近似最近邻检索索引配置（见ann_index.py），
+        # 例如 {"type": "ivf", "prefilter": 200}；None 表示精确检索。
+        self.retrieval_index = reverie_meta.get("retrieval_index")
+
         # 在Reverie中设置角色
         # <personas> 是一个字典，键是角色的全名，值是实际的Persona实例。
         # 该字典用于跟踪所有属于Reverie实例的角色。
@@ -142,17 +181,30 @@ class ReverieServer:
             persona_folder = f"{sim_folder}/personas/{persona_name}"
             p_x = init_env[persona_name]["x"]
             p_y = init_env[persona_name]["y"]
-            curr_persona = Persona(persona_name, persona_folder)
+            curr_persona = Persona(persona_name, persona_folder, 
+                                   self.retrieval_index)
 
             self.personas[persona_name] = curr_persona
             self.personas_tile[persona_name] = (p_x, p_y)
-            self.maze.tiles[p_y][p_x]["events"].add(curr_persona.scratch
-                                                    .get_curr_event_and_desc())
+            self.maze.add_event_from_tile(curr_persona.scratch
+                                          .get_curr_event_and_desc(), 
+                                          (p_x, p_y))
 
         # Reverie设置参数:  
         # <server_sleep> 表示每次循环之间休眠的时间；
         # 这是为了避免占用过多计算资源。
         self.server_sleep = 0.1
+        # <cognition_workers> 是每一步中并行执行人物认知（LLM调用）的线程数；
+        # 1 表示按顺序执行。
+        self.cognition_workers = cognition_workers
+        # <headless> 为True时不使用前端：人物直接移动到上一步给出的瓷砖，
+        # 不再等待前端写入的environment文件（见start_server）。
+        self.headless = headless
+        # 记录/回放LLM与嵌入调用（见setup_llm_log）。
+        self.setup_llm_log(record_llm, replay_llm)
+        # <seed> 是本次运行的种子，每一步与人物名一起为每个人物的随机数
+        # 生成器重新播种（见move_personas）。
+        self.seed = random.getrandbits(32)
 
         # 信号前端服务器: 
         # curr_sim_code.json包含当前的模拟代码，
@@ -186,9 +238,21 @@ class ReverieServer:
       # <sim_code> indicates our current simulation. The first step here is to 
       # copy everything that's in <fork_sim_code>, but edit its 
       # reverie/meta/json's fork variable. 
+      # Only the state that changes as the simulation runs (reverie/ and the
+      # personas' memories) is actually copied: the environment and movement
+      # files of the steps before the fork never change, so they are 
+      # hard-linked to the parent's (see linkanything). 
       self.sim_code = sim_code
       sim_folder = f"{fs_storage}/{self.sim_code}"
-      copyanything(fork_folder, sim_folder) # 模版的使用
+      # A checkpoint interrupted by a crash is completed (or discarded, if it
+      # was not committed) before the simulation is read (see 
+      # CheckpointWriter). 
+      finish_checkpoint(fork_folder)
+      with open(f"{fork_folder}/reverie/meta.json") as json_file:  
+        fork_step = json.load(json_file)["step"]
+      linkanything(fork_folder, sim_folder, # 模版的使用
+                   lambda path: is_past_step_file(path, fork_step))
+      finish_checkpoint(sim_folder)
 
       with open(f"{sim_folder}/reverie/meta.json") as json_file:  
         parent = json.load(json_file)["parent"]
@@ -231,6 +295,11 @@ class ReverieServer:
       # of the number of tiles. 
       self.step = reverie_meta['step']
 
+      # <retrieval_index> optionally configures an approximate nearest-neighbor
+      # index for the personas' retrieval (see ann_index.py), e.g. 
+      # {"type": "ivf", "prefilter": 200}. None keeps exact retrieval. 
+      self.retrieval_index = reverie_meta.get("retrieval_index")
+
       # SETTING UP PERSONAS IN REVERIE
       # <personas> is a dictionary that takes the persona's full name as its 
       # keys, and the actual persona instance as its values.
@@ -263,17 +332,35 @@ class ReverieServer:
         persona_folder = f"{sim_folder}/personas/{persona_name}"
         p_x = init_env[persona_name]["x"]
         p_y = init_env[persona_name]["y"]
-        curr_persona = Persona(persona_name, persona_folder)
+        curr_persona = Persona(persona_name, persona_folder, 
+                               self.retrieval_index)
 
         self.personas[persona_name] = curr_persona
         self.personas_tile[persona_name] = (p_x, p_y)
-        self.maze.tiles[p_y][p_x]["events"].add(curr_persona.scratch
-                                                .get_curr_event_and_desc())
+        self.maze.add_event_from_tile(curr_persona.scratch
+                                      .get_curr_event_and_desc(), 
+                                      (p_x, p_y))
 
       # REVERIE SETTINGS PARAMETERS:  
       # <server_sleep> denotes the amount of time that our while loop rests each
       # cycle; this is to not kill our machine. 
       self.server_sleep = 0.1
+      # <cognition_workers> denotes the number of threads that run the 
+      # personas' LLM-bound cognition in parallel within a step. 1 keeps the
+      # original sequential behavior. 
+      self.cognition_workers = cognition_workers
+      # <headless> runs the simulation without the frontend: personas are 
+      # moved straight to the tiles they were sent to in the previous step,
+      # instead of waiting for the frontend's environment file (see 
+      # start_server). 
+      self.headless = headless
+      # Recording or replaying the LLM and embedding calls (see setup_llm_log).
+      self.setup_llm_log(record_llm, replay_llm)
+      # <seed> is the seed of this run. Each step, the personas' random 
+      # generators are reseeded from it, the step and their name (see 
+      # move_personas). It comes from the random module, which is seeded 
+      # when the LLM calls are recorded or replayed. 
+      self.seed = random.getrandbits(32)
 
       # SIGNALING THE FRONTEND SERVER: 
       # curr_sim_code.json contains the current simulation code, and
@@ -295,6 +382,40 @@ class ReverieServer:
       os.makedirs(f"{sim_folder}/movement/", exist_ok=True)  # exist_ok=True 可以防止文件夹已存在时抛出错误
 
 
+  def setup_llm_log(self, record_llm, replay_llm): 
+    """
+    Installs the LLM call recorder for this run. Recording appends every 
+    GPT_request, ChatGPT_request and get_embedding call to 
+    reverie/llm_log.jsonl of the current simulation; replaying answers those 
+    calls from the log of an earlier run instead of the network. The random 
+    module is seeded from the log too, so that the prompts are the same 
+    (see LLMRecorder.start_run). 
+
+    INPUT
+      record_llm: True if the calls of this run should be recorded. 
+      replay_llm: the sim_code of a recorded run to replay, or None. 
+    OUTPUT 
+      None
+    """
+    if replay_llm: 
+      log_path = f"{fs_storage}/{replay_llm}/reverie/llm_log.jsonl"
+      # A checkpointed run creates one server per segment; they all keep 
+      # consuming the same replay log. 
+      curr_recorder = get_recorder()
+      if (not curr_recorder or curr_recorder.mode != "replay" 
+          or curr_recorder.path != log_path): 
+        set_recorder(LLMRecorder(log_path, "replay"))
+      seed = get_recorder().start_run()
+      print (f"(reverie): Replaying LLM calls from {log_path} (seed: {seed})")
+    elif record_llm: 
+      log_path = f"{fs_storage}/{self.sim_code}/reverie/llm_log.jsonl"
+      set_recorder(LLMRecorder(log_path, "record"))
+      seed = get_recorder().start_run()
+      print (f"(reverie): Recording LLM calls to {log_path} (seed: {seed})")
+    else: 
+      set_recorder(None)
+
+
   def save(self): 
     """
     Save all Reverie progress -- this includes Reverie's global state as well
@@ -309,8 +430,20 @@ class ReverieServer:
     # <sim_folder> points to the current simulation folder.
     sim_folder = f"{fs_storage}/{self.sim_code}"
 
-    # Save Reverie meta information.
-    reverie_meta = dict() 
+    # The personas and the meta information (with the step) are saved as one
+    # checkpoint: a crash while saving leaves the previous one in place, or 
+    # the new one if it was committed already (see CheckpointWriter). 
+    checkpoint = CheckpointWriter(sim_folder)
+
+    # Save the personas. 
+    for persona_name, persona in self.personas.items(): 
+      save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
+      persona.save(save_folder, checkpoint.stage(save_folder))
+
+    # Save Reverie meta information. The keys that are only set when the 
+    # simulation is forked (e.g., "owner", "parent") are kept. 
+    with open(f"{sim_folder}/reverie/meta.json") as json_file: 
+      reverie_meta = json.load(json_file)
     reverie_meta["fork_sim_code"] = self.fork_sim_code
     reverie_meta["start_date"] = self.start_time.strftime("%B %d, %Y")
     reverie_meta["curr_time"] = self.curr_time.strftime("%B %d, %Y, %H:%M:%S")
@@ -318,15 +451,13 @@ class ReverieServer:
     reverie_meta["maze_name"] = self.maze.maze_name
     reverie_meta["persona_names"] = list(self.personas.keys())
     reverie_meta["step"] = self.step
+    if self.retrieval_index: 
+      reverie_meta["retrieval_index"] = self.retrieval_index
     # reverie_meta["running_status"] = "finished" # 添加状态记录
-    reverie_meta_f = f"{sim_folder}/reverie/meta.json"
-    with open(reverie_meta_f, "w") as outfile: 
-      outfile.write(json.dumps(reverie_meta, indent=2))
+    reverie_meta_f = f"{checkpoint.stage(f'{sim_folder}/reverie')}/meta.json"
+    write_json_atomic(reverie_meta, reverie_meta_f, indent=2)
 
-    # Save the personas.
-    for persona_name, persona in self.personas.items(): 
-      save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
-      persona.save(save_folder)
+    checkpoint.commit()
 
 
   def start_path_tester_server(self): 
@@ -425,6 +556,9 @@ class ReverieServer:
     understand the state of the world, calls on each personas to make 
     decisions based on the world state, and saves their moves at certain step
     intervals. 
+    In headless mode there is no frontend: the world state of each step is 
+    the tiles the personas were sent to in the previous step, and the 
+    environment file is written by the backend itself. 
     INPUT
       int_counter: Integer value for the number of steps left for us to take
                    in this iteration. 
@@ -444,117 +578,249 @@ class ReverieServer:
     # <game_obj_cleanup> is used for that. 
     game_obj_cleanup = dict()
 
-    # The main while loop of Reverie. 
-    while (True): 
+    # <headless_env> stands in for the frontend's environment file in 
+    # headless mode. It starts from the personas' current tiles. 
+    headless_env = dict()
+    for persona_name, tile in self.personas_tile.items(): 
+      headless_env[persona_name] = {"maze": self.maze.maze_name, 
+                                    "x": tile[0], 
+                                    "y": tile[1]}
+
+    # Otherwise, the frontend pushes each environment to us and waits for our
+    # movements through <env_channel> (see env_channel.py). The environment
+    # files are still read if nothing is pushed, e.g., by an older frontend.
+    env_channel = None
+    if not self.headless: 
+      env_channel = EnvironmentChannel(self.sim_code)
+      env_channel.start()
+
+    # The channel is closed (and its socket removed) however the loop ends.
+    try: 
+      # The main while loop of Reverie. 
+      while (True): 
       
-      # Done with this iteration if <int_counter> reaches 0. 
-      if int_counter == 0: 
-        break
-
-      # <curr_env_file> file is the file that our frontend outputs. When the
-      # frontend has done its job and moved the personas, then it will put a 
-      # new environment file that matches our step count. That's when we run 
-      # the content of this for loop. Otherwise, we just wait. 
-      curr_env_file = f"{sim_folder}/environment/{self.step}.json"
-      if check_if_file_exists(curr_env_file):
-        # If we have an environment file, it means we have a new perception
-        # input to our personas. So we first retrieve it.
-        try: 
-          # Try and save block for robustness of the while loop.
-          with open(curr_env_file) as json_file:
-            new_env = json.load(json_file)
+        # Done with this iteration if <int_counter> reaches 0. 
+        if int_counter == 0: 
+          break
+
+        # <curr_env_file> file is the file that our frontend outputs. When the
+        # frontend has done its job and moved the personas, then it will put a 
+        # new environment file that matches our step count. That's when we run 
+        # the content of this for loop. Otherwise, we just wait. 
+        curr_env_file = f"{sim_folder}/environment/{self.step}.json"
+        # Waiting (for at most <server_sleep>) for the frontend to push it. 
+        pushed_env = None
+        if env_channel: 
+          pushed_env = env_channel.wait_environment(self.step, self.server_sleep)
+        if (self.headless or pushed_env is not None 
+            or check_if_file_exists(curr_env_file)):
+          # If we have an environment file, it means we have a new perception
+          # input to our personas. So we first retrieve it.
+          if self.headless: 
+            new_env = headless_env
+            env_retrieved = True
+          elif pushed_env is not None: 
+            new_env = pushed_env
             env_retrieved = True
-        except: 
-          pass
+          else: 
+            try: 
+              # Try and save block for robustness of the while loop.
+              with open(curr_env_file) as json_file:
+                new_env = json.load(json_file)
+                env_retrieved = True
+            except: 
+              pass
       
-        if env_retrieved: 
-          # This is where we go through <game_obj_cleanup> to clean up all 
-          # object actions that were used in this cylce. 
-          for key, val in game_obj_cleanup.items(): 
-            # We turn all object actions to their blank form (with None). 
-            self.maze.turn_event_from_tile_idle(key, val)
-          # Then we initialize game_obj_cleanup for this cycle. 
-          game_obj_cleanup = dict()
-
-          # We first move our personas in the backend environment to match 
-          # the frontend environment. 
-          for persona_name, persona in self.personas.items(): 
-            # <curr_tile> is the tile that the persona was at previously. 
-            curr_tile = self.personas_tile[persona_name]
-            # <new_tile> is the tile that the persona will move to right now,
-            # during this cycle. 
-            new_tile = (new_env[persona_name]["x"], 
-                        new_env[persona_name]["y"])
-
-            # We actually move the persona on the backend tile map here. 
-            self.personas_tile[persona_name] = new_tile
-            self.maze.remove_subject_events_from_tile(persona.name, curr_tile)
-            self.maze.add_event_from_tile(persona.scratch
-                                         .get_curr_event_and_desc(), new_tile)
-
-            # Now, the persona will travel to get to their destination. *Once*
-            # the persona gets there, we activate the object action.
-            if not persona.scratch.planned_path: 
-              # We add that new object action event to the backend tile map. 
-              # At its creation, it is stored in the persona's backend. 
-              game_obj_cleanup[persona.scratch
-                               .get_curr_obj_event_and_desc()] = new_tile
+          if env_retrieved: 
+            # This is where we go through <game_obj_cleanup> to clean up all 
+            # object actions that were used in this cylce. 
+            for key, val in game_obj_cleanup.items(): 
+              # We turn all object actions to their blank form (with None). 
+              self.maze.turn_event_from_tile_idle(key, val)
+            # Then we initialize game_obj_cleanup for this cycle. 
+            game_obj_cleanup = dict()
+
+            # We first move our personas in the backend environment to match 
+            # the frontend environment. 
+            for persona_name, persona in self.personas.items(): 
+              # <curr_tile> is the tile that the persona was at previously. 
+              curr_tile = self.personas_tile[persona_name]
+              # <new_tile> is the tile that the persona will move to right now,
+              # during this cycle. 
+              new_tile = (new_env[persona_name]["x"], 
+                          new_env[persona_name]["y"])
+
+              # We actually move the persona on the backend tile map here. 
+              self.personas_tile[persona_name] = new_tile
+              self.maze.remove_subject_events_from_tile(persona.name, curr_tile)
               self.maze.add_event_from_tile(persona.scratch
-                                     .get_curr_obj_event_and_desc(), new_tile)
-              # We also need to remove the temporary blank action for the 
-              # object that is currently taking the action. 
-              blank = (persona.scratch.get_curr_obj_event_and_desc()[0], 
-                       None, None, None)
-              self.maze.remove_event_from_tile(blank, new_tile)
-
-          # Then we need to actually have each of the personas perceive and
-          # move. The movement for each of the personas comes in the form of
-          # x y coordinates where the persona will move towards. e.g., (50, 34)
-          # This is where the core brains of the personas are invoked. 
-          movements = {"persona": dict(), 
-                       "meta": dict()}
-          for persona_name, persona in self.personas.items(): 
-            # <next_tile> is a x,y coordinate. e.g., (58, 9)
-            # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
-            # <description> is a string description of the movement. e.g., 
-            #   writing her next novel (editing her novel) 
-            #   @ double studio:double studio:common room:sofa
-            next_tile, pronunciatio, description = persona.move(
-              self.maze, self.personas, self.personas_tile[persona_name], 
-              self.curr_time)
-            movements["persona"][persona_name] = {}
-            movements["persona"][persona_name]["movement"] = next_tile
-            movements["persona"][persona_name]["pronunciatio"] = pronunciatio
-            movements["persona"][persona_name]["description"] = description
-            movements["persona"][persona_name]["chat"] = (persona
-                                                          .scratch.chat)
-
-          # Include the meta information about the current stage in the 
-          # movements dictionary. 
-          movements["meta"]["curr_time"] = (self.curr_time 
-                                             .strftime("%B %d, %Y, %H:%M:%S"))
-
-          # We then write the personas' movements to a file that will be sent 
-          # to the frontend server. 
-          # Example json output: 
-          # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
-          #  "persona": {"Klaus Mueller": {"movement": [38, 12]}}, 
-          #  "meta": {curr_time: <datetime>}}
-          curr_move_path = f"{sim_folder}/movement"
-          if not os.path.exists(curr_move_path):
-            os.makedirs(curr_move_path)
-          curr_move_file = f"{sim_folder}/movement/{self.step}.json"
-          with open(curr_move_file, "w") as outfile: 
-            outfile.write(json.dumps(movements, indent=2))
-
-          # After this cycle, the world takes one step forward, and the 
-          # current time moves by <sec_per_step> amount. 
-          self.step += 1
-          self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
-
-          int_counter -= 1
-      # Sleep so we don't burn our machines. 
-      time.sleep(self.server_sleep)
+                                           .get_curr_event_and_desc(), new_tile)
+
+              # Now, the persona will travel to get to their destination. *Once*
+              # the persona gets there, we activate the object action.
+              if not persona.scratch.planned_path: 
+                # We add that new object action event to the backend tile map. 
+                # At its creation, it is stored in the persona's backend. 
+                game_obj_cleanup[persona.scratch
+                                 .get_curr_obj_event_and_desc()] = new_tile
+                self.maze.add_event_from_tile(persona.scratch
+                                       .get_curr_obj_event_and_desc(), new_tile)
+                # We also need to remove the temporary blank action for the 
+                # object that is currently taking the action. 
+                blank = (persona.scratch.get_curr_obj_event_and_desc()[0], 
+                         None, None, None)
+                self.maze.remove_event_from_tile(blank, new_tile)
+
+            # Then we need to actually have each of the personas perceive and
+            # move. The movement for each of the personas comes in the form of
+            # x y coordinates where the persona will move towards. e.g., (50, 34)
+            # This is where the core brains of the personas are invoked. 
+            movements = {"persona": dict(), 
+                         "meta": dict()}
+            executions = self.move_personas()
+            for persona_name, persona in self.personas.items(): 
+              # <next_tile> is a x,y coordinate. e.g., (58, 9)
+              # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
+              # <description> is a string description of the movement. e.g., 
+              #   writing her next novel (editing her novel) 
+              #   @ double studio:double studio:common room:sofa
+              next_tile, pronunciatio, description = executions[persona_name]
+              movements["persona"][persona_name] = {}
+              movements["persona"][persona_name]["movement"] = next_tile
+              movements["persona"][persona_name]["pronunciatio"] = pronunciatio
+              movements["persona"][persona_name]["description"] = description
+              movements["persona"][persona_name]["chat"] = (persona
+                                                            .scratch.chat)
+
+            # Include the meta information about the current stage in the 
+            # movements dictionary. 
+            movements["meta"]["curr_time"] = (self.curr_time 
+                                               .strftime("%B %d, %Y, %H:%M:%S"))
+
+            # We then write the personas' movements to a file that will be sent 
+            # to the frontend server. 
+            # Example json output: 
+            # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
+            #  "persona": {"Klaus Mueller": {"movement": [38, 12]}}, 
+            #  "meta": {curr_time: <datetime>}}
+            curr_move_path = f"{sim_folder}/movement"
+            if not os.path.exists(curr_move_path):
+              os.makedirs(curr_move_path)
+            curr_move_file = f"{sim_folder}/movement/{self.step}.json"
+            with open(curr_move_file, "w") as outfile: 
+              outfile.write(json.dumps(movements, indent=2))
+            if env_channel: 
+              env_channel.publish_movement(self.step, movements)
+
+            # After this cycle, the world takes one step forward, and the 
+            # current time moves by <sec_per_step> amount. 
+            self.step += 1
+            self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
+
+            # In headless mode, the personas simply arrive at their next tile. 
+            # We still write the environment file the frontend would have 
+            # written, so that the simulation can be resumed with a frontend.
+            if self.headless: 
+              headless_env = dict()
+              for persona_name, execution in executions.items(): 
+                next_tile = execution[0]
+                headless_env[persona_name] = {"maze": self.maze.maze_name, 
+                                              "x": next_tile[0], 
+                                              "y": next_tile[1]}
+              curr_env_file = f"{sim_folder}/environment/{self.step}.json"
+              with open(curr_env_file, "w") as outfile: 
+                outfile.write(json.dumps(headless_env, indent=2))
+
+            int_counter -= 1
+    finally: 
+      if env_channel: 
+        env_channel.close()
+
+
+  def move_personas(self): 
+    """
+    Runs one cognitive step (perceive, retrieve, plan, reflect, execute) for
+    every persona and returns their executions. 
+
+    With <cognition_workers> set to 1, this is the original sequential loop
+    over Persona.move. Otherwise the step runs in three phases over a bounded
+    thread pool: 
+      1) perceive and retrieve for all personas concurrently. The maze is not
+         written during cognition, and each persona only writes its own 
+         memory here. 
+      2) plan/reflect/execute concurrently for personas that did not retrieve
+         another persona's event -- they cannot touch anyone else's state. 
+      3) plan/reflect/execute sequentially, in persona order, for the 
+         remaining "social" personas and the personas they react to, since 
+         a chat reaction writes into both participants' scratch. 
+    Results are merged by persona name, so the movement file has the same
+    shape and ordering as in sequential mode. The personas draw from their
+    own random generators (see Persona.rng), reseeded here every step, so 
+    the draws do not depend on thread scheduling either, and their LLM calls
+    are tagged with their name, so that they are replayed in each persona's 
+    order (see llm_record.py). 
+
+    INPUT
+      None
+    OUTPUT
+      executions: a dictionary keyed by persona name whose values are the 
+                  (next_tile, pronunciatio, description) triple.
+    """
+    for persona_name, persona in self.personas.items(): 
+      persona.rng.seed(f"{self.seed}:{self.step}:{persona_name}")
+
+    executions = dict()
+    if self.cognition_workers <= 1: 
+      for persona_name, persona in self.personas.items(): 
+        with call_context(persona_name): 
+          executions[persona_name] = persona.move(
+            self.maze, self.personas, self.personas_tile[persona_name], 
+            self.curr_time)
+      return executions
+
+    # Every persona's tile is fixed before the fan-out so that personas 
+    # reading each other's <curr_tile> (e.g., while chatting) see the same
+    # snapshot regardless of thread scheduling. 
+    for persona_name, persona in self.personas.items(): 
+      persona.scratch.curr_tile = self.personas_tile[persona_name]
+
+    with ThreadPoolExecutor(max_workers=self.cognition_workers) as pool: 
+      futures = dict()
+      for persona_name, persona in self.personas.items(): 
+        futures[persona_name] = pool.submit(run_in_context, persona_name,
+                                            persona.move_perceive, 
+                                            self.maze, 
+                                            self.personas_tile[persona_name],
+                                            self.curr_time)
+      perceptions = {name: f.result() for name, f in futures.items()}
+
+      social = set()
+      for persona_name, persona in self.personas.items(): 
+        partners = persona.reacts_to(perceptions[persona_name][1], 
+                                     self.personas)
+        if partners: 
+          social.add(persona_name)
+          social.update(partners)
+
+      futures = dict()
+      for persona_name, persona in self.personas.items(): 
+        if persona_name not in social: 
+          new_day, retrieved = perceptions[persona_name]
+          futures[persona_name] = pool.submit(run_in_context, persona_name,
+                                              persona.move_act, 
+                                              self.maze, self.personas, 
+                                              new_day, retrieved)
+      for persona_name, f in futures.items(): 
+        executions[persona_name] = f.result()
+
+    for persona_name, persona in self.personas.items(): 
+      if persona_name in social: 
+        new_day, retrieved = perceptions[persona_name]
+        with call_context(persona_name): 
+          executions[persona_name] = persona.move_act(self.maze, 
+                                                      self.personas,
+                                                      new_day, retrieved)
+    return executions
 
 
   def open_server(self, input_command: str = None) -> None: 
@@ -775,11 +1041,38 @@ if __name__ == '__main__':
     default="test-simulation",
     help='The name of the new simulation'
   )
+  parser.add_argument(
+    '--workers',
+    type=int,
+    default=1,
+    help='Number of threads running persona cognition in parallel each step'
+  )
+  parser.add_argument(
+    '--record',
+    action='store_true',
+    help='Record all LLM and embedding calls to reverie/llm_log.jsonl'
+  )
+  parser.add_argument(
+    '--replay',
+    type=str,
+    default=None,
+    help='Replay the LLM and embedding calls recorded by this simulation'
+  )
+  parser.add_argument(
+    '--headless',
+    action='store_true',
+    help='Step the simulation without the frontend'
+  )
     
   origin = parser.parse_args().origin
   target = parser.parse_args().target
+  workers = parser.parse_args().workers
+  record = parser.parse_args().record
+  replay = parser.parse_args().replay
+  headless = parser.parse_args().headless
   
-  rs = ReverieServer(origin, target)
+  rs = ReverieServer(origin, target, cognition_workers=workers, 
+                     record_llm=record, replay_llm=replay, headless=headless)
   rs.open_server()
 
 
@@ -42,6 +42,22 @@ while [[ $# -gt 0 ]]; do
             echo "(${FILE_NAME}): Running backend server at: http://127.0.0.1:${2}/simulator_home"
             shift 2
             ;;
+        --workers|-w)
+            ARGS="${ARGS} --workers ${2}"
+            shift 2
+            ;;
+        --record)
+            ARGS="${ARGS} --record"
+            shift 1
+            ;;
+        --replay)
+            ARGS="${ARGS} --replay ${2}"
+            shift 2
+            ;;
+        --headless)
+            ARGS="${ARGS} --headless"
+            shift 1
+            ;;
         --owner)
             ARGS="${ARGS} --owner ${2}"
             shift 2